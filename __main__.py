@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 # coding=utf-8
-import json
+import os
 import sys
 import signal
 
+from message_adapter import codec, framing, ingest, log, tracing
 from message_adapter.message_adapter import MessageAdapter
 
 
@@ -13,7 +14,7 @@ def callMessageAdapterFunction(functionName, allInput):
 
     Parameters:
     functionName(string): CMA function to run (one of loadAndUpdateRemoteEvent, loadNestedEvent
-                          and createNextEvent
+                          and createNextEvent, or their Batch variants)
     input(dict):          Dict object representing a parsed cumulus message
 
     Returns:
@@ -23,7 +24,10 @@ def callMessageAdapterFunction(functionName, allInput):
         schemas = allInput['schemas']
     else:
         schemas = None
-    transformer = MessageAdapter(schemas)
+    # Input is parsed fresh for every command, so the adapter may update it in place
+    transformer = MessageAdapter(schemas, owns_events=True)
+    if functionName.endswith('Batch'):
+        return callBatchFunction(transformer, functionName, allInput)
     event = allInput['event']
     context = allInput.get('context')
     result = None
@@ -42,12 +46,94 @@ def callMessageAdapterFunction(functionName, allInput):
         raise ValueError(f'Unknown function name {functionName}')
     return result
 
-def handle_exit():
-    """ Method that explicitly flushes stderr/stdout before exiting 1"""
+def callBatchFunction(transformer, functionName, allInput):
+    """
+    Runs the batch variant of a CMA function: 'events' (with matching 'contexts',
+    'handler_responses' and 'message_configs' lists where the function takes them) is
+    processed concurrently and a {"result"} or {"error", "message"} record is returned per event
+    """
+    events = allInput['events']
+    if functionName == 'loadAndUpdateRemoteEventBatch':
+        return transformer.load_and_update_remote_events(events, allInput.get('contexts'))
+    if functionName == 'loadNestedEventBatch':
+        return transformer.load_nested_events(events)
+    if functionName == 'createNextEventBatch':
+        return transformer.create_next_events(allInput['handler_responses'], events,
+                                              allInput.get('message_configs'))
+    raise ValueError(f'Unknown function name {functionName}')
+
+def runCommand(functionName, body):
+    """
+    Decodes a request body, runs a CMA function on it and returns the encoded response,
+    traced as one command when CMA_TRACE is set. A bytearray body is cleared once decoded;
+    an ingest.IncrementalParser body is read from its stream as it is decoded
+    """
+    try:
+        with tracing.command(functionName):
+            with tracing.span('deserialize', bytes=len(body)):
+                allInput = ingest.load(body)
+            result = callMessageAdapterFunction(functionName, allInput)
+            with tracing.span('serialize') as span:
+                response = codec.dumps(result)
+                span.set(bytes=len(response))
+    finally:
+        log.flush()
+    return response
+
+def handle_exit(*_):
+    """ Signal handler that flushes buffered logs, stderr and stdout before exiting 1"""
+    log.flush()
     sys.stdout.flush()
     sys.stderr.flush()
     sys.exit(1)
 
+def streamLineCommands(reader, writer, first_line):
+    """
+    Runs the original line-based stream protocol, starting from an already-read first line.
+    Lines are read from the binary reader; responses are written to the binary writer.
+    Body lines are read in chunks straight into the request body, which is limited to
+    CMA_MAX_INPUT_BYTES
+    """
+    limit = ingest.max_input_bytes()
+    next_line = first_line
+    body = bytearray()
+    command = ''
+
+    while next_line and next_line.rstrip(b'\r\n') != b'<EXIT>':
+        if next_line.rstrip(b'\r\n') == b'<EOC>':
+            response = runCommand(command, body)
+            writer.write(response + b'\n<EOC>\n')
+            writer.flush()
+            body = bytearray()
+            command = ''
+        elif not command:
+            command = next_line.decode('utf-8').strip()
+            log.logger.debug('setting command to %s', command)
+        else:
+            body += next_line
+            if not next_line.endswith(b'\n'):
+                ingest.read_line(reader, limit, body)
+            while body[-1:] in (b'\n', b'\r'):
+                del body[-1]
+            ingest.check_size(len(body), limit)
+        next_line = reader.readline(ingest.CHUNK_SIZE)
+
+
+def streamFramedCommands(reader, writer):
+    """
+    Runs the length-prefixed stream protocol (see message_adapter.framing) until <EXIT>
+    or end of input
+    """
+    limit = ingest.max_input_bytes()
+    incremental = ingest.incremental()
+    while True:
+        request = framing.read_request(reader, limit, incremental)
+        if request is None:
+            return
+        command, body = request
+        framing.write_response(writer, runCommand(command, body))
+
+
 def streamCommands():
     """
     Method that runs, and reads messages on STDIN in the format:
@@ -62,36 +148,46 @@ def streamCommands():
     <EOC>
 
     A single line "<EXIT>" input will cause the program to exit
+
+    If the first line is "<FRAMED>", the CMA acknowledges it with the same line and the
+    rest of the session uses the length-prefixed protocol in message_adapter.framing.
+    "<PIPELINED>" selects the pipelined variant, served concurrently by
+    message_adapter.pipeline with limits from the CMA_STREAM_* environment variables
     """
+    streamSession(sys.stdin.buffer, sys.stdout.buffer)
 
-    cont = True
-    buffer = ''
-    command = ''
-    jsonObj = {}
-
-    while cont:
-        next_line = sys.stdin.readline().rstrip('\n')
-        if next_line == '<EXIT>':
-            cont = False
-        elif next_line == '<EOC>':
-            jsonObj = json.loads(buffer)
-            result = callMessageAdapterFunction(command, jsonObj)
-            sys.stdout.write(json.dumps(result) + "\n")
-            sys.stdout.write('<EOC>\n')
-            sys.stdout.flush()
-            buffer = ''
-            command = ''
+
+def streamSession(reader, writer):
+    """
+    Serves one stream session (see streamCommands) on binary reader and writer streams:
+    STDIN/STDOUT, or a daemon connection
+    """
+    first_line = reader.readline()
+    handshake = first_line.rstrip(b'\r\n')
+    if handshake in (framing.HANDSHAKE, framing.PIPELINED_HANDSHAKE):
+        writer.write(handshake + b'\n')
+        writer.flush()
+        if handshake == framing.HANDSHAKE:
+            streamFramedCommands(reader, writer)
         else:
-            if not command:
-                command = next_line.strip()
-                sys.stderr.write(f'warning setting command to {command}\n')
-            else:
-                buffer += next_line
+            from message_adapter import pipeline  # pylint: disable=import-outside-toplevel
+            pipeline.serve_pipelined(reader, writer, runCommand,
+                                     **pipeline.limits_from_environment())
+    else:
+        streamLineCommands(reader, writer, first_line)
 
 
 def singleCommand(functionName):
     """Executes a single CMA command"""
-    allInput = json.loads(input())
+    limit = ingest.max_input_bytes()
+    if ingest.incremental():
+        body = ingest.IncrementalParser(sys.stdin.buffer, limit)
+    else:
+        body = ingest.read_line(sys.stdin.buffer, limit)
+    with tracing.span('deserialize', bytes=len(body)) as span:
+        allInput = ingest.load(body)
+        if isinstance(body, ingest.IncrementalParser):
+            span.set(bytes=len(body))
     return callMessageAdapterFunction(functionName, allInput)
 
 
@@ -108,17 +204,28 @@ def cmaCli():
         if functionName == 'stream':
             streamCommands()
             exitCode = 0
+        elif functionName == 'daemon':
+            from message_adapter import daemon  # pylint: disable=import-outside-toplevel
+            socketPath = sys.argv[2] if len(sys.argv) > 2 else os.environ['CMA_DAEMON_SOCKET']
+            daemon.serve(socketPath, streamSession)
+            exitCode = 0
         else:
-            result = singleCommand(functionName)
-            if (result is not None and len(result) > 0):
-                sys.stdout.write(json.dumps(result))
-                sys.stdout.flush()
-                exitCode = 0
+            with tracing.command(functionName):
+                result = singleCommand(functionName)
+                # A batch's result is a list with a record per event, empty for an empty batch
+                if result is not None and (len(result) > 0 or isinstance(result, list)):
+                    with tracing.span('serialize') as span:
+                        response = codec.dumps(result)
+                        span.set(bytes=len(response))
+                    sys.stdout.buffer.write(response)
+                    sys.stdout.flush()
+                    exitCode = 0
 
     except LookupError as le:
-        sys.stderr.write("Lookup error: " + str(le))
+        log.logger.error('Lookup error: %s', le)
     except Exception:  # pylint: disable=broad-except
-        sys.stderr.write(f'Unexpected Error {str(sys.exc_info()[0])}. {str(sys.exc_info()[1])}')
+        log.logger.error('Unexpected Error %s. %s', sys.exc_info()[0], sys.exc_info()[1])
+    log.flush()
     sys.exit(exitCode)
 
 
@@ -0,0 +1,120 @@
+"""
+Cold-start budget for the CMA command line
+
+Measures, in fresh interpreters, the time to import message_adapter.message_adapter and the
+wall-clock latency of one single-command CLI call for each CMA function, on a message with
+no replace pointer and no schemas. It also records which heavy dependencies (boto3,
+jsonschema, jsonpath_ng) that path loads. Results are compared against
+benchmarks/cold_start_budget.json; with --check the exit status is non-zero when any
+median exceeds its budget or a dependency is loaded that the budget does not allow.
+
+Usage: python -m benchmarks.cold_start [--repeats N] [--check]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_budget.json')
+HEAVY_MODULES = ['boto3', 'botocore', 'jsonschema', 'fastjsonschema', 'jsonpath_ng']
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import message_adapter.message_adapter
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed,
+                  'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+EVENT = {
+    'task_config': {'bar': '{$.meta.foo}'},
+    'cumulus_meta': {'message_source': 'local', 'id': 'id-1234'},
+    'meta': {'foo': 'bar'},
+    'payload': {'anykey': 'anyvalue'}
+}
+
+COMMANDS = {
+    'loadAndUpdateRemoteEvent': {'event': EVENT},
+    'loadNestedEvent': {'event': EVENT},
+    'createNextEvent': {'event': EVENT, 'handler_response': {'result': 'ok'}},
+}
+
+
+def measure_import(repeats):
+    """ Returns the import times (seconds) and the heavy modules the import loaded """
+    samples = []
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=REPO_ROOT,
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        samples.append(result['seconds'])
+        loaded = result['loaded']
+    return samples, loaded
+
+
+def measure_command(command, command_input, repeats):
+    """ Returns the wall-clock times (seconds) of running one CLI command in a new process """
+    samples = []
+    body = json.dumps(command_input)
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, REPO_ROOT, command], input=body, check=True,
+                       capture_output=True, text=True)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def median_ms(samples):
+    """ Returns the median of samples (seconds) in milliseconds """
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def over_budget(results, budget):
+    """ Returns a list of human readable budget violations """
+    failures = []
+    for name, limit in budget.get('import_ms', {}).items():
+        if results['import_ms'].get(name, 0) > limit:
+            failures.append(f'import of {name}: {results["import_ms"][name]}ms > {limit}ms')
+    for name, limit in budget.get('command_ms', {}).items():
+        if results['command_ms'].get(name, 0) > limit:
+            failures.append(f'{name}: {results["command_ms"][name]}ms > {limit}ms')
+    allowed = set(budget.get('allowed_modules', []))
+    for module in results['loaded_modules']:
+        if module not in allowed:
+            failures.append(f'import loads {module}')
+    return failures
+
+
+def main():
+    """ Prints the cold-start measurements as JSON and optionally enforces the budget """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--budget', default=BUDGET_FILE)
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    import_samples, loaded = measure_import(args.repeats)
+    results = {
+        'python': sys.version.split()[0],
+        'repeats': args.repeats,
+        'import_ms': {'message_adapter.message_adapter': median_ms(import_samples)},
+        'command_ms': {command: median_ms(measure_command(command, command_input, args.repeats))
+                       for command, command_input in COMMANDS.items()},
+        'loaded_modules': loaded
+    }
+    with open(args.budget, encoding='utf-8') as budget_file:
+        failures = over_budget(results, json.load(budget_file))
+    results['over_budget'] = failures
+    print(json.dumps(results, indent=2))
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
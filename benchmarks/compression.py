@@ -0,0 +1,77 @@
+"""
+Size and latency of offloaded payloads with and without compression
+
+Stores a synthetic granule payload with store_remote_response and reads it back with
+load_remote_event once per compression setting, against the local S3 stand-in used by the
+tests (localstack, selected with CUMULUS_ENV=testing and LOCALSTACK_HOST). Reports the
+stored object size and the median store and load latencies.
+
+Usage: CUMULUS_ENV=testing python -m benchmarks.compression [--granules N] [--repeats N]
+"""
+import argparse
+import importlib.util
+import json
+import statistics
+import time
+
+from message_adapter import aws, cumulus_message
+from .messages import generate_message
+
+BUCKET = 'cma-compression-benchmark'
+
+
+def run(algorithm, payload, repeats):
+    """ Returns the stored size and store/load latencies for one compression setting """
+    bucket = aws.s3().Bucket(BUCKET)
+    store_times = []
+    load_times = []
+    stored_bytes = 0
+    for _ in range(repeats):
+        event = {
+            'cumulus_meta': {'system_bucket': BUCKET},
+            'payload': payload,
+            'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 0, 'Compression': algorithm}
+        }
+        start = time.perf_counter()
+        stored = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+        store_times.append(time.perf_counter() - start)
+
+        key = stored['replace']['Key']
+        stored_bytes = bucket.Object(key).content_length
+        start = time.perf_counter()
+        loaded = cumulus_message.load_remote_event(stored)
+        load_times.append(time.perf_counter() - start)
+        assert loaded['payload'] == payload
+        bucket.Object(key).delete()
+
+    return {
+        'stored_bytes': stored_bytes,
+        'store_ms': round(statistics.median(store_times) * 1000, 2),
+        'load_ms': round(statistics.median(load_times) * 1000, 2)
+    }
+
+
+def main():
+    """ Prints a JSON comparison of the compression settings """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--granules', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = generate_message(granules=args.granules, files=args.files)['event']['payload']
+    algorithms = ['none', 'gzip']
+    if importlib.util.find_spec('zstandard') is not None:
+        algorithms.append('zstd')
+
+    aws.s3().Bucket(BUCKET).create()
+    try:
+        results = {algorithm: run(algorithm, payload, args.repeats) for algorithm in algorithms}
+    finally:
+        aws.s3().Bucket(BUCKET).delete()
+    print(json.dumps({'granules': args.granules, 'files': args.files, 'results': results},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Peak-memory comparison of MessageAdapter with and without owns_events
+
+Runs loadAndUpdateRemoteEvent, loadNestedEvent and createNextEvent over a synthetic
+message (wrapped in a 'cma' parameter block, with a ReplaceConfig large enough that nothing
+is offloaded so no S3 endpoint is needed) and reports the tracemalloc peak above the
+memory already held by the inputs.
+
+Usage: python -m benchmarks.memory [--granules N] [--files N]
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from message_adapter.message_adapter import MessageAdapter
+from .messages import generate_message
+
+
+def run_pipeline(owns_events, granules, files):
+    """ Returns the peak traced bytes allocated by one full CMA invocation """
+    message = generate_message(granules=granules, files=files)
+    event = {'cma': {'event': message['event'],
+                     'ReplaceConfig': {'Path': '$.payload', 'MaxSize': sys.maxsize}}}
+    handler_response = message['handler_response']
+    del message
+    gc.collect()
+
+    adapter = MessageAdapter(owns_events=owns_events)
+    tracemalloc.start()
+    try:
+        full_event = adapter.load_and_update_remote_event(event, None)
+        nested = adapter.load_nested_event(full_event)
+        adapter.create_next_event(handler_response, full_event, nested.get('messageConfig'))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def main():
+    """ Prints a JSON comparison of the default and owns_events peaks """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--granules', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=4)
+    args = parser.parse_args()
+
+    default_peak = run_pipeline(False, args.granules, args.files)
+    owned_peak = run_pipeline(True, args.granules, args.files)
+    print(json.dumps({
+        'granules': args.granules,
+        'files': args.files,
+        'default_peak_bytes': default_peak,
+        'owns_events_peak_bytes': owned_peak,
+        'reduction': round(1 - owned_peak / default_peak, 3) if default_peak else None
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Synthetic Cumulus messages for benchmarks, modelled on the examples/messages shapes
+"""
+
+
+def granule(index, files):
+    """ Returns a granule record with the given number of files """
+    granule_id = f'MOD09GQ.A{2017000 + index}.h{index % 36:02d}v{index % 18:02d}.006'
+    return {
+        'granuleId': granule_id,
+        'dataType': 'MOD09GQ',
+        'version': '006',
+        'files': [{
+            'bucket': 'cumulus-protected',
+            'key': f'MOD09GQ___006/2017/{granule_id}.{file_index}.hdf',
+            'fileName': f'{granule_id}.{file_index}.hdf',
+            'size': 1048576 + file_index,
+            'checksumType': 'md5',
+            'checksum': f'{index:016x}{file_index:016x}',
+        } for file_index in range(files)]
+    }
+
+
+def generate_message(granules=100, files=4, config_keys=10, templates=10, outputs=1):
+    """
+    * Builds a Cumulus message and a matching handler response
+    * @param {int} granules     Number of granules in the payload
+    * @param {int} files        Number of files per granule
+    * @param {int} config_keys  Number of literal task_config entries
+    * @param {int} templates    Number of templated task_config entries
+    * @param {int} outputs      Number of cumulus_message.outputs entries
+    * @returns {dict} {'event': <Cumulus message>, 'handler_response': <task output>}
+    """
+    meta = {
+        'collection': {'name': 'MOD09GQ', 'version': '006', 'granuleIdExtraction': '(.*)'},
+        'provider': {'id': 'MODAPS', 'protocol': 'https', 'host': 'example.com'},
+        'buckets': {'protected': {'name': 'cumulus-protected', 'type': 'protected'}},
+    }
+    for index in range(templates):
+        meta[f'field{index}'] = f'value{index}'
+
+    task_config = {f'literal{index}': f'a literal configuration value {index}'
+                   for index in range(config_keys)}
+    for index in range(templates):
+        task_config[f'template{index}'] = f'prefix-{{$.meta.field{index}}}-suffix'
+    task_config['collection'] = '{$.meta.collection}'
+    task_config['provider'] = '{$.meta.provider}'
+    task_config['cumulus_message'] = {
+        'input': '{$.payload}',
+        'outputs': [{'source': '{$.granules}', 'destination': '{$.payload.granules}'}] + [
+            {'source': f'{{$.counts.c{index}}}', 'destination': f'{{$.meta.outputs.o{index}}}'}
+            for index in range(outputs - 1)
+        ]
+    }
+
+    event = {
+        'task_config': task_config,
+        'cumulus_meta': {
+            'message_source': 'sfn',
+            'state_machine': 'arn:aws:states:us-east-1:1234:stateMachine:MySfn',
+            'execution_name': 'MyExecution__id-1234',
+            'system_bucket': 'cumulus-internal',
+            'id': 'id-1234'
+        },
+        'meta': meta,
+        'payload': {'granules': [granule(index, files) for index in range(granules)]},
+        'exception': 'None'
+    }
+    handler_response = {
+        'granules': [granule(index, files) for index in range(granules)],
+        'counts': {f'c{index}': index for index in range(outputs)}
+    }
+    return {'event': event, 'handler_response': handler_response}
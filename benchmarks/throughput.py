@@ -0,0 +1,284 @@
+"""
+Throughput and latency of the CMA over scaled synthetic messages
+
+Generates a message with benchmarks.messages at the requested scale and times, over the same
+inputs:
+* each MessageAdapter method, in process
+* each CMA function as a single-command CLI call, one process per call
+* each stream protocol (line, framed and pipelined), one session per protocol, with the
+  three CMA functions sent in turn
+
+With --remote the payload is offloaded to, and loaded back from, the local S3 stand-in used
+by the tests (localstack, selected with CUMULUS_ENV=testing and LOCALSTACK_HOST); otherwise
+no S3 endpoint is needed. Results are printed as JSON, and written to --output if given.
+With --compare, results are checked against an earlier output file: any timing whose
+median is more than --tolerance slower than the baseline is reported, and the exit status
+is non-zero.
+
+Usage: python -m benchmarks.throughput [--granules N] [--files N] [--config-keys N]
+       [--templates N] [--outputs N] [--repeats N] [--remote] [--output FILE]
+       [--compare BASELINE] [--tolerance FRACTION]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from copy import deepcopy
+
+from message_adapter import aws, codec, cumulus_message
+from message_adapter.message_adapter import MessageAdapter
+from .messages import generate_message
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = 'cma-throughput-benchmark'
+COMMANDS = ['loadAndUpdateRemoteEvent', 'loadNestedEvent', 'createNextEvent']
+
+
+def summarize(samples, elapsed=None):
+    """ Returns the median and p95 (milliseconds) of samples (seconds) """
+    ordered = sorted(samples)
+    summary = {
+        'count': len(ordered),
+        'median_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3)
+    }
+    if elapsed:
+        summary['requests_per_second'] = round(len(ordered) / elapsed, 2)
+    return summary
+
+
+def build_inputs(scale, remote):
+    """
+    * Returns the CLI input of each CMA function for a message at the given scale. With
+    * remote, the event's payload is stored on S3 and createNextEvent stores its output there.
+    """
+    message = generate_message(**scale)
+    event = message['event']
+    if remote:
+        event['cumulus_meta']['system_bucket'] = BUCKET
+        event = cumulus_message.store_remote_response(
+            dict(event, ReplaceConfig={'Path': '$.payload', 'MaxSize': 0}), 0,
+            ['ReplaceConfig'])
+
+    adapter = MessageAdapter()
+    full_event = adapter.load_and_update_remote_event(event, None)
+    nested = adapter.load_nested_event(full_event)
+    if remote:
+        full_event['ReplaceConfig'] = {'Path': '$.payload', 'MaxSize': 0}
+    return {
+        'loadAndUpdateRemoteEvent': {'event': event},
+        'loadNestedEvent': {'event': full_event},
+        'createNextEvent': {'event': full_event,
+                            'handler_response': message['handler_response'],
+                            'message_config': nested.get('messageConfig')}
+    }
+
+
+def call_adapter(command, command_input):
+    """ Runs one CMA function in process on an input the adapter may update in place """
+    adapter = MessageAdapter(owns_events=True)
+    if command == 'loadAndUpdateRemoteEvent':
+        return adapter.load_and_update_remote_event(command_input['event'], None)
+    if command == 'loadNestedEvent':
+        return adapter.load_nested_event(command_input['event'])
+    return adapter.create_next_event(command_input['handler_response'],
+                                     command_input['event'], command_input['message_config'])
+
+
+def measure_adapter(inputs, repeats):
+    """ Times each MessageAdapter method in process, after one untimed warm-up call """
+    results = {}
+    for command, command_input in inputs.items():
+        samples = []
+        for repeat in range(repeats + 1):
+            working_input = deepcopy(command_input)
+            start = time.perf_counter()
+            call_adapter(command, working_input)
+            if repeat:
+                samples.append(time.perf_counter() - start)
+        results[f'adapter.{command}'] = summarize(samples)
+    return results
+
+
+def measure_single_commands(bodies, repeats):
+    """ Times one single-command CLI process per call, including interpreter start-up """
+    results = {}
+    for command, body in bodies.items():
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, REPO_ROOT, command], input=body + b'\n',
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+        results[f'cli.single.{command}'] = summarize(samples)
+    return results
+
+
+def start_stream(handshake=None):
+    """ Starts a CMA stream session, negotiating a protocol if a handshake is given """
+    # The session outlives this function; finish_stream closes it
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, REPO_ROOT, 'stream'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    if handshake is not None:
+        process.stdin.write(handshake + b'\n')
+        process.stdin.flush()
+        if process.stdout.readline() != handshake + b'\n':
+            raise RuntimeError(f'stream did not acknowledge {handshake!r}')
+    return process
+
+
+def finish_stream(process):
+    """ Ends a stream session and checks it exited cleanly """
+    process.stdin.write(b'<EXIT>\n')
+    process.stdin.close()
+    if process.wait(60) != 0:
+        raise RuntimeError(f'stream exited with status {process.returncode}')
+
+
+def line_request(process, command, body):
+    """ Sends one line-protocol request and reads its response """
+    process.stdin.write(command.encode('utf-8') + b'\n' + body + b'\n<EOC>\n')
+    process.stdin.flush()
+    while process.stdout.readline() not in (b'<EOC>\n', b''):
+        pass
+
+
+def framed_request(process, command, body):
+    """ Sends one framed-protocol request and reads its response """
+    process.stdin.write(f'{command} {len(body)}\n'.encode('utf-8') + body)
+    process.stdin.flush()
+    length = int(process.stdout.readline())
+    process.stdout.read(length)
+
+
+def measure_sequential_stream(handshake, send, requests):
+    """ Times each request of a sequential stream session, after one untimed request """
+    process = start_stream(handshake)
+    try:
+        send(process, *requests[0])
+        samples = []
+        began = time.perf_counter()
+        for command, body in requests:
+            start = time.perf_counter()
+            send(process, command, body)
+            samples.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - began
+    finally:
+        finish_stream(process)
+    return summarize(samples, elapsed)
+
+
+def measure_pipelined_stream(requests):
+    """ Sends every request of a pipelined session at once and times each response """
+    process = start_stream(b'<PIPELINED>')
+    sent = {}
+
+    def write_requests():
+        for request_id, (command, body) in enumerate(requests):
+            sent[str(request_id)] = time.perf_counter()
+            process.stdin.write(f'{request_id} {command} {len(body)}\n'.encode('utf-8') + body)
+            process.stdin.flush()
+
+    try:
+        command, body = requests[0]
+        process.stdin.write(f'warm-up {command} {len(body)}\n'.encode('utf-8') + body)
+        process.stdin.flush()
+        process.stdout.read(int(process.stdout.readline().split()[2]))
+
+        began = time.perf_counter()
+        writer = threading.Thread(target=write_requests)
+        writer.start()
+        samples = []
+        for _ in requests:
+            request_id, status, length = process.stdout.readline().split()
+            process.stdout.read(int(length))
+            samples.append(time.perf_counter() - sent[request_id.decode('utf-8')])
+            if status != b'OK':
+                raise RuntimeError(f'request {request_id.decode("utf-8")} failed')
+        elapsed = time.perf_counter() - began
+        writer.join()
+    finally:
+        finish_stream(process)
+    return summarize(samples, elapsed)
+
+
+def measure_streams(bodies, repeats):
+    """ Times the three stream protocols over repeats rounds of the CMA functions """
+    requests = [(command, bodies[command]) for _ in range(repeats) for command in COMMANDS]
+    return {
+        'cli.stream.line': measure_sequential_stream(None, line_request, requests),
+        'cli.stream.framed': measure_sequential_stream(b'<FRAMED>', framed_request, requests),
+        'cli.stream.pipelined': measure_pipelined_stream(requests)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of human readable regressions of results against a baseline """
+    regressions = []
+    for name, timing in sorted(results['timings'].items()):
+        previous = baseline.get('timings', {}).get(name)
+        if previous and timing['median_ms'] > previous['median_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: median {timing["median_ms"]}ms > '
+                               f'{previous["median_ms"]}ms baseline')
+    return regressions
+
+
+def main():
+    """ Prints the throughput and latency measurements as JSON """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--granules', type=int, default=100)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--config-keys', type=int, default=10)
+    parser.add_argument('--templates', type=int, default=10)
+    parser.add_argument('--outputs', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--remote', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    scale = {'granules': args.granules, 'files': args.files, 'config_keys': args.config_keys,
+             'templates': args.templates, 'outputs': args.outputs}
+    if args.remote:
+        aws.s3().Bucket(BUCKET).create()
+    try:
+        inputs = build_inputs(scale, args.remote)
+        bodies = {command: codec.dumps(command_input) for command, command_input in inputs.items()}
+        timings = measure_adapter(inputs, args.repeats)
+        timings.update(measure_single_commands(bodies, args.repeats))
+        timings.update(measure_streams(bodies, args.repeats))
+    finally:
+        if args.remote:
+            bucket = aws.s3().Bucket(BUCKET)
+            bucket.objects.all().delete()
+            bucket.delete()
+
+    results = {
+        'python': sys.version.split()[0],
+        'codec': codec.default_codec().name,
+        'scale': scale,
+        'remote': args.remote,
+        'message_bytes': len(bodies['loadNestedEvent']),
+        'repeats': args.repeats,
+        'timings': timings
+    }
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            results['regressions'] = compare(results, json.load(baseline_file), args.tolerance)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
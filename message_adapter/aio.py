@@ -0,0 +1,210 @@
+"""
+asyncio interface to the CMA
+
+AsyncMessageAdapter offers awaitable versions of the three MessageAdapter operations for
+tasks running on an event loop. Remote message portions are read and written through an
+ObjectStore, and the portions of one message are fetched or stored concurrently, so a
+single worker can overlap the hydration and offloading of many messages. Message
+interpretation itself (config resolution, schema validation, output assignment) is CPU work
+and runs on the loop, exactly as MessageAdapter runs it.
+
+Stores:
+* S3ObjectStore (the default): S3 through the process-wide boto3 resource, with each
+  blocking request run on a thread by asyncio.to_thread
+* MemoryObjectStore: a dict, for tests and local runs
+* FileSystemObjectStore: files under a root directory, one directory per bucket
+
+The async path does not use the remote cache or the HEAD-based reuse of content-addressed
+objects; ContentAddressed keys are still derived from the content, so identical portions
+overwrite the same object.
+"""
+import abc
+import asyncio
+import os
+
+from copy import deepcopy
+
+from . import codec, compression, transfer
+from .cumulus_message import apply_remote_events, object_key, remote_pointers
+from .message_adapter import MessageAdapter
+
+
+class ObjectStore(abc.ABC):
+    """ Asynchronous get/put of stored message portions """
+
+    @abc.abstractmethod
+    async def get(self, bucket, key):
+        """
+        * Reads a stored object
+        * @param {string} bucket The bucket named in the replace pointer
+        * @param {string} key The object key
+        * @returns {tuple} (stored bytes, ContentEncoding or None)
+        """
+
+    @abc.abstractmethod
+    async def put(self, bucket, key, body, content_encoding=None):
+        """
+        * Writes an object
+        * @param {string} bucket The bucket configured in ReplaceConfig
+        * @param {string} key The object key
+        * @param {bytes} body The stored (possibly compressed) bytes
+        * @param {string|None} content_encoding The compression the body was stored with
+        """
+
+
+class MemoryObjectStore(ObjectStore):
+    """ Keeps objects in a dict keyed by (bucket, key) """
+
+    def __init__(self):
+        self.objects = {}
+
+    async def get(self, bucket, key):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise LookupError(f'No object {key} in bucket {bucket}') from None
+
+    async def put(self, bucket, key, body, content_encoding=None):
+        self.objects[(bucket, key)] = (bytes(body), content_encoding)
+
+
+class FileSystemObjectStore(ObjectStore):
+    """
+    Keeps objects as files at <root>/<bucket>/<key>, with the content encoding, if any, in a
+    <key>.encoding file beside each one
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(os.path.normpath(self.root), '')):
+            raise ValueError(f'Object key {key} is outside the store')
+        return path
+
+    def _read(self, bucket, key):
+        path = self._path(bucket, key)
+        with open(path, 'rb') as object_file:
+            body = object_file.read()
+        try:
+            with open(f'{path}.encoding', encoding='utf-8') as encoding_file:
+                content_encoding = encoding_file.read() or None
+        except FileNotFoundError:
+            content_encoding = None
+        return body, content_encoding
+
+    def _write(self, bucket, key, body, content_encoding):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as object_file:
+            object_file.write(body)
+        if content_encoding is None:
+            try:
+                os.remove(f'{path}.encoding')
+            except FileNotFoundError:
+                pass
+        else:
+            with open(f'{path}.encoding', 'w', encoding='utf-8') as encoding_file:
+                encoding_file.write(content_encoding)
+        os.replace(temporary, path)
+
+    async def get(self, bucket, key):
+        return await asyncio.to_thread(self._read, bucket, key)
+
+    async def put(self, bucket, key, body, content_encoding=None):
+        await asyncio.to_thread(self._write, bucket, key, body, content_encoding)
+
+
+class S3ObjectStore(ObjectStore):
+    """ Reads and writes S3 objects with the CMA's boto3 resource, each call on a thread """
+
+    @staticmethod
+    def _read(bucket, key):
+        from .aws import s3  # pylint: disable=import-outside-toplevel
+        response = s3().Object(bucket, key).get()
+        return response['Body'].read(), response.get('ContentEncoding')
+
+    @staticmethod
+    def _write(bucket, key, body, content_encoding):
+        from .aws import s3  # pylint: disable=import-outside-toplevel
+        transfer.upload_body(s3().Object(bucket, key), body,
+                             transfer.object_arguments(content_encoding))
+
+    async def get(self, bucket, key):
+        return await asyncio.to_thread(self._read, bucket, key)
+
+    async def put(self, bucket, key, body, content_encoding=None):
+        await asyncio.to_thread(self._write, bucket, key, body, content_encoding)
+
+
+def _decode(stored, pointer):
+    body, content_encoding = stored
+    algorithm = pointer.get('Compression')
+    if algorithm is None and content_encoding in compression.ALGORITHMS:
+        algorithm = content_encoding
+    return codec.loads(compression.decompress(body, algorithm))
+
+
+class AsyncMessageAdapter:
+    """
+    Awaitable MessageAdapter whose remote message portions go through an ObjectStore.
+    schemas and owns_events are as for MessageAdapter.
+    """
+
+    def __init__(self, schemas=None, owns_events=False, store=None):
+        self.adapter = MessageAdapter(schemas, owns_events)
+        self.store = S3ObjectStore() if store is None else store
+
+    async def load_remote_event(self, event):
+        """
+        * Replaces the remote pointers of a Cumulus message with the data they point to,
+        * fetching all of them concurrently
+        * @param {*} event An event in the Cumulus message format, updated in place
+        * @returns {*} the updated event
+        """
+        if 'replace' not in event:
+            return event
+        pointers = remote_pointers(event)
+        stored = await asyncio.gather(*(self.store.get(pointer['Bucket'], pointer['Key'])
+                                        for pointer in pointers))
+        remote_events = [_decode(body, pointer) for body, pointer in zip(stored, pointers)]
+        return apply_remote_events(event, pointers, remote_events)
+
+    async def load_and_update_remote_event(self, incoming_event, context):
+        """ Awaitable MessageAdapter.load_and_update_remote_event """
+        adapter = self.adapter
+        event = incoming_event if adapter.owns_events else deepcopy(incoming_event)
+        target = adapter.remote_event_target(event)
+        remote_pointer = target.get('replace') if target else None
+        await self.load_remote_event(target)
+        return adapter.update_loaded_event(event, target, remote_pointer, context)
+
+    async def load_nested_event(self, event):
+        """ Awaitable MessageAdapter.load_nested_event; it reads nothing remote """
+        return self.adapter.load_nested_event(event)
+
+    async def create_next_event(self, handler_response, event, message_config):
+        """
+        * Awaitable MessageAdapter.create_next_event; the portions of the output message that
+        * are offloaded are all written to the store concurrently
+        """
+        pending = []
+
+        def store_body(bucket, body, replace_config_values):
+            key = object_key(body, replace_config_values)
+            algorithm = replace_config_values['compression']
+            pending.append(self.store.put(bucket, key, compression.compress(body, algorithm),
+                                          algorithm))
+            return key
+
+        try:
+            result = self.adapter.create_next_event(handler_response, event, message_config,
+                                                    store_body=store_body)
+        except BaseException:
+            for put in pending:
+                put.close()
+            raise
+        await asyncio.gather(*pending)
+        return result
@@ -1,6 +1,15 @@
 """ Determines the correct AWS endpoint for AWS services """
 import os
-from boto3 import resource
+import threading
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# boto3 sessions are not safe to build resources from concurrently
+_resource_lock = threading.Lock()
+_s3_resource = None
+_s3_resource_key = None
+_stepfunctions_client = None
+_stepfunctions_client_key = None
 
 def localhost_s3_url():
     """ Returns configured LOCALSTACK_HOST url or default for localstack s3 """
@@ -11,67 +20,85 @@ def localhost_s3_url():
     return s3_url
 
 
-def s3():
-    """ Determines the endpoint for the S3 service """
+def _s3_settings():
+    """ Returns the environment settings that determine how the S3 resource is built """
+    testing = os.environ.get('CUMULUS_ENV') == 'testing'
+    return (
+        localhost_s3_url() if testing else None,
+        int(os.environ.get('CMA_S3_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        os.environ.get('CMA_S3_TCP_KEEPALIVE', 'true').lower() == 'true'
+    )
 
-    if ('CUMULUS_ENV' in os.environ) and (os.environ['CUMULUS_ENV'] == 'testing'):
-        return resource(
+
+def _create_s3(endpoint_url, max_pool_connections, tcp_keepalive):
+    # boto3 is imported here so commands that never touch S3 do not pay for it
+    from boto3.session import Session  # pylint: disable=import-outside-toplevel
+    from botocore.config import Config  # pylint: disable=import-outside-toplevel
+    config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive)
+    if endpoint_url is not None:
+        return Session().resource(
             service_name='s3',
-            endpoint_url=localhost_s3_url(),
+            endpoint_url=endpoint_url,
             aws_access_key_id='my-id',
             aws_secret_access_key='my-secret',
             region_name='us-east-1',
-            verify=False
+            verify=False,
+            config=config
         )
-    return resource('s3')
+    return Session().resource('s3', config=config)
 
-def _get_sfn_execution_arn_by_name(state_machine_arn, execution_name):
-    """
-    * Given a state machine arn and execution name, returns the execution's ARN
-    * @param {string} state_machine_arn The ARN of the state machine containing the execution
-    * @param {string} execution_name The name of the execution
-    * @returns {string} The execution's ARN
-    """
-    return (':').join([state_machine_arn.replace(':stateMachine:', ':execution:'),
-                       execution_name])
 
-
-def _get_task_name_from_execution_history(execution_history, arn):
+def s3():
     """
-    * Given an execution history object returned by the StepFunctions API and an optional
-    * Activity or Lambda ARN returns the most recent task name started for the given ARN,
-    * or if no ARN is supplied, the most recent task started.
-    *
-    * IMPORTANT! If no ARN is supplied, this message assumes that the most recently started
-    * execution is the desired execution. This WILL BREAK parallel executions, so always supply
-    * this if possible.
-    *
-    * @param {dict} executionHistory The execution history returned by getExecutionHistory,
-    * assumed to be sorted so most recent executions come last
-    * @param {string} arn An ARN to an Activity or Lambda to find. See "IMPORTANT!"
-    * @throws If no matching task is found
-    * @returns {string} The matching task name
+    * Returns the process-wide S3 resource, creating it on first use. The resource (and the
+    * connection pool of its client) is reused by later calls, including across stream
+    * commands and warm Lambda invocations, until CUMULUS_ENV, LOCALSTACK_HOST or the
+    * CMA_S3_* pool settings change.
+    * The underlying client is thread-safe; callers should create their own Object/Bucket
+    * instances from the resource rather than sharing them between threads.
+    * @returns {boto3.resources.base.ServiceResource} the S3 resource
     """
-    events_by_id = {}
+    global _s3_resource, _s3_resource_key  # pylint: disable=global-statement
+    settings = _s3_settings()
+    with _resource_lock:
+        if _s3_resource is None or _s3_resource_key != settings:
+            _s3_resource = _create_s3(*settings)
+            _s3_resource_key = settings
+        return _s3_resource
 
-    # Create a lookup table for finding events by their id
-    for event in execution_history['events']:
-        events_by_id[event['id']] = event
 
-    for step in execution_history['events']:
-        # Find the ARN in the history (the API is awful here).  When found, return its
-        # previousEventId's (TaskStateEntered) name
-        lambda_of_type_and_matching_arn = (
-            (step['type'] == 'LambdaFunctionScheduled' and
-             step['lambdaFunctionScheduledEventDetails']['resource'] == arn) or
-            (step['type'] == 'ActivityScheduled' and
-             step['activityScheduledEventDetails']['resource'] == arn))
+def _create_stepfunctions(endpoint_url):
+    from boto3.session import Session  # pylint: disable=import-outside-toplevel
+    if endpoint_url is not None:
+        return Session().client(
+            service_name='stepfunctions',
+            endpoint_url=endpoint_url,
+            aws_access_key_id='my-id',
+            aws_secret_access_key='my-secret',
+            region_name='us-east-1',
+            verify=False
+        )
+    return Session().client('stepfunctions')
+
 
-        if (arn is not None and lambda_of_type_and_matching_arn and
-                'stateEnteredEventDetails' in events_by_id[step['previousEventId']]):
-            return events_by_id[step['previousEventId']]['stateEnteredEventDetails']['name']
+def stepfunctions():
+    """
+    * Returns the process-wide Step Functions client, creating it on first use and again
+    * when CUMULUS_ENV or LOCALSTACK_HOST change
+    * @returns {botocore.client.BaseClient} the Step Functions client
+    """
+    global _stepfunctions_client, _stepfunctions_client_key  # pylint: disable=global-statement
+    endpoint_url = _s3_settings()[0]
+    with _resource_lock:
+        if _stepfunctions_client is None or _stepfunctions_client_key != endpoint_url:
+            _stepfunctions_client = _create_stepfunctions(endpoint_url)
+            _stepfunctions_client_key = endpoint_url
+        return _stepfunctions_client
 
-        if step['type'] == 'TaskStateEntered':
-            return step['stateEnteredEventDetails']['name']
 
-    raise LookupError('No task found for ' + arn)
+def reset_s3():
+    """ Drops the process-wide S3 resource; the next s3() call creates a new one """
+    global _s3_resource, _s3_resource_key  # pylint: disable=global-statement
+    with _resource_lock:
+        _s3_resource = None
+        _s3_resource_key = None
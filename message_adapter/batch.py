@@ -0,0 +1,53 @@
+"""
+Concurrent execution of CMA operations over batches of messages
+
+run_batch applies one operation to every item of a batch and returns a record per item:
+{"result": <value>} on success, or {"error": <exception type>, "message": <text>} on
+failure, so one bad message does not fail the batch. The first item runs alone, which
+compiles the config plans and loads the schema validators that the rest then share from the
+process-wide caches. The remaining items run on a thread pool so their S3 downloads and
+uploads overlap.
+
+Settings:
+* CMA_BATCH_WORKERS: number of items processed at once (default 8)
+"""
+import contextvars
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
+
+
+def error_record(exception):
+    """ Returns the {'error', 'message'} record reported for a failed item or request """
+    return {'error': type(exception).__name__, 'message': str(exception)}
+
+
+def _run_item(function, arguments):
+    try:
+        return {'result': function(*arguments)}
+    except Exception as exception:  # pylint: disable=broad-except
+        return error_record(exception)
+
+
+def run_batch(function, items, workers=None):
+    """
+    * Applies function to every item of a batch
+    * @param {function} function The operation, called as function(*item)
+    * @param {list} items Argument tuples, one per message
+    * @param {int} workers Maximum items run at once; defaults to CMA_BATCH_WORKERS
+    * @returns {list} a result or error record per item, in item order
+    """
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, int(workers or os.environ.get('CMA_BATCH_WORKERS', DEFAULT_WORKERS)))
+    records = [_run_item(function, items[0])]
+    if workers == 1:
+        return records + [_run_item(function, item) for item in items[1:]]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        # Each item runs in a copy of this context so its trace spans join the command's
+        futures = [executor.submit(contextvars.copy_context().run, _run_item, function, item)
+                   for item in items[1:]]
+        return records + [future.result() for future in futures]
@@ -0,0 +1,98 @@
+"""
+JSON encoding and decoding for every CMA boundary (CLI input/output, S3 bodies, size checks)
+
+orjson is used when it is installed, with the stdlib json module as the fallback. The
+backend is chosen by CMA_JSON_CODEC: "auto" (the default) uses orjson if it can be imported,
+"orjson" requires it and "stdlib" forces the json module. Either way, dumps returns compact
+UTF-8 bytes and loads accepts bytes or str.
+
+Documents orjson cannot encode are passed to the stdlib: integers outside the 64-bit range,
+nesting deeper than orjson's limit and strings with lone surrogates. Input orjson rejects,
+such as the NaN/Infinity literals, is decoded by the stdlib. Two differences remain, both
+matching how JavaScript consumers of the message already behave: orjson decodes integers
+outside the 64-bit range as floats, and encodes NaN and Infinity floats as null.
+"""
+import json
+import os
+
+from functools import lru_cache
+
+BACKENDS = ('auto', 'orjson', 'stdlib')
+
+
+class StdlibCodec:
+    """ JSON codec backed by the json module """
+
+    name = 'stdlib'
+
+    @staticmethod
+    def dumps(obj):
+        """ Returns obj encoded as compact UTF-8 JSON bytes """
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        """ Returns the object decoded from JSON bytes or str """
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """ JSON codec backed by orjson, deferring to StdlibCodec where orjson would differ """
+    # orjson is a compiled extension pylint cannot introspect
+    # pylint: disable=no-member
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson  # pylint: disable=import-outside-toplevel
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        """ Returns obj encoded as compact UTF-8 JSON bytes """
+        try:
+            return self._orjson.dumps(obj, option=self._options)
+        except self._orjson.JSONEncodeError:
+            return StdlibCodec.dumps(obj)
+
+    def loads(self, data):
+        """ Returns the object decoded from JSON bytes or str """
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            return StdlibCodec.loads(data)
+
+
+@lru_cache(maxsize=None)
+def get_codec(backend='auto'):
+    """
+    * Returns the codec for a backend name
+    * @param {string} backend One of BACKENDS
+    * @throws ImportError if backend is "orjson" and orjson is not installed
+    * @returns {StdlibCodec|OrjsonCodec} the codec
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown JSON codec {backend!r}, expected one of {BACKENDS}')
+    if backend == 'stdlib':
+        return StdlibCodec()
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        if backend == 'orjson':
+            raise
+        return StdlibCodec()
+
+
+def default_codec():
+    """ Returns the codec selected by CMA_JSON_CODEC """
+    return get_codec(os.environ.get('CMA_JSON_CODEC', 'auto').lower())
+
+
+def dumps(obj):
+    """ Encodes obj as compact UTF-8 JSON bytes with the default codec """
+    return default_codec().dumps(obj)
+
+
+def loads(data):
+    """ Decodes JSON bytes or str with the default codec """
+    return default_codec().loads(data)
@@ -0,0 +1,77 @@
+"""
+Compression of message portions stored on S3
+
+Compression is opt-in, either per task with the ReplaceConfig "Compression" key or for the
+process with CMA_REMOTE_COMPRESSION. gzip is always available; zstd requires the zstandard
+package. The algorithm used is recorded in the replace pointer (and as the object's
+ContentEncoding) so load_remote_event can decompress transparently, while pointers written
+without one are read as plain JSON.
+"""
+import gzip
+import os
+
+ALGORITHMS = ('gzip', 'zstd')
+NONE_VALUES = ('', 'none')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _zstandard():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as exception:
+        raise ValueError('zstd compression requires the zstandard package') from exception
+    return zstandard
+
+
+def resolve_algorithm(configured=None):
+    """
+    * Returns the compression algorithm to use for an offloaded message portion
+    * @param {string} configured The ReplaceConfig Compression value, if any; when absent
+    *                            CMA_REMOTE_COMPRESSION is used
+    * @throws ValueError if the algorithm is not supported
+    * @returns {string|None} the algorithm name, or None for no compression
+    """
+    if configured is None:
+        configured = os.environ.get('CMA_REMOTE_COMPRESSION', 'none')
+    algorithm = str(configured).lower()
+    if algorithm in NONE_VALUES:
+        return None
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f'Unsupported compression {configured!r}, expected one of '
+                         f'{ALGORITHMS} or "none"')
+    return algorithm
+
+
+def compress(body, algorithm):
+    """
+    * Compresses an encoded message portion
+    * @param {bytes} body The encoded JSON
+    * @param {string|None} algorithm One of ALGORITHMS, or None to return body unchanged
+    * @returns {bytes} the compressed body
+    """
+    if algorithm is None:
+        return body
+    if algorithm == 'gzip':
+        # A fixed mtime keeps the output identical for identical input
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if algorithm == 'zstd':
+        return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError(f'Unsupported compression {algorithm!r}')
+
+
+def decompress(body, algorithm):
+    """
+    * Reverses compress
+    * @param {bytes} body The stored object body
+    * @param {string|None} algorithm The algorithm the body was compressed with, or None
+    * @returns {bytes} the encoded JSON
+    """
+    if algorithm is None:
+        return body
+    if algorithm == 'gzip':
+        return gzip.decompress(body)
+    if algorithm == 'zstd':
+        # Frames written by ZstdCompressor.compress carry their content size
+        return _zstandard().ZstdDecompressor().decompress(body)
+    raise ValueError(f'Unsupported compression {algorithm!r}')
@@ -0,0 +1,217 @@
+"""
+Compiles task configuration into reusable resolution plans
+
+A plan records, once per distinct task_config, which leaves are JSONPath templates (with
+their paths already parsed) and which subtrees are literal. Applying a plan to an event
+then only touches the templated leaves instead of re-running the template regexes against
+every string in the configuration.
+"""
+# pylint: disable=too-few-public-methods
+import hashlib
+import json
+import re
+
+from .jsonpath_cache import parse
+from .lru import LRUCache, size_from_environment
+
+VALUE_REGEX = re.compile(r"^{[^\[\]].*}$")
+ARRAY_REGEX = re.compile(r"^{\[.*\]}$")
+TEMPLATE_REGEX = re.compile('{[^}]+}')
+
+DEFAULT_PLAN_CACHE_SIZE = 128
+
+
+class _Literal:
+    """ A subtree containing no templates; resolves to the current config value as-is """
+
+    @staticmethod
+    def resolve(event, value):  # pylint: disable=unused-argument
+        """ Returns the literal value """
+        return value
+
+
+LITERAL = _Literal()
+
+
+class _ValueTemplate:
+    """ "{$.path}" / "{{$.path}}": the first value matched by the path, or None """
+
+    def __init__(self, path):
+        self.path = parse(path)
+
+    def resolve(self, event, value):  # pylint: disable=unused-argument
+        """ Returns the first match of the path in event """
+        match_data = self.path.find_values(event)
+        return match_data[0] if match_data else None
+
+
+class _ArrayTemplate:
+    """ "{[$.path]}": every value matched by the path """
+
+    def __init__(self, path):
+        self.path = parse(path)
+
+    def resolve(self, event, value):  # pylint: disable=unused-argument
+        """ Returns a list of all matches of the path in event """
+        return self.path.find_values(event)
+
+
+class _InlineTemplate:
+    """ "some{$.path}value": each template replaced by the first value it matches """
+
+    def __init__(self, template):
+        self.template = template
+        self.tokens = [(match, parse(match.lstrip('{').rstrip('}')))
+                       for match in TEMPLATE_REGEX.findall(template)]
+
+    def resolve(self, event, value):  # pylint: disable=unused-argument
+        """ Returns the template string with each matched path substituted """
+        result = self.template
+        for match, path in self.tokens:
+            match_data = path.find_values(event)
+            if match_data:
+                result = result.replace(match, match_data[0])
+        return result
+
+
+class _Object:
+    """ A dict with at least one templated descendant """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def resolve(self, event, value):
+        """ Returns a copy of value with the templated entries resolved """
+        result = dict(value)
+        for key, node in self.entries:
+            result[key] = node.resolve(event, value[key])
+        return result
+
+
+class _Array:
+    """ A list with at least one templated descendant """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def resolve(self, event, value):
+        """ Returns a copy of value with the templated items resolved """
+        result = list(value)
+        for index, node in self.entries:
+            result[index] = node.resolve(event, value[index])
+        return result
+
+
+def compile_template(template):
+    """
+    * Compiles a single template string (see cumulus_message.resolve_path_str) into a node
+    * whose resolve(event, template) method evaluates it. Its paths come from the JSONPath
+    * cache; the nodes themselves are only kept as part of a cached plan.
+    * @param {string} template The string to compile
+    * @returns {*} the compiled node
+    """
+    if isinstance(template, str) and '{' not in template:
+        return LITERAL
+    if VALUE_REGEX.search(template):
+        return _ValueTemplate(template.lstrip('{').rstrip('}'))
+    if ARRAY_REGEX.search(template):
+        return _ArrayTemplate(template.lstrip('{').rstrip('}').lstrip('[').rstrip(']'))
+    if TEMPLATE_REGEX.search(template):
+        return _InlineTemplate(template)
+    return LITERAL
+
+
+def _compile_node(config):
+    if isinstance(config, str):
+        return compile_template(config)
+
+    if isinstance(config, list):
+        entries = [(index, node) for index, node in
+                   ((index, _compile_node(item)) for index, item in enumerate(config))
+                   if node is not LITERAL]
+        return _Array(entries) if entries else LITERAL
+
+    if isinstance(config, dict):
+        entries = [(key, node) for key, node in
+                   ((key, _compile_node(item)) for key, item in config.items())
+                   if node is not LITERAL]
+        return _Object(entries) if entries else LITERAL
+
+    return LITERAL
+
+
+class ConfigPlan:
+    """
+    The compiled form of a task configuration: the templated task config (without its
+    cumulus_message section) and the cumulus_message.input template, if any.
+
+    Plans only record structure; literal values are always read from the config passed
+    to resolve_config, so a plan is safe to share between messages with equal configs.
+    """
+
+    def __init__(self, config):
+        task_config = config.copy()
+        if 'cumulus_message' in task_config:
+            del task_config['cumulus_message']
+        self.config_node = _compile_node(task_config)
+
+        self.input_node = None
+        if 'cumulus_message' in config and 'input' in config['cumulus_message']:
+            self.input_node = compile_template(config['cumulus_message']['input'])
+
+    def resolve_config(self, event, config):
+        """
+        * Resolves the templates in a task config against an event
+        * @param {*} event The event that paths resolve against
+        * @param {*} config The task config this plan was compiled from (or an equal one)
+        * @returns {*} the task config without cumulus_message and with all paths resolved
+        """
+        task_config = config.copy()
+        if 'cumulus_message' in task_config:
+            del task_config['cumulus_message']
+        return self.config_node.resolve(event, task_config)
+
+    def resolve_input(self, event, config):
+        """
+        * Resolves the task input as defined under config.cumulus_message.input, defaulting
+        * to the event payload
+        * @param {*} event The event that paths resolve against
+        * @param {*} config The task config this plan was compiled from (or an equal one)
+        * @returns {*} the input object for the task
+        """
+        if self.input_node is None:
+            return event.get('payload')
+        return self.input_node.resolve(event, config['cumulus_message']['input'])
+
+
+_plans = LRUCache(size_from_environment('CMA_CONFIG_PLAN_CACHE_SIZE',
+                                        DEFAULT_PLAN_CACHE_SIZE))
+
+
+def _fingerprint(config):
+    try:
+        serialized = json.dumps(config, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def compile_config(config):
+    """
+    * Returns the resolution plan for a task config, reusing a cached plan when an equal
+    * config has been compiled before
+    * @param {*} config The task config
+    * @returns {ConfigPlan} the compiled plan
+    """
+    fingerprint = _fingerprint(config)
+    plan = _plans.get(fingerprint) if fingerprint else None
+    if plan is None:
+        plan = ConfigPlan(config)
+        if fingerprint:
+            _plans.put(fingerprint, plan)
+    return plan
+
+
+def plan_cache_info():
+    """ Returns hit/miss/size statistics for the process-wide plan cache """
+    return _plans.info()
@@ -1,12 +1,14 @@
-import json
-import re
+import contextvars
+import os
 import uuid
 
 from copy import deepcopy
-from datetime import datetime, timedelta
-from jsonpath_ng import parse
+from . import codec, compression, remote_cache, tracing, transfer
 from .aws import s3
-from .error import write_error
+from .config_plan import compile_config, compile_template
+from .jsonpath_cache import parse
+from .log import logger
+from .simple_jsonpath import compile_simple_path
 
 
 def load_config(event):
@@ -16,7 +18,7 @@ def load_config(event):
     * @param {*} context The context object passed to AWS Lambda or containing an activityArn
     * @returns {*} The task's configuration
     """
-    write_error('Starting load_config')
+    logger.debug('Starting load_config')
 
     if 'task_config' in event:
         return event['task_config']
@@ -25,36 +27,79 @@ def load_config(event):
 def load_remote_event(event):
     """
     * Given a Cumulus message, checks for a 'replace' key and fetches a remote stored
-    * object from S3 and inserts it into the configured path
+    * object from S3 and inserts it into the configured path. 'replace' may also hold a
+    * list of pointers, which are fetched concurrently.
     * @param {*} event An event in the Cumulus message format
     * @returns {*} A Cumulus message with the remote message resolved
     """
-    write_error('Starting load_remote_event')
+    logger.debug('Starting load_remote_event')
     if 'replace' in event:
-        local_exception = event.get('exception', None)
-        _s3 = s3()
-        data = _s3.Object(event['replace']['Bucket'],
-                          event['replace']['Key']).get()
-        target_json_path = event['replace']['TargetPath']
+        pointers = remote_pointers(event)
+        with tracing.span('remote.load', pointers=len(pointers)):
+            remote_events = _fetch_remote_events(pointers)
+        apply_remote_events(event, pointers, remote_events)
+    logger.debug('Ending load_remote_event')
+    return event
+
+
+def remote_pointers(event):
+    """
+    * Returns the replace pointers of a Cumulus message as a list
+    * @param {*} event An event in the Cumulus message format
+    * @returns {list} the pointers, empty if the event has no 'replace' key
+    """
+    pointers = event.get('replace', [])
+    return pointers if isinstance(pointers, list) else [pointers]
+
+
+def apply_remote_events(event, pointers, remote_events):
+    """
+    * Inserts loaded remote portions at their pointers' target paths, removes the 'replace'
+    * key and keeps an exception recorded in the local message
+    * @param {*} event An event in the Cumulus message format
+    * @param {list} pointers The event's replace pointers
+    * @param {list} remote_events The decoded remote portion for each pointer
+    * @returns {*} the updated event
+    """
+    local_exception = event.get('exception', None)
+    for pointer, remote_event in zip(pointers, remote_events):
+        target_json_path = pointer['TargetPath']
         parsed_json_path = parse(target_json_path)
-        if data is not None:
-            remote_event = json.loads(data['Body'].read().decode('utf-8'))
-            replacement_targets = parsed_json_path.find(event)
-            if not replacement_targets or len(replacement_targets) != 1:
-                raise ValueError(f'Remote event configuration target {target_json_path} invalid')
-            try:
-                replacement_targets[0].value.update(remote_event)
-            except AttributeError:
-                parsed_json_path.update(event, remote_event)
-
-            event.pop('replace')
-            exception_bool = (local_exception and local_exception != 'None')
-            if exception_bool and (not event['exception'] or event['exception'] == 'None'):
-                event['exception'] = local_exception
-    write_error('Ending load_remote_event')
+        replacement_targets = parsed_json_path.find_values(event)
+        if not replacement_targets or len(replacement_targets) != 1:
+            raise ValueError(f'Remote event configuration target {target_json_path} invalid')
+        try:
+            replacement_targets[0].update(remote_event)
+        except AttributeError:
+            parsed_json_path.update(event, remote_event)
+
+    event.pop('replace')
+    exception_bool = (local_exception and local_exception != 'None')
+    if exception_bool and (not event['exception'] or event['exception'] == 'None'):
+        event['exception'] = local_exception
     return event
 
 
+def _fetch_remote_events(pointers):
+    """ Loads the objects referenced by replace pointers, in parallel when there are several """
+    _s3 = s3()
+
+    def fetch(pointer):
+        return remote_cache.load(_s3.Object(pointer['Bucket'], pointer['Key']),
+                                 pointer.get('Compression'))
+
+    if len(pointers) == 1:
+        return [fetch(pointers[0])]
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    workers = min(len(pointers), int(os.environ.get('CMA_S3_MAX_CONCURRENCY',
+                                                    transfer.DEFAULT_MAX_CONCURRENCY)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Each fetch runs in a copy of this context so its spans join the current trace
+        futures = [executor.submit(contextvars.copy_context().run, fetch, pointer)
+                   for pointer in pointers]
+        return [future.result() for future in futures]
+
+
 # Config templating
 def resolve_path_str(event, json_path_string):
     """
@@ -75,31 +120,10 @@ def resolve_path_str(event, json_path_string):
     * @param {*} json_path_string A string containing a JSONPath template to resolve
     * @returns {*} The resolved object
     """
-    write_error('Starting resolve_path_str')
-
-    value_regex = r"^{[^\[\]].*}$"
-    array_regex = r"^{\[.*\]}$"
-    template_regex = '{[^}]+}'
-
-    if re.search(value_regex, json_path_string):
-        match_data = parse(json_path_string.lstrip('{').rstrip('}')).find(event)
-        return match_data[0].value if match_data else None
-
-    if re.search(array_regex, json_path_string):
-        parsed_json_path = json_path_string.lstrip('{').rstrip('}').lstrip('[').rstrip(']')
-        match_data = parse(parsed_json_path).find(event)
-        return [item.value for item in match_data] if match_data else []
-
-    if re.search(template_regex, json_path_string):
-        matches = re.findall(template_regex, json_path_string)
-        for match in matches:
-            match_data = parse(match.lstrip('{').rstrip('}')).find(event)
-            if match_data:
-                json_path_string = json_path_string.replace(match, match_data[0].value)
-        return json_path_string
-
-    write_error('End resolve_path_str')
-    return json_path_string
+    logger.debug('Starting resolve_path_str')
+    result = compile_template(json_path_string).resolve(event, json_path_string)
+    logger.debug('End resolve_path_str')
+    return result
 
 
 def resolve_input(event, config):
@@ -110,12 +134,10 @@ def resolve_input(event, config):
     * @param {*} config The config object
     * @returns {*} The object to place on the input key of the task's event
     """
-    write_error('Starting resolve_input')
-    if ('cumulus_message' in config and 'input' in config['cumulus_message']):
-        input_path = config['cumulus_message']['input']
-        return resolve_path_str(event, input_path)
-    write_error('End resolve_input')
-    return event.get('payload')
+    logger.debug('Starting resolve_input')
+    result = compile_config(config).resolve_input(event, config)
+    logger.debug('End resolve_input')
+    return result
 
 def resolve_config_templates(event, config):
     """
@@ -126,25 +148,28 @@ def resolve_config_templates(event, config):
     * @param {*} config A config object, containing paths
     * @returns {*} A config object with all JSONPaths resolved
     """
-    write_error('Starting resolve_config_templates')
-    task_config = config.copy()
-    if 'cumulus_message' in task_config:
-        del task_config['cumulus_message']
-    write_error('Ending resolve_config_templates')
-    return _resolve_config_object(event, task_config)
+    logger.debug('Starting resolve_config_templates')
+    result = compile_config(config).resolve_config(event, config)
+    logger.debug('Ending resolve_config_templates')
+    return result
 
 
-def store_remote_response(incoming_event, default_max_size, config_keys):
+def store_remote_response(incoming_event, default_max_size, config_keys, copy_event=True,
+                          store_body=None):
     """
     * Stores part of a response message in S3 if it is too big to send to StepFunctions
     * @param {*} incoming_event    - The response message
     * @param {*} default_max_size  - The maximum size (in bytes) a response message portion
     *                                can be before the method will store it in s3
     * @param {*} config_keys       - A list of valid CMA configuration keys
+    * @param {*} copy_event        - If False, incoming_event is updated in place
+    * @param {*} store_body        - store_body(bucket, body, replace config values) storing
+    *                                an encoded portion and returning its key; defaults to an
+    *                                S3 upload
     * @returns {*} A response message, possibly referencing an S3 object for its contents
     """
-    write_error('Starting store_remote_response')
-    event = deepcopy(incoming_event)
+    logger.debug('Starting store_remote_response')
+    event = deepcopy(incoming_event) if copy_event else incoming_event
     replace_config = event.get('ReplaceConfig', None)
     if not replace_config:
         return event
@@ -153,80 +178,203 @@ def store_remote_response(incoming_event, default_max_size, config_keys):
         replace_config['Path'] = '$'
 
     replace_config_values = _parse_remote_config_from_event(replace_config, default_max_size)
+    replace_config_values['store_body'] = store_body or _store_body
 
     for key in config_keys:
         if event.get(key):
             del event[key]
 
-    cumulus_meta = deepcopy(event['cumulus_meta'])
-    replacement_data = replace_config_values['parsed_json_path'].find(event)
-    if len(replacement_data) != 1:
-        raise ValueError(f'JSON path invalid: {replace_config_values["parsed_json_path"]}')
-    replacement_data = replacement_data[0]
-
-    estimated_data_size = len(json.dumps(replacement_data.value).encode(('utf-8')))
-
-    if estimated_data_size < replace_config_values['max_size']:
+    # Clearing a FullMessage replacement empties the event itself, but not this dict
+    cumulus_meta = event['cumulus_meta']
+    if replace_config_values['max_message_size'] is not None:
+        pointers = _offload_to_budget(event, replace_config_values)
+    else:
+        parsed_json_path = replace_config_values['parsed_json_path']
+        replacement_data = parsed_json_path.find_values(event)
+        if len(replacement_data) != 1:
+            raise ValueError(f'JSON path invalid: {parsed_json_path}')
+        replacement_data = replacement_data[0]
+
+        with tracing.span('serialize') as span:
+            body = codec.dumps(replacement_data)
+            span.set(bytes=len(body))
+        if len(body) < replace_config_values['max_size']:
+            return event
+        pointers = [_offload(event, parsed_json_path, replacement_data, body,
+                             replace_config_values['target_path'], replace_config_values)]
+
+    if not pointers:
         return event
+    event['cumulus_meta'] = event.get('cumulus_meta', cumulus_meta)
+    # A single pointer keeps the dict form older readers understand
+    event['replace'] = pointers[0] if len(pointers) == 1 else pointers
+    logger.debug('store_remote_response')
+    return event
 
-    _s3 = s3()
+
+def _offload(event, parsed_json_path, replacement_data, body, target_path,
+             replace_config_values):
+    # pylint: disable=too-many-arguments
+    """
+    * Stores one encoded message portion, empties it in the event and returns its pointer
+    """
     s3_bucket = event['cumulus_meta']['system_bucket']
-    s3_key = ('/').join(['events', str(uuid.uuid4())])
-    s3_params = {
-        'Expires': datetime.utcnow() + timedelta(days=7),  # Expire in a week
-        'Body': json.dumps(replacement_data.value)
-    }
-    _s3.Object(s3_bucket, s3_key).put(**s3_params)
+    s3_key = replace_config_values['store_body'](s3_bucket, body, replace_config_values)
 
     try:
-        replacement_data.value.clear()
+        replacement_data.clear()
     except AttributeError:
-        replace_config_values['parsed_json_path'].update(event, '')
+        parsed_json_path.update(event, '')
 
-    remote_configuration = {'Bucket': s3_bucket, 'Key': s3_key,
-                            'TargetPath': replace_config_values['target_path']}
-    event['cumulus_meta'] = event.get('cumulus_meta', cumulus_meta)
-    event['replace'] = remote_configuration
-    write_error('store_remote_response')
-    return event
+    return _pointer(s3_bucket, s3_key, target_path, replace_config_values['compression'])
 
-def _resolve_config_object(event, config):
-    """
-    * Recursive helper for resolve_config_templates
-    *
-    * Given a config object containing possible JSONPath-templated values, resolves
-    * all the values in the object using JSONPaths into the provided event.
-    *
-    * @param {*} event The event that paths resolve against
-    * @param {*} config A config object, containing paths
-    * @returns {*} A config object with all JSONPaths resolved
-    """
 
-    if isinstance(config, str):
-        return resolve_path_str(event, config)
+def _pointer(s3_bucket, s3_key, target_path, algorithm):
+    """ Returns the replace pointer to a stored message portion """
+    remote_configuration = {'Bucket': s3_bucket, 'Key': s3_key, 'TargetPath': target_path}
+    if algorithm is not None:
+        remote_configuration['Compression'] = algorithm
+    return remote_configuration
 
-    if isinstance(config, list):
-        for i in range(0, len(config)):  # pylint: disable=consider-using-enumerate
-            config[i] = _resolve_config_object(event, config[i])
-        return config
 
-    if (config is not None and isinstance(config, dict)):
-        result = {}
-        for key in config.keys():
-            result[key] = _resolve_config_object(event, config[key])
-        return result
-
-    return config
+def _offload_candidates(event, paths):
+    """
+    * Returns (parsed path, value, encoded value) for each candidate subtree, largest first.
+    * Without configured paths the candidates are the payload and each meta entry.
+    """
+    if paths is None:
+        paths = ['$.payload'] + [f'$.meta.{key}' for key in event.get('meta') or {}
+                                 if compile_simple_path(f'$.meta.{key}') is not None]
+    candidates = []
+    for path in paths:
+        parsed_json_path = parse(path)
+        values = parsed_json_path.find_values(event)
+        if len(values) > 1:
+            raise ValueError(f'JSON path invalid: {path}')
+        if values:
+            with tracing.span('serialize', path=path) as span:
+                body = codec.dumps(values[0])
+                span.set(bytes=len(body))
+            candidates.append((parsed_json_path, values[0], body))
+    candidates.sort(key=lambda candidate: len(candidate[2]), reverse=True)
+    return candidates
+
+
+def _replace_size(pointers):
+    """ Returns the bytes a 'replace' key holding these pointers adds to an encoded event """
+    # ,"replace": then the pointer, or a list of pointers
+    value_size = sum(len(codec.dumps(pointer)) for pointer in pointers)
+    if len(pointers) > 1:
+        value_size += len(pointers) + 1
+    return len(b',"replace":') + value_size
+
+
+def _offload_to_budget(event, replace_config_values):
+    """
+    * Offloads the largest candidate subtrees until the encoded event fits in the
+    * MaxMessageSize budget. Taking the largest first offloads the fewest subtrees.
+    * @returns {list} the replace pointers for the offloaded subtrees
+    """
+    budget = replace_config_values['max_message_size']
+    # The event is measured without 'replace', which the new pointers (if any) replace
+    existing = event.pop('replace', None)
+    with tracing.span('size.estimate') as span:
+        content_size = len(codec.dumps(event))
+        span.set(bytes=content_size)
+    if existing is not None:
+        event['replace'] = existing
+    existing_size = 0 if existing is None else len(b',"replace":') + len(codec.dumps(existing))
+
+    def size(pointers):
+        return content_size + (_replace_size(pointers) if pointers else existing_size)
+
+    # Keys from object_key all have the same length, so any one sizes a pointer before its
+    # portion is stored
+    sample_key = object_key(b'', replace_config_values)
+    pointers = []
+    for parsed_json_path, value, body in _offload_candidates(
+            event, replace_config_values['paths']):
+        if size(pointers) <= budget:
+            break
+        # Skip subtrees already emptied with an enclosing candidate
+        if not any(found is value for found in parsed_json_path.find_values(event)):
+            continue
+        # Skip subtrees that would save no more than their pointer adds to the message
+        pointer = _pointer(event['cumulus_meta']['system_bucket'], sample_key,
+                           str(parsed_json_path), replace_config_values['compression'])
+        if len(body) - 2 <= size(pointers + [pointer]) - size(pointers):
+            continue
+        pointers.append(_offload(event, parsed_json_path, value, body, str(parsed_json_path),
+                                 replace_config_values))
+        # The emptied subtree is encoded as {}, [] or ""
+        content_size -= len(body) - 2
+    if size(pointers) > budget:
+        logger.warning('Offloading every candidate left the message at %d bytes, '
+                       'over its MaxMessageSize of %d', size(pointers), budget)
+    return pointers
+
+
+def _store_body(s3_bucket, body, replace_config_values):
+    """
+    * Uploads an encoded message portion and returns its key. In content-addressed mode the
+    * key is derived from the body's digest and a recent existing object is reused.
+    """
+    algorithm = replace_config_values['compression']
+    s3_key = object_key(body, replace_config_values)
+    s3_object = s3().Object(s3_bucket, s3_key)
+
+    if replace_config_values['content_addressed']:
+        with tracing.span('s3.head', key=s3_key):
+            existing = transfer.fresh_object(s3_object, replace_config_values['dedup_max_age'])
+        if existing is not None:
+            etag, stored_size = existing
+            remote_cache.put(s3_bucket, s3_key, etag, body, stored_size)
+            tracing.count('s3.put_skipped')
+            return s3_key
+
+    s3_params = transfer.object_arguments(algorithm)
+    if algorithm is not None:
+        with tracing.span('compress', algorithm=algorithm, bytes=len(body)):
+            stored_body = compression.compress(body, algorithm)
+    else:
+        stored_body = body
+    with tracing.span('s3.put', key=s3_key, bytes=len(stored_body)):
+        etag = transfer.upload_body(s3_object, stored_body, s3_params)
+    remote_cache.put(s3_bucket, s3_key, etag, body, len(stored_body))
+    return s3_key
+
+
+def object_key(body, replace_config_values):
+    """
+    * Returns the key an encoded message portion is stored under: its content-addressed key
+    * in ContentAddressed mode, otherwise a random key under events/
+    """
+    if replace_config_values['content_addressed']:
+        return transfer.content_key(body, replace_config_values['compression'])
+    return ('/').join(['events', str(uuid.uuid4())])
 
 
 def _parse_remote_config_from_event(replace_config, default_max_size):
-    source_path = replace_config['Path']
-    target_path = replace_config.get('TargetPath', replace_config['Path'])
+    max_message_size = replace_config.get('MaxMessageSize')
+    if max_message_size is None:
+        source_path = replace_config['Path']
+        target_path = replace_config.get('TargetPath', replace_config['Path'])
+        parsed_json_path = parse(source_path)
+    else:
+        max_message_size = int(max_message_size)
+        target_path = parsed_json_path = None
     default_max_size = replace_config.get('MaxSize', default_max_size)
-    parsed_json_path = parse(source_path)
 
     return {
         'target_path': target_path,
         'max_size': default_max_size,
         'parsed_json_path': parsed_json_path,
+        'max_message_size': max_message_size,
+        'paths': replace_config.get('Paths'),
+        'compression': compression.resolve_algorithm(replace_config.get('Compression')),
+        'content_addressed': replace_config.get(
+            'ContentAddressed',
+            os.environ.get('CMA_REMOTE_CONTENT_ADDRESSED', 'false').lower() == 'true'),
+        'dedup_max_age': int(os.environ.get('CMA_REMOTE_DEDUP_MAX_AGE',
+                                            transfer.DEFAULT_DEDUP_MAX_AGE)),
     }
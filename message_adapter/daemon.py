@@ -0,0 +1,143 @@
+"""
+Long-lived CMA server on a Unix domain socket
+
+serve() binds the socket, then forks worker processes that all accept connections from it.
+Commands from many client processes therefore run on several cores, and each worker keeps
+its schema registry, compiled JSONPaths, config plans, remote cache and S3 connection pool
+warm for every client it serves. Each connection is served on its own thread by a session
+function; the CLI passes its stream session, so a connection speaks the stream protocols
+(line-based, <FRAMED> or <PIPELINED>) exactly as STDIN does.
+
+The parent process only supervises. It replaces workers that exit unexpectedly and, on
+SIGTERM or SIGINT, stops the workers and removes the socket. An error in one connection
+closes that connection and is logged; the worker keeps serving the others.
+
+Settings:
+* CMA_DAEMON_WORKERS: number of worker processes (default: the number of CPUs)
+"""
+import os
+import signal
+import socket
+import threading
+
+from . import log
+
+DEFAULT_BACKLOG = 128
+
+
+def worker_count(configured=None):
+    """ Returns the number of workers to fork: configured, CMA_DAEMON_WORKERS, or the CPUs """
+    configured = configured or os.environ.get('CMA_DAEMON_WORKERS') or os.cpu_count() or 1
+    return max(1, int(configured))
+
+
+def _remove_stale_socket(path):
+    """ Removes a socket file left by a daemon that is no longer running """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f'A CMA daemon is already listening on {path}')
+
+
+def bind(path, backlog=DEFAULT_BACKLOG):
+    """
+    * Creates the listening socket
+    * @param {string} path Filesystem path of the Unix domain socket
+    * @throws RuntimeError if another daemon is already listening on path
+    * @returns {socket.socket} the listening socket
+    """
+    _remove_stale_socket(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(backlog)
+    return listener
+
+
+def _serve_connection(connection, session):
+    with connection:
+        reader = connection.makefile('rb')
+        writer = connection.makefile('wb')
+        try:
+            session(reader, writer)
+        except Exception as exception:  # pylint: disable=broad-except
+            log.logger.error('CMA daemon connection failed: %s: %s',
+                             type(exception).__name__, exception)
+        finally:
+            for stream in (reader, writer):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+            log.flush()
+
+
+def _run_worker(listener, session):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    while True:
+        connection, _ = listener.accept()
+        threading.Thread(target=_serve_connection, args=(connection, session),
+                         daemon=True).start()
+
+
+def _spawn(listener, session):
+    # Buffered log records would otherwise be written by the parent and the child
+    log.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Workers only leave the accept loop on an error; never return into the CLI
+        try:
+            _run_worker(listener, session)
+        finally:
+            log.flush()
+            os._exit(1)  # pylint: disable=protected-access
+    return pid
+
+
+def serve(path, session, workers=None):
+    """
+    * Serves connections on a Unix domain socket until SIGTERM or SIGINT
+    * @param {string} path Filesystem path of the socket
+    * @param {function} session session(reader, writer) serving one connection's binary
+    *                           streams until the client is done
+    * @param {int} workers Number of worker processes; defaults to worker_count()
+    """
+    listener = bind(path)
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for _ in range(worker_count(workers)):
+            children.add(_spawn(listener, session))
+        log.logger.info('CMA daemon listening on %s with %d workers', path, len(children))
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            if not stopping:
+                log.logger.warning('CMA daemon worker %d exited with status %d; replacing it',
+                                   pid, os.waitstatus_to_exitcode(status))
+                children.add(_spawn(listener, session))
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        log.flush()
@@ -1,6 +1,13 @@
-import sys
+import warnings
+
+from .log import logger
+
 
 def write_error(error):
-    """stderr.write wrapper that forces flush on each write"""
-    sys.stderr.write(error + '\n')
-    sys.stderr.flush()
+    """
+    Deprecated: use message_adapter.log.logger. Logs error at ERROR level, which writes it
+    to stderr (with any buffered records) immediately
+    """
+    warnings.warn('write_error is deprecated; use message_adapter.log.logger',
+                  DeprecationWarning, stacklevel=2)
+    logger.error(error)
@@ -0,0 +1,138 @@
+"""
+Lookup of the task a Step Functions activity or Lambda is running for
+
+The lookup reads an execution's history newest first, one page at a time, and stops at
+the first event that answers it, so it usually reads only the first page however long the
+execution is. Only the state names of TaskStateEntered-style events read so far are kept,
+not the events themselves. Names found for a given (execution ARN, activity or Lambda ARN)
+are cached, since a running task looks itself up with the same pair every time.
+
+Settings:
+* CMA_TASK_NAME_CACHE_SIZE: number of resolved task names kept (default 256, 0 disables;
+  a malformed value is ignored with a warning)
+"""
+from .lru import LRUCache, size_from_environment
+
+DEFAULT_CACHE_SIZE = 256
+
+_SCHEDULED_DETAILS = {
+    'LambdaFunctionScheduled': 'lambdaFunctionScheduledEventDetails',
+    'ActivityScheduled': 'activityScheduledEventDetails'
+}
+
+_task_names = LRUCache(size_from_environment('CMA_TASK_NAME_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+
+def execution_arn(state_machine_arn, execution_name):
+    """
+    * Given a state machine arn and execution name, returns the execution's ARN
+    * @param {string} state_machine_arn The ARN of the state machine containing the execution
+    * @param {string} execution_name The name of the execution
+    * @returns {string} The execution's ARN
+    """
+    return (':').join([state_machine_arn.replace(':stateMachine:', ':execution:'),
+                       execution_name])
+
+
+def history_pages(client, arn, page_size=None):
+    """
+    * Yields the events of an execution's history a page at a time, newest first
+    * @param {*} client A boto3 Step Functions client
+    * @param {string} arn The execution ARN
+    * @param {int} page_size The maximum number of events per request, if not the API default
+    * @returns {generator} lists of history events; each page is requested when it is reached
+    """
+    arguments = {'executionArn': arn, 'reverseOrder': True}
+    if page_size:
+        arguments['maxResults'] = page_size
+    while True:
+        response = client.get_execution_history(**arguments)
+        yield response['events']
+        if not response.get('nextToken'):
+            return
+        arguments['nextToken'] = response['nextToken']
+
+
+def _scheduled_resource(step):
+    details = _SCHEDULED_DETAILS.get(step['type'])
+    return step[details]['resource'] if details else None
+
+
+def task_name_from_events(events, arn):
+    """
+    * Given the events of an execution history, returns the most recent task name started
+    * for an Activity or Lambda ARN or, if no ARN is supplied, the most recent task started.
+    *
+    * IMPORTANT! If no ARN is supplied, this assumes that the most recently started task is
+    * the desired one. This WILL BREAK parallel executions, so always supply one if possible.
+    *
+    * @param {iterable} events The history events, newest first; read only as far as needed
+    * @param {string} arn An ARN to an Activity or Lambda to find. See "IMPORTANT!"
+    * @throws LookupError If no matching task is found
+    * @returns {string} The matching task name
+    """
+    entered = {}  # id -> state name, for the state-entered events read so far
+    seen = set()
+    # previousEventIds of matching scheduled events whose event has not been read yet
+    candidates = []
+    for step in events:
+        if arn is None:
+            if step['type'] == 'TaskStateEntered':
+                return step['stateEnteredEventDetails']['name']
+            continue
+        seen.add(step['id'])
+        if 'stateEnteredEventDetails' in step:
+            entered[step['id']] = step['stateEnteredEventDetails']['name']
+        # Find the ARN in the history (the API is awful here). When found, the task is its
+        # previousEventId's (TaskStateEntered) name. Tasks entered by other branches of a
+        # parallel execution are passed over
+        if _scheduled_resource(step) == arn:
+            candidates.append(step['previousEventId'])
+        # Earlier candidates take precedence; a candidate whose event turned out not to
+        # enter a state is passed over
+        while candidates and candidates[0] in seen:
+            previous = candidates.pop(0)
+            if previous in entered:
+                return entered[previous]
+    raise LookupError(f'No task found for {arn}')
+
+
+def lookup_task_name(arn_of_execution, arn, pages=None):
+    """
+    * Returns the task an Activity or Lambda is running for in an execution, reading the
+    * execution's history only as far as needed. Names found for an ARN are cached; the
+    * most recent task, looked up without an ARN, changes as the execution runs and is not.
+    * @param {string} arn_of_execution The execution ARN
+    * @param {string} arn An ARN to an Activity or Lambda, or None for the most recent task
+    * @param {iterable} pages The history as pages of events, newest first; defaults to
+    *                         history_pages() from the Step Functions API
+    * @throws LookupError If no matching task is found
+    * @returns {string} The matching task name
+    """
+    key = (arn_of_execution, arn)
+    if arn is not None:
+        name = _task_names.get(key)
+        if name is not None:
+            return name
+    if pages is None:
+        from .aws import stepfunctions  # pylint: disable=import-outside-toplevel
+        pages = history_pages(stepfunctions(), arn_of_execution)
+    name = task_name_from_events((step for page in pages for step in page), arn)
+    if arn is not None:
+        _task_names.put(key, name)
+    return name
+
+
+def configure_cache(max_size):
+    """ Resizes the task name cache. A max_size of 0 disables caching """
+    _task_names.resize(max_size)
+
+
+def clear_cache():
+    """ Empties the task name cache """
+    _task_names.clear()
+
+
+def cache_info():
+    """ Returns hit/miss/size statistics for the task name cache """
+    return _task_names.info()
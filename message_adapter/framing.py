@@ -0,0 +1,133 @@
+"""
+Length-prefixed framing for the CMA stream interface
+
+A client opts in by sending the handshake line "<FRAMED>" as the first line of a stream
+session; the CMA acknowledges with the same line. Each request is then a header line
+"<command> <length>" followed by exactly <length> bytes of UTF-8 JSON, and each response
+is a header line "<length>" followed by that many bytes. "<EXIT>" (or end of input) ends
+the session.
+
+The pipelined variant is negotiated with "<PIPELINED>" instead. Request headers are then
+"<id> <command> <length>" and response headers "<id> <status> <length>", where status is
+OK or ERROR and responses may arrive in any order.
+"""
+from .ingest import IncrementalParser, check_size
+
+HANDSHAKE = b'<FRAMED>'
+PIPELINED_HANDSHAKE = b'<PIPELINED>'
+EXIT = b'<EXIT>'
+MAX_HEADER_LENGTH = 1024
+
+
+class FramingError(ValueError):
+    """ Raised when a framed request is malformed or truncated """
+
+
+def read_exact(reader, length):
+    """
+    * Reads exactly length bytes from a binary reader
+    * @param {*} reader Binary file-like object
+    * @param {int} length Number of bytes to read
+    * @throws FramingError if input ends first
+    * @returns {bytearray} the bytes read, in a buffer ingest.load can release
+    """
+    body = bytearray(length)
+    view = memoryview(body)
+    filled = 0
+    while filled < length:
+        count = reader.readinto(view[filled:])
+        if not count:
+            view.release()
+            raise FramingError(f'Expected {length} bytes, input ended after {filled}')
+        filled += count
+    view.release()
+    return body
+
+
+def read_header(reader):
+    """
+    * Reads one header line and splits it into fields
+    * @param {*} reader Binary file-like object
+    * @returns {list|None} the header fields (as str), or None on <EXIT> or end of input
+    """
+    line = reader.readline(MAX_HEADER_LENGTH)
+    if not line or line.rstrip(b'\r\n') == EXIT:
+        return None
+    if not line.endswith(b'\n'):
+        raise FramingError(f'Header line exceeds {MAX_HEADER_LENGTH} bytes')
+    return line.decode('utf-8').split()
+
+
+def parse_length(value):
+    """ Parses a frame length field """
+    try:
+        length = int(value)
+    except ValueError as exception:
+        raise FramingError(f'Invalid frame length {value!r}') from exception
+    if length < 0:
+        raise FramingError(f'Invalid frame length {value!r}')
+    return length
+
+
+def read_request(reader, max_length=None, incremental=False):
+    """
+    * Reads one framed request
+    * @param {*} reader Binary file-like object
+    * @param {int|None} max_length The largest body accepted, or None for no limit
+    * @param {boolean} incremental If True, the body is left on the reader and returned as an
+    *                              IncrementalParser that reads it; it must be parsed before
+    *                              the next request is read
+    * @throws InputTooLarge if the header declares a longer body, before it is read
+    * @returns {tuple|None} (command, body bytes or parser), or None when the session ends
+    """
+    header = read_header(reader)
+    if header is None:
+        return None
+    if len(header) != 2:
+        raise FramingError(f'Expected "<command> <length>" header, got {header!r}')
+    command, length = header
+    length = parse_length(length)
+    check_size(length, max_length)
+    if incremental:
+        return command, IncrementalParser(reader, length=length)
+    return command, read_exact(reader, length)
+
+
+def read_pipelined_header(reader):
+    """
+    * Reads one pipelined request header; the body is left on the reader
+    * @param {*} reader Binary file-like object
+    * @returns {tuple|None} (request id, command, body length), or None when the session ends
+    """
+    header = read_header(reader)
+    if header is None:
+        return None
+    if len(header) != 3:
+        raise FramingError(f'Expected "<id> <command> <length>" header, got {header!r}')
+    request_id, command, length = header
+    return request_id, command, parse_length(length)
+
+
+def write_tagged_response(writer, request_id, status, body):
+    """
+    * Writes one pipelined response and flushes it. Callers writing from several threads
+    * must serialize calls.
+    * @param {*} writer Binary file-like object
+    * @param {string} request_id The id of the request being answered
+    * @param {string} status OK or ERROR
+    * @param {bytes} body Encoded response body
+    """
+    writer.write(f'{request_id} {status} {len(body)}\n'.encode('utf-8'))
+    writer.write(body)
+    writer.flush()
+
+
+def write_response(writer, body):
+    """
+    * Writes one framed response and flushes it
+    * @param {*} writer Binary file-like object
+    * @param {bytes} body Encoded response body
+    """
+    writer.write(b'%d\n' % len(body))
+    writer.write(body)
+    writer.flush()
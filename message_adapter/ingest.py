@@ -0,0 +1,292 @@
+"""
+Bounded reading and parsing of CLI input
+
+By default request bodies are read from the binary input in chunks into one growing
+bytearray and decoded straight from it, instead of being assembled from lines with a join
+that briefly holds two copies. The raw buffer is cleared as soon as the event tree is
+built, so while a command runs only the parsed event is held.
+
+With CMA_INPUT_PARSER=incremental, single commands and framed stream requests are instead
+parsed by IncrementalParser as they are read, so the raw message is never held whole: peak
+memory while reading is the event tree plus one chunk of input. It is pure Python and so
+several times slower than the default (orjson) decoding; it suits messages whose raw size,
+not decoding time, is the constraint. Line-based and pipelined stream requests are always
+buffered, since their bodies must be read in full to find where they end or to be handed to
+a worker.
+
+CMA_MAX_INPUT_BYTES sets a hard limit on the size of one request body (default 0, no
+limit). Input is checked as it is read, and framed bodies are checked against their
+declared length before any of it is read, so an oversized message fails with InputTooLarge
+without being buffered.
+"""
+import codecs
+import os
+import re
+
+from json.decoder import WHITESPACE, scanstring
+from json.scanner import NUMBER_RE
+
+from . import codec
+
+CHUNK_SIZE = 1024 * 1024
+PARSERS = ('buffered', 'incremental')
+_LITERALS = {'null': None, 'true': True, 'false': False, 'NaN': float('nan'),
+             'Infinity': float('inf'), '-Infinity': float('-inf')}
+_LITERAL_STARTS = {'n': 'null', 't': 'true', 'f': 'false', 'N': 'NaN', 'I': 'Infinity'}
+_NUMBER_END = re.compile(r'[^0-9eE.+-]')
+
+
+class InputTooLarge(ValueError):
+    """ Raised when a request body exceeds CMA_MAX_INPUT_BYTES """
+
+
+def max_input_bytes():
+    """ Returns the CMA_MAX_INPUT_BYTES limit, or None when input size is not limited """
+    limit = int(os.environ.get('CMA_MAX_INPUT_BYTES', 0))
+    return limit if limit > 0 else None
+
+
+def incremental():
+    """ Returns True if CMA_INPUT_PARSER selects the incremental parser """
+    parser = os.environ.get('CMA_INPUT_PARSER', 'buffered').lower()
+    if parser not in PARSERS:
+        raise ValueError(f'Unknown CMA_INPUT_PARSER {parser!r}, expected one of {PARSERS}')
+    return parser == 'incremental'
+
+
+def check_size(size, limit):
+    """
+    * Checks the size of a request body against a limit
+    * @param {int} size The body size, or the size read so far
+    * @param {int|None} limit The maximum body size, or None for no limit
+    * @throws InputTooLarge if size is over limit
+    """
+    if limit is not None and size > limit:
+        raise InputTooLarge(f'Input of at least {size} bytes exceeds the CMA_MAX_INPUT_BYTES '
+                            f'limit of {limit} bytes')
+
+
+def read_line(reader, limit=None, buffer=None):
+    """
+    * Reads one line (through its newline, or to end of input) in chunks
+    * @param {*} reader Binary file-like object
+    * @param {int|None} limit The maximum size of the line, without its newline
+    * @param {bytearray} buffer A buffer to append the line to, e.g. the earlier lines of
+    *                           the same request body
+    * @throws InputTooLarge as soon as buffer grows beyond limit
+    * @returns {bytearray} buffer, with the line appended
+    """
+    buffer = bytearray() if buffer is None else buffer
+    while True:
+        chunk = reader.readline(CHUNK_SIZE)
+        buffer += chunk
+        check_size(len(buffer) - buffer.endswith(b'\n'), limit)
+        if not chunk or chunk.endswith(b'\n'):
+            return buffer
+
+
+def skip(reader, length):
+    """ Reads and discards length bytes, a chunk at a time """
+    while length > 0:
+        chunk = reader.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+
+
+class IncrementalParser:
+    """
+    Builds a JSON document from a binary reader a chunk at a time. Strings are decoded with
+    the json module's C scanner; containers are built on an explicit stack, so nesting depth
+    is not limited by recursion. Decoding matches the stdlib json module.
+    """
+
+    def __init__(self, reader, limit=None, length=None):
+        """
+        * @param {*} reader Binary file-like object
+        * @param {int|None} limit The maximum number of bytes read (CMA_MAX_INPUT_BYTES)
+        * @param {int|None} length The exact length of the body (framed requests); without
+        *                         one the document is read line by line and ends with the
+        *                         line it closes on, as a single command's input does
+        """
+        self._reader = reader  # None once input has ended
+        self._limit = limit
+        self._remaining = length
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._pos = 0
+        self.size = 0
+
+    def __len__(self):
+        """ The body length if known, otherwise the number of bytes read so far """
+        return self.size + (self._remaining or 0)
+
+    def _fill(self):
+        """ Appends the next chunk of input to the text; returns it, or None at end of input """
+        if self._reader is None:
+            return None
+        if self._remaining is None:
+            chunk = self._reader.readline(CHUNK_SIZE)
+        else:
+            chunk = self._reader.read(min(CHUNK_SIZE, self._remaining))
+            self._remaining -= len(chunk)
+        self.size += len(chunk)
+        check_size(self.size, self._limit)
+        final = not chunk or self._remaining == 0
+        if final:
+            self._reader = None
+        text = self._decoder.decode(chunk, final=final)
+        # Drop what has been parsed so only the unparsed tail and the new chunk are held
+        self._text = self._text[self._pos:] + text
+        self._pos = 0
+        return text
+
+    def _error(self, message):
+        unparsed = len(self._text[self._pos:].encode('utf-8'))
+        return ValueError(f'{message}: input byte {self.size - unparsed}')
+
+    def _ensure(self, count):
+        """ Reads until count characters follow the current position, or input ends """
+        while len(self._text) - self._pos < count and self._fill() is not None:
+            pass
+
+    def _next(self):
+        """ Skips whitespace and returns the next character, or '' at end of input """
+        while True:
+            self._pos = WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if self._fill() is None:
+                return ''
+
+    def _string(self):
+        while True:
+            try:
+                value, self._pos = scanstring(self._text, self._pos + 1, True)
+                return value
+            except ValueError:
+                if self._reader is None:
+                    raise
+            # The string continues in later chunks; rescan once its closing quote may be read
+            while True:
+                text = self._fill()
+                if text is None or '"' in text:
+                    break
+
+    def _number(self):
+        # A number may continue into the next chunk until a character that ends it is read
+        while _NUMBER_END.search(self._text, self._pos) is None and self._fill() is not None:
+            pass
+        match = NUMBER_RE.match(self._text, self._pos)
+        if match is None:
+            raise self._error('Expecting value')
+        integer, fraction, exponent = match.groups()
+        self._pos = match.end()
+        if fraction or exponent:
+            return float(integer + (fraction or '') + (exponent or ''))
+        return int(integer)
+
+    def _literal(self, word):
+        self._ensure(len(word))
+        if not self._text.startswith(word, self._pos):
+            raise self._error('Expecting value')
+        self._pos += len(word)
+        return _LITERALS[word]
+
+    def _scalar(self, char):
+        if char == '"':
+            return self._string()
+        if char == '-':
+            self._ensure(len('-Infinity'))
+            if self._text.startswith('-Infinity', self._pos):
+                return self._literal('-Infinity')
+        if char and char in '-0123456789':
+            return self._number()
+        if char in _LITERAL_STARTS:
+            return self._literal(_LITERAL_STARTS[char])
+        raise self._error('Expecting value' if char else 'Unexpected end of input')
+
+    def _key(self):
+        if self._next() != '"':
+            raise self._error('Expecting property name enclosed in double quotes')
+        key = self._string()
+        if self._next() != ':':
+            raise self._error("Expecting ':' delimiter")
+        self._pos += 1
+        return key
+
+    def _value(self):
+        containers = []
+        keys = []  # the key being read in each open object; None for arrays
+        while True:
+            char = self._next()
+            if char in ('{', '['):
+                self._pos += 1
+                closing = '}' if char == '{' else ']'
+                if self._next() == closing:
+                    self._pos += 1
+                    value = {} if char == '{' else []
+                else:
+                    containers.append({} if char == '{' else [])
+                    keys.append(self._key() if char == '{' else None)
+                    continue
+            else:
+                value = self._scalar(char)
+            # Add the value to its container, closing every container it completes
+            while containers:
+                container = containers[-1]
+                if keys[-1] is None:
+                    container.append(value)
+                else:
+                    container[keys[-1]] = value
+                char = self._next()
+                self._pos += 1
+                if char == ',':
+                    if keys[-1] is not None:
+                        keys[-1] = self._key()
+                    break
+                if char != (']' if keys[-1] is None else '}'):
+                    self._pos -= 1
+                    raise self._error("Expecting ',' delimiter" if char else
+                                      'Unexpected end of input')
+                containers.pop()
+                keys.pop()
+                value = container
+            else:
+                return value
+
+    def parse(self):
+        """
+        * Reads and decodes the document
+        * @throws InputTooLarge as soon as more than limit bytes have been read
+        * @throws ValueError if the input is not one JSON document
+        * @returns {*} the decoded document
+        """
+        document = self._value()
+        if self._remaining is None:
+            # Only the rest of the line the document ends on belongs to it
+            while '\n' not in self._text[self._pos:] and self._fill() is not None:
+                pass
+            trailing = self._text[self._pos:].split('\n', 1)[0]
+        else:
+            trailing = self._next()
+        if trailing.strip(' \t\r'):
+            raise self._error('Extra data')
+        self._text = ''
+        return document
+
+
+def load(body):
+    """
+    * Decodes a request body, clearing it afterwards if it is a bytearray so the raw copy
+    * is released while the event is in use, even if the caller still references it
+    * @param {bytes|bytearray|IncrementalParser} body The encoded JSON, or a parser reading it
+    * @returns {*} the decoded document
+    """
+    if isinstance(body, IncrementalParser):
+        return body.parse()
+    try:
+        return codec.loads(body)
+    finally:
+        if isinstance(body, bytearray):
+            body.clear()
@@ -0,0 +1,114 @@
+""" Process-wide cache of compiled JSONPath expressions """
+import threading
+
+from .lru import LRUCache, size_from_environment
+from .simple_jsonpath import UnsupportedValue, compile_simple_path
+
+DEFAULT_MAX_SIZE = 1024
+
+# jsonpath_ng builds a PLY parser per call; keep concurrent callers from racing on it
+_parse_lock = threading.Lock()
+
+
+def _parse_jsonpath(path):
+    # jsonpath_ng is only needed for paths outside the simple subset, so load it on demand
+    from jsonpath_ng import parse as parse_jsonpath  # pylint: disable=import-outside-toplevel
+    with _parse_lock:
+        return parse_jsonpath(path)
+
+
+class CompiledJsonPath:
+    """
+    A compiled JSONPath. Paths in the simple subset (dotted keys, integer indices and [*])
+    are evaluated natively; everything else, and any document the native evaluator cannot
+    handle identically, goes through jsonpath_ng.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.simple = compile_simple_path(path)
+        self._expression = None if self.simple else _parse_jsonpath(path)
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def expression(self):
+        """ The jsonpath_ng expression for this path, parsed on first use """
+        if self._expression is None:
+            self._expression = _parse_jsonpath(self.path)
+        return self._expression
+
+    def find_values(self, data):
+        """
+        * Returns the values in data matched by this path
+        * @param {*} data The document to search
+        * @returns {list} the matched values, in jsonpath_ng match order
+        """
+        if self.simple is not None:
+            try:
+                return self.simple.find_values(data)
+            except UnsupportedValue:
+                pass
+        return [match.value for match in self.expression.find(data)]
+
+    def update(self, data, value):
+        """
+        * Replaces the existing values in data matched by this path with value
+        * @param {*} data The document to update in place
+        * @param {*} value The value to set
+        * @returns {*} the updated document, as returned by jsonpath_ng's update
+        """
+        if self.simple is not None:
+            try:
+                return self.simple.update(data, value)
+            except UnsupportedValue:
+                pass
+        return self.expression.update(data, value)
+
+
+class JsonPathCache(LRUCache):
+    """
+    Bounded, thread-safe LRU cache of compiled JSONPath expressions
+
+    A max_size of 0 disables caching; every lookup then compiles the path.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(max_size)
+
+    def parse(self, path):
+        """
+        * Returns the compiled JSONPath expression for a path string, compiling and
+        * caching it if it has not been seen before
+        * @param {string} path JSONPath string
+        * @returns {CompiledJsonPath} the compiled expression
+        """
+        expression = self.get(path)
+        if expression is None:
+            expression = CompiledJsonPath(path)
+            self.put(path, expression)
+        return expression
+
+
+_cache = JsonPathCache(size_from_environment('CMA_JSONPATH_CACHE_SIZE', DEFAULT_MAX_SIZE))
+
+
+def parse(path):
+    """ Compiles a JSONPath string using the process-wide cache """
+    return _cache.parse(path)
+
+
+def configure_cache(max_size):
+    """ Resizes the process-wide cache. A max_size of 0 disables caching """
+    _cache.resize(max_size)
+
+
+def clear_cache():
+    """ Empties the process-wide cache """
+    _cache.clear()
+
+
+def cache_info():
+    """ Returns hit/miss/size statistics for the process-wide cache """
+    return _cache.info()
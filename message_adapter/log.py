@@ -0,0 +1,102 @@
+"""
+Leveled, buffered diagnostics for the CMA
+
+Messages go through the 'cumulus_message_adapter' stdlib logger. Its level is set with
+CMA_LOG_LEVEL (default WARNING, which drops the per-step "Starting ..." chatter; DEBUG
+restores it). Records are held in memory and written to stderr in one batch when
+CMA_LOG_BUFFER records (default 100) have accumulated, when a record at ERROR or above
+arrives, and whenever flush() is called. The CLI flushes after every command and before it
+exits, and flush() is also registered with atexit.
+"""
+import atexit
+import logging
+import os
+import sys
+
+LOGGER_NAME = 'cumulus_message_adapter'
+DEFAULT_LEVEL = 'WARNING'
+DEFAULT_BUFFER = 100
+
+logger = logging.getLogger(LOGGER_NAME)
+logger.propagate = False
+
+
+class BufferedStreamHandler(logging.Handler):
+    """
+    Holds formatted records and writes them to a stream with one write and flush per batch.
+    logging.handlers.MemoryHandler does the same but costs more to import than the CMA
+    itself (it loads socket, pickle and queue).
+    """
+
+    def __init__(self, stream, capacity, flush_level=logging.ERROR):
+        super().__init__()
+        self.stream = stream
+        self.capacity = capacity
+        self.flush_level = flush_level
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.capacity or record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write('\n'.join(self.buffer) + '\n')
+                self.buffer = []
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+def flush():
+    """ Writes out any buffered records """
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def configure(level=None, buffer=None, stream=None):
+    """
+    * (Re)configures the CMA logger, flushing records buffered under the old configuration
+    * @param {string} level A logging level name; defaults to CMA_LOG_LEVEL
+    * @param {int} buffer Number of records held before they are written; defaults to
+    *                     CMA_LOG_BUFFER. 1 (or 0) writes each record as it is logged.
+    * @param {*} stream The text stream records are written to; defaults to sys.stderr
+    """
+    flush()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    # The logger is configured at import time, so malformed settings fall back to the
+    # defaults with a warning instead of making the import fail
+    ignored = []
+    if not level:
+        level = os.environ.get('CMA_LOG_LEVEL', DEFAULT_LEVEL)
+        if not isinstance(logging.getLevelName(level.upper()), int):
+            ignored.append(('CMA_LOG_LEVEL', level, 'a logging level', DEFAULT_LEVEL))
+            level = DEFAULT_LEVEL
+    if buffer is None:
+        buffer = os.environ.get('CMA_LOG_BUFFER', DEFAULT_BUFFER)
+        try:
+            buffer = int(buffer)
+        except ValueError:
+            ignored.append(('CMA_LOG_BUFFER', buffer, 'an integer', DEFAULT_BUFFER))
+            buffer = DEFAULT_BUFFER
+    handler = BufferedStreamHandler(sys.stderr if stream is None else stream, max(1, buffer))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.setLevel(str(level).upper())
+    logger.addHandler(handler)
+    for name, value, expected, default in ignored:
+        logger.warning('Ignoring %s=%r, which is not %s; using %s', name, value, expected,
+                       default)
+
+
+configure()
+atexit.register(flush)
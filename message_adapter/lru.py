@@ -0,0 +1,102 @@
+""" Small thread-safe LRU cache shared by the CMA's process-wide caches """
+import os
+import threading
+
+from collections import OrderedDict
+
+from .log import logger
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe least-recently-used cache with hit/miss counters
+
+    A max_size of 0 disables caching; every lookup is then a miss and nothing is stored.
+    If weigh is given, max_size bounds the total weigh(value) of the entries instead of
+    their number, and a value heavier than max_size is not stored.
+    """
+
+    def __init__(self, max_size, weigh=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_size = max(0, int(max_size))
+        self._weigh = weigh
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_weight(self, value):
+        return self._weigh(value) if self._weigh is not None else 1
+
+    def _evict(self):
+        """ Drops least recently used entries until the cache is within max_size """
+        while self._entries and self._weight > self._max_size:
+            _, value = self._entries.popitem(last=False)
+            self._weight -= self._entry_weight(value)
+
+    def get(self, key, default=None):
+        """ Returns the cached value for key (marking it recently used), or default """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """ Stores value under key, evicting the least recently used entries if full """
+        with self._lock:
+            weight = self._entry_weight(value)
+            if key in self._entries:
+                self._weight -= self._entry_weight(self._entries.pop(key))
+            if weight > self._max_size:
+                return
+            self._entries[key] = value
+            self._weight += weight
+            self._evict()
+
+    def resize(self, max_size):
+        """ Sets the maximum number of entries, evicting as needed. 0 disables the cache """
+        with self._lock:
+            self._max_size = max(0, int(max_size))
+            self._evict()
+
+    def clear(self):
+        """ Drops all entries and resets the counters """
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """ Returns a dict of cache statistics """
+        with self._lock:
+            info = {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'max_size': self._max_size}
+            if self._weigh is not None:
+                info['weight'] = self._weight
+            return info
+
+
+def size_from_environment(name, default):
+    """
+    * Reads a cache size setting. Caches are created at import time, so a malformed value
+    * falls back to the default with a warning instead of making the import fail.
+    * @param {string} name The environment variable, e.g. CMA_JSONPATH_CACHE_SIZE
+    * @param {int} default The size to use if the variable is unset or invalid
+    * @returns {int} the cache size
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size < 0:
+        logger.warning('Ignoring %s=%r, which is not a non-negative integer; using %d',
+                       name, value, default)
+        return default
+    return size
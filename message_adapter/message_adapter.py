@@ -1,24 +1,35 @@
 import os
-import json
 
 from copy import deepcopy
-from jsonschema import validate
 
-from .util import assign_json_path_value
-from .cumulus_message import (resolve_config_templates, resolve_input,
-                              resolve_path_str, load_config, load_remote_event,
+from . import tracing
+from .config_plan import compile_config
+from .schemas import registry as schema_registry
+from .util import assign_json_path_values
+from .cumulus_message import (resolve_path_str, load_config, load_remote_event,
                               store_remote_response)
 
 
+def _check_batch_length(name, values, events):
+    if len(values) != len(events):
+        raise ValueError(f'Batch has {len(values)} {name} for {len(events)} events')
+
+
 class MessageAdapter:
     """
     transforms the cumulus message
+
+    By default, events and handler responses passed in are never modified; they are
+    deep-copied before being updated. Callers that hand over ownership of their inputs
+    (and will not use them again) can set owns_events to skip those copies, which keeps
+    a single copy of a large message in memory instead of several.
     """
     REMOTE_DEFAULT_MAX_SIZE = 0
     CMA_CONFIG_KEYS = ['ReplaceConfig', 'task_config']
 
-    def __init__(self, schemas=None):
+    def __init__(self, schemas=None, owns_events=False):
         self.schemas = schemas
+        self.owns_events = owns_events
 
     ##################################
     #  Input message interpretation  #
@@ -43,15 +54,35 @@ class MessageAdapter:
         * @param {*} event The input Lambda event in the Cumulus message protocol
         * @returns {*} the full event data
         """
-        event = deepcopy(incoming_event)
+        event = incoming_event if self.owns_events else deepcopy(incoming_event)
+        target = self.remote_event_target(event)
+        remote_pointer = target.get('replace') if target else None
+        load_remote_event(target)
+        return self.update_loaded_event(event, target, remote_pointer, context)
 
-        if incoming_event.get('cma'):
-            cma_event = deepcopy(incoming_event)
-            event = load_remote_event(event['cma'].get('event'))
-            cma_event['cma']['event'].update(event)
-            event = self.__parse_parameter_configuration(cma_event)
-        else:
-            event = load_remote_event(event)
+    @staticmethod
+    def remote_event_target(event):
+        """
+        * Returns the part of an input event whose remote pointers are loaded: the nested
+        * event of a parameterized ('cma') event, otherwise the event itself
+        """
+        return event['cma'].get('event') if event.get('cma') else event
+
+    def update_loaded_event(self, event, target, remote_pointer, context):
+        """
+        * Completes load_and_update_remote_event once the target's remote data is loaded
+        * @param {*} event The (copied) input event
+        * @param {*} target The event's remote_event_target, now loaded
+        * @param {*} remote_pointer The target's 'replace' value before it was loaded
+        * @param {*} context The Lambda context, or None
+        * @returns {*} the full event data
+        """
+        if event.get('cma'):
+            # load_remote_event updates the nested event in place, but the parameterized
+            # event keeps its remote pointer unless the remote event supplied its own
+            if remote_pointer is not None and 'replace' not in target:
+                target['replace'] = remote_pointer
+            event = self.__parse_parameter_configuration(event)
 
         if context and 'meta' in event:
             task_meta = {}
@@ -71,22 +102,21 @@ class MessageAdapter:
         root_dir = os.environ.get("LAMBDA_TASK_ROOT", '')
         has_schema = schemas and schemas.get(schema_type)
         rel_filepath = schemas.get(schema_type) if has_schema else f'schemas/{schema_type}.json'
-        filepath = os.path.join(root_dir, rel_filepath)
-        return filepath if os.path.exists(filepath) else None
+        return os.path.join(root_dir, rel_filepath)
 
     def __validate_json(self, document, schema_type):
         """
         check that json is valid based on a schema
         """
         schema_filepath = self.__get_jsonschema(schema_type)
-        if schema_filepath:
-            with open(schema_filepath, encoding='utf-8') as schema_handle:
-                schema = json.load(schema_handle)
-                try:
-                    validate(document, schema)
-                except Exception as exception:
-                    exception.message = f'{schema_type} schema: {str(exception)}'
-                    raise exception
+        try:
+            with tracing.span('schema.validate', schema=schema_type):
+                validator = schema_registry.get(schema_filepath)
+                if validator:
+                    validator.validate(document)
+        except Exception as exception:
+            exception.message = f'{schema_type} schema: {str(exception)}'
+            raise exception
 
     def load_nested_event(self, event):
         """
@@ -96,8 +126,11 @@ class MessageAdapter:
         * @returns {*} message that is ready to pass to an inner task
         """
         config = load_config(event)
-        final_config = resolve_config_templates(event, config)
-        final_payload = resolve_input(event, config)
+        plan = compile_config(config)
+        with tracing.span('config.resolve'):
+            final_config = plan.resolve_config(event, config)
+        with tracing.span('input.resolve'):
+            final_payload = plan.resolve_input(event, config)
         response = {'input': final_payload}
         self.__validate_json(final_payload, 'input')
         if final_config:
@@ -127,8 +160,7 @@ class MessageAdapter:
 
         return response
 
-    @staticmethod
-    def __assign_outputs(handler_response, event, message_config):
+    def __assign_outputs(self, handler_response, event, message_config):
         """
         * Applies a task's return value to an output message as defined in config.cumulus_message
         *
@@ -137,35 +169,81 @@ class MessageAdapter:
         * @param {*} messageConfig The cumulus_message configuration
         * @returns {*} The output message with the nested response applied
         """
-        result = deepcopy(event)
+        result = event if self.owns_events else deepcopy(event)
         if message_config is not None and 'outputs' in message_config:
             outputs = message_config['outputs']
             result['payload'] = {}
-            for output in outputs:
-                source_path = output['source']
-                dest_path = output['destination']
-                dest_json_path = dest_path.lstrip('{').rstrip('}')
-                value = resolve_path_str(handler_response, source_path)
-                result = assign_json_path_value(result, dest_json_path, value)
+            # Every source is resolved before anything is assigned, so each one reads the
+            # handler response as the task returned it
+            assignments = [(output['destination'].lstrip('{').rstrip('}'),
+                            resolve_path_str(handler_response, output['source']))
+                           for output in outputs]
+            result = assign_json_path_values(result, assignments, copy=False)
         else:
             result['payload'] = handler_response
 
         return result
 
-    def create_next_event(self, handler_response, event, message_config):
+    def create_next_event(self, handler_response, event, message_config, store_body=None):
         """
         * Creates the output message returned by a task
         *
         * @param {*} handler_response The response returned by the inner task code
         * @param {*} event The input message sent to the Lambda
         * @param {*} message_config The cumulus_message object configured for the task
+        * @param {function} store_body Stores offloaded portions; see store_remote_response
         * @returns {*} the output message to be returned
         """
         self.__validate_json(handler_response, 'output')
 
-        result = self.__assign_outputs(handler_response, event, message_config)
+        with tracing.span('outputs.assign'):
+            result = self.__assign_outputs(handler_response, event, message_config)
         if not result.get('exception'):
             result['exception'] = 'None'
         if 'replace' in result:
             del result['replace']
-        return store_remote_response(result, self.REMOTE_DEFAULT_MAX_SIZE, self.CMA_CONFIG_KEYS)
+        return store_remote_response(result, self.REMOTE_DEFAULT_MAX_SIZE, self.CMA_CONFIG_KEYS,
+                                     copy_event=not self.owns_events, store_body=store_body)
+
+    ##################################
+    #  Batches of messages           #
+    ##################################
+
+    def load_and_update_remote_events(self, events, contexts=None):
+        """
+        * Runs load_and_update_remote_event on every event of a batch, concurrently
+        *
+        * @param {list} events The input Lambda events
+        * @param {list} contexts A context per event, or None
+        * @returns {list} a {'result'} or {'error', 'message'} record per event
+        """
+        from .batch import run_batch  # pylint: disable=import-outside-toplevel
+        contexts = [None] * len(events) if contexts is None else contexts
+        _check_batch_length('contexts', contexts, events)
+        return run_batch(self.load_and_update_remote_event, zip(events, contexts))
+
+    def load_nested_events(self, events):
+        """
+        * Runs load_nested_event on every event of a batch, concurrently
+        *
+        * @param {list} events The full Cumulus messages
+        * @returns {list} a {'result'} or {'error', 'message'} record per event
+        """
+        from .batch import run_batch  # pylint: disable=import-outside-toplevel
+        return run_batch(self.load_nested_event, ((event,) for event in events))
+
+    def create_next_events(self, handler_responses, events, message_configs=None):
+        """
+        * Runs create_next_event on every (handler response, event) pair of a batch,
+        * concurrently, so remote offloads are uploaded in parallel
+        *
+        * @param {list} handler_responses The responses returned by the inner task code
+        * @param {list} events The input messages, one per handler response
+        * @param {list} message_configs A cumulus_message configuration per event, or None
+        * @returns {list} a {'result'} or {'error', 'message'} record per event
+        """
+        from .batch import run_batch  # pylint: disable=import-outside-toplevel
+        message_configs = [None] * len(events) if message_configs is None else message_configs
+        _check_batch_length('handler responses', handler_responses, events)
+        _check_batch_length('message configs', message_configs, events)
+        return run_batch(self.create_next_event, zip(handler_responses, events, message_configs))
@@ -0,0 +1,133 @@
+"""
+Pipelined, concurrent request handling for the framed stream protocol
+
+Requests are read in order from a binary reader and run on a bounded thread pool, so a
+command waiting on S3 does not block the commands queued behind it. Responses are tagged
+with their request id and written as each command finishes. Reading stops (and so the
+client's writes block) while the in-flight request count or body bytes are at their limits.
+"""
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from . import codec, framing, ingest
+from .batch import error_record
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_IN_FLIGHT = 16
+DEFAULT_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+
+class InFlightLimiter:
+    """
+    Bounds the number of requests, and the total size of their bodies, being processed.
+    A single request larger than the byte limit is admitted once nothing else is in flight.
+    """
+
+    def __init__(self, max_requests, max_bytes):
+        self.max_requests = max(1, int(max_requests))
+        self.max_bytes = max(1, int(max_bytes))
+        self.requests = 0
+        self.bytes = 0
+        self._condition = threading.Condition()
+
+    def _has_room(self, size):
+        if self.requests == 0:
+            return True
+        return self.requests < self.max_requests and self.bytes + size <= self.max_bytes
+
+    def acquire(self, size):
+        """ Blocks until a request of the given body size may start """
+        with self._condition:
+            self._condition.wait_for(lambda: self._has_room(size))
+            self.requests += 1
+            self.bytes += size
+
+    def release(self, size):
+        """ Marks a request of the given body size as finished """
+        with self._condition:
+            self.requests -= 1
+            self.bytes -= size
+            self._condition.notify_all()
+
+
+def limits_from_environment():
+    """ Returns the pipelining limits configured by CMA_STREAM_* environment variables """
+    return {
+        'workers': int(os.environ.get('CMA_STREAM_WORKERS', DEFAULT_WORKERS)),
+        'max_in_flight': int(os.environ.get('CMA_STREAM_MAX_IN_FLIGHT',
+                                            DEFAULT_MAX_IN_FLIGHT)),
+        'max_in_flight_bytes': int(os.environ.get('CMA_STREAM_MAX_IN_FLIGHT_BYTES',
+                                                  DEFAULT_MAX_IN_FLIGHT_BYTES)),
+        'max_request_bytes': ingest.max_input_bytes(),
+    }
+
+
+def _error_body(exception):
+    return codec.dumps(error_record(exception))
+
+
+def _reject_oversized(reader, writer, write_lock, header, max_request_bytes):
+    """
+    * Skips the body of a request over max_request_bytes and answers it with an
+    * InputTooLarge ERROR
+    * @returns {boolean} True if the request was rejected
+    """
+    request_id, _, size = header
+    try:
+        ingest.check_size(size, max_request_bytes)
+    except ingest.InputTooLarge as exception:
+        ingest.skip(reader, size)
+        with write_lock:
+            framing.write_tagged_response(writer, request_id, 'ERROR', _error_body(exception))
+        return True
+    return False
+
+
+def serve_pipelined(  # pylint: disable=too-many-arguments
+        reader, writer, handler, workers=DEFAULT_WORKERS,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES,
+        max_request_bytes=None):
+    """
+    * Serves pipelined requests until <EXIT> or end of input, then waits for the requests
+    * still in flight to be answered
+    * @param {*} reader Binary file-like object requests are read from
+    * @param {*} writer Binary file-like object responses are written to
+    * @param {function} handler handler(command, body) returning the encoded response body
+    * @param {int} workers Size of the thread pool running requests
+    * @param {int} max_in_flight Maximum number of requests read but not yet answered
+    * @param {int} max_in_flight_bytes Maximum total body size of those requests
+    * @param {int} max_request_bytes Largest body run; larger bodies are skipped unread and
+    *                                answered with an InputTooLarge ERROR
+    """
+    limiter = InFlightLimiter(max_in_flight, max_in_flight_bytes)
+    write_lock = threading.Lock()
+
+    def run(request_id, command, size, body):
+        try:
+            try:
+                status = 'OK'
+                response = handler(command, body)
+            except Exception as exception:  # pylint: disable=broad-except
+                status = 'ERROR'
+                response = _error_body(exception)
+            with write_lock:
+                framing.write_tagged_response(writer, request_id, status, response)
+        finally:
+            limiter.release(size)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        while True:
+            header = framing.read_pipelined_header(reader)
+            if header is None:
+                break
+            size = header[2]
+            if _reject_oversized(reader, writer, write_lock, header, max_request_bytes):
+                continue
+            limiter.acquire(size)
+            try:
+                body = framing.read_exact(reader, size)
+            except framing.FramingError:
+                limiter.release(size)
+                raise
+            executor.submit(run, *header, body)
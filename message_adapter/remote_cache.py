@@ -0,0 +1,256 @@
+"""
+Process-wide cache of remote message portions, keyed by S3 bucket and key
+
+Entries hold the decompressed JSON bytes and the object's ETag. load_remote_event reads
+through the cache and store_remote_response writes through it. A cached entry is only used
+after a conditional GET (IfNoneMatch on its ETag) confirms the object has not changed, so a
+hit saves the transfer and decompression but never returns stale data. Entries are kept as
+encoded bytes rather than parsed objects because the adapter updates loaded events in place;
+decoding a cached body is cheaper than deep-copying a cached object.
+
+The cache is off unless configured:
+* CMA_REMOTE_CACHE_MAX_BYTES: in-memory bound on cached body bytes (default 0, disabled)
+* CMA_REMOTE_CACHE_DIR: directory (e.g. under /tmp) for an on-disk tier shared by processes;
+  one that cannot be created is ignored with a warning
+* CMA_REMOTE_CACHE_DIR_MAX_BYTES: bound on the on-disk tier (default 256 MiB)
+"""
+import hashlib
+import json
+import os
+import threading
+
+from . import codec, tracing, transfer
+from .log import logger
+from .lru import LRUCache, size_from_environment
+
+DEFAULT_DIRECTORY_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _not_modified(error):
+    """ Returns True if a botocore ClientError is S3's 304 response to IfNoneMatch """
+    return (error.response.get('Error', {}).get('Code') in ('304', 'NotModified') or
+            error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304)
+
+
+class DiskTier:
+    """ Size-bounded directory of cache entries, evicting the least recently written """
+
+    def __init__(self, directory, max_bytes=DEFAULT_DIRECTORY_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256('/'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{digest}.cma')
+
+    def get(self, key):
+        """ Returns the (etag, body, stored size) entry for key, or None """
+        try:
+            with open(self._path(key), 'rb') as entry_file:
+                header = json.loads(entry_file.readline())
+                return header['etag'], entry_file.read(), header['size']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, entry):
+        """ Writes an (etag, body, stored size) entry for key, then enforces max_bytes """
+        etag, body, size = entry
+        if len(body) > self.max_bytes:
+            return
+        path = self._path(key)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary, 'wb') as entry_file:
+                entry_file.write(json.dumps({'etag': etag, 'size': size}).encode('utf-8'))
+                entry_file.write(b'\n')
+                entry_file.write(body)
+            os.replace(temporary, path)
+        except OSError:
+            return
+        self._evict()
+
+    def _evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.name.endswith('.cma')]
+        except OSError:
+            return
+        stats = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                        for entry in entries), reverse=True)
+        total = 0
+        for _, size, path in stats:
+            total += size
+            if total > self.max_bytes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        """ Removes every entry """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.cma'):
+                os.remove(entry.path)
+
+
+class RemoteEventCache:
+    """ Two-tier (memory, then optional disk) cache of remote message portions """
+
+    def __init__(self, max_bytes=0, directory=None,
+                 directory_max_bytes=DEFAULT_DIRECTORY_MAX_BYTES):
+        self._memory = LRUCache(max_bytes, weigh=lambda entry: len(entry[1]))
+        self._disk = DiskTier(directory, directory_max_bytes) if directory else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self):
+        """ True if either tier can hold entries """
+        return bool(self._memory.info()['max_size']) or self._disk is not None
+
+    def _lookup(self, key):
+        entry = self._memory.get(key)
+        if entry is None and self._disk is not None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                self._memory.put(key, entry)
+        return entry
+
+    def put(self, key, etag, body, stored_size=None):
+        """
+        * Caches the body of an S3 object
+        * @param {tuple} key The object's (bucket, key)
+        * @param {string} etag The object's ETag
+        * @param {bytes} body The decompressed JSON body
+        * @param {int} stored_size The size of the object in S3, if different from body
+        """
+        if not self.enabled or not etag:
+            return
+        entry = (etag, bytes(body), len(body) if stored_size is None else stored_size)
+        self._memory.put(key, entry)
+        if self._disk is not None:
+            self._disk.put(key, entry)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+        for name, value in counts.items():
+            tracing.count(f'remote_cache.{name}', value)
+
+    def load(self, s3_object, algorithm=None):
+        """
+        * Returns the JSON document stored in an S3 object, from the cache when its ETag
+        * is still current
+        * @param {*} s3_object The boto3 S3 Object resource to read
+        * @param {string|None} algorithm The compression recorded in the replace pointer
+        * @returns {*} the decoded document
+        """
+        with tracing.span('s3.get', key=s3_object.key) as span:
+            body = self._read(s3_object, algorithm, span)
+        with tracing.span('deserialize', bytes=len(body)):
+            return codec.loads(body)
+
+    def _read(self, s3_object, algorithm, span):
+        """ Returns the decompressed body of an S3 object, from the cache if still current """
+        if not self.enabled:
+            response = s3_object.get()
+            span.set(bytes=response.get('ContentLength'))
+            return transfer.read_body(response, algorithm)
+
+        key = (s3_object.bucket_name, s3_object.key)
+        cached = self._lookup(key)
+        if cached is None:
+            response = s3_object.get()
+            self._count(misses=1)
+            span.set(cache='miss')
+        else:
+            from botocore.exceptions import ClientError  # pylint: disable=import-outside-toplevel
+            etag, body, stored_size = cached
+            try:
+                response = s3_object.get(IfNoneMatch=etag)
+            except ClientError as error:
+                if not _not_modified(error):
+                    raise
+                self._count(hits=1, bytes_saved=stored_size)
+                span.set(cache='hit', bytes=0)
+                return body
+            self._count(stale=1)
+            span.set(cache='stale')
+
+        span.set(bytes=response.get('ContentLength'))
+        body = transfer.read_body(response, algorithm)
+        self.put(key, response.get('ETag'), body, response.get('ContentLength'))
+        return body
+
+    def clear(self):
+        """ Drops every entry in both tiers and resets the counters """
+        self._memory.clear()
+        if self._disk is not None:
+            self._disk.clear()
+        with self._lock:
+            self.hits = self.misses = self.stale = self.bytes_saved = 0
+
+    def info(self):
+        """ Returns hit/miss counters, the hit ratio, bytes saved and memory tier usage """
+        memory = self._memory.info()
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'entries': memory['size'],
+                'bytes': memory['weight'],
+                'max_bytes': memory['max_size'],
+                'directory': self._disk.directory if self._disk is not None else None
+            }
+
+
+def _from_environment():
+    max_bytes = size_from_environment('CMA_REMOTE_CACHE_MAX_BYTES', 0)
+    directory = os.environ.get('CMA_REMOTE_CACHE_DIR') or None
+    try:
+        return RemoteEventCache(max_bytes, directory, size_from_environment(
+            'CMA_REMOTE_CACHE_DIR_MAX_BYTES', DEFAULT_DIRECTORY_MAX_BYTES))
+    except OSError as exception:
+        # The cache is built at import time, so a directory that cannot be created leaves
+        # it without a disk tier instead of failing every command
+        logger.warning('Ignoring CMA_REMOTE_CACHE_DIR=%r, which cannot be used (%s); '
+                       'remote message portions are not cached on disk', directory, exception)
+        return RemoteEventCache(max_bytes)
+
+
+_cache = _from_environment()
+
+
+def configure(max_bytes=0, directory=None, directory_max_bytes=DEFAULT_DIRECTORY_MAX_BYTES):
+    """ Replaces the process-wide cache. max_bytes=0 and no directory disables it """
+    global _cache  # pylint: disable=global-statement
+    _cache = RemoteEventCache(max_bytes, directory, directory_max_bytes)
+
+
+def load(s3_object, algorithm=None):
+    """ Loads a remote message portion through the process-wide cache """
+    return _cache.load(s3_object, algorithm)
+
+
+def put(bucket, key, etag, body, stored_size=None):
+    """ Writes a just-stored message portion through to the process-wide cache """
+    _cache.put((bucket, key), etag, body, stored_size)
+
+
+def clear_cache():
+    """ Empties the process-wide cache """
+    _cache.clear()
+
+
+def cache_info():
+    """ Returns statistics for the process-wide cache """
+    return _cache.info()
@@ -0,0 +1,112 @@
+"""
+Process-wide registry of compiled JSON schema validators
+
+Schemas are loaded, checked and compiled once per file and reused by every MessageAdapter
+in the process until the file changes on disk (detected by modification time and size).
+"""
+import json
+import os
+import threading
+
+from functools import lru_cache
+
+# jsonschema and fastjsonschema are imported on first use, so commands run without
+# schemas never load them
+# pylint: disable=import-outside-toplevel
+
+
+@lru_cache(maxsize=None)
+def _fastjsonschema():
+    """ Returns the fastjsonschema module, or None if it is not installed """
+    try:
+        import fastjsonschema
+    except ImportError:  # pragma: no cover - optional dependency
+        return None
+    return fastjsonschema
+
+
+def _fast_validation_enabled():
+    return os.environ.get('CMA_FAST_SCHEMA_VALIDATION', 'false').lower() == 'true'
+
+
+class SchemaValidator:  # pylint: disable=too-few-public-methods
+    """
+    A compiled validator for one schema. When fastjsonschema is installed and
+    CMA_FAST_SCHEMA_VALIDATION=true, documents are first checked by a code-generated
+    validator; any document it rejects is re-validated with jsonschema, so the errors
+    raised are always the ones jsonschema.validate would raise.
+    """
+
+    def __init__(self, schema):
+        from jsonschema import validators
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.validator = cls(schema)
+        self.fast_validator = None
+        fastjsonschema = _fastjsonschema()
+        if fastjsonschema is not None and _fast_validation_enabled():
+            try:
+                self.fast_validator = fastjsonschema.compile(schema)
+            except Exception:  # pylint: disable=broad-except
+                self.fast_validator = None
+
+    def validate(self, document):
+        """
+        * Validates document against the schema
+        * @param {*} document The document to validate
+        * @throws jsonschema.exceptions.ValidationError the best matching error, if invalid
+        """
+        from jsonschema.exceptions import best_match
+        if self.fast_validator is not None:
+            try:
+                self.fast_validator(document)
+                return
+            except _fastjsonschema().JsonSchemaException:
+                pass
+        error = best_match(self.validator.iter_errors(document))
+        if error is not None:
+            raise error
+
+
+class SchemaRegistry:
+    """ Thread-safe cache of SchemaValidators keyed by absolute schema path """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._validators = {}
+        self.loads = 0
+
+    def get(self, filepath):
+        """
+        * Returns the validator for the schema at filepath, (re)loading the file only if
+        * it has not been loaded before or has changed since
+        * @param {string} filepath Path to a JSON schema file
+        * @returns {SchemaValidator|None} the validator, or None if the file does not exist
+        """
+        key = os.path.abspath(filepath)
+        try:
+            stat = os.stat(key)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._validators.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with open(key, encoding='utf-8') as schema_handle:
+            validator = SchemaValidator(json.load(schema_handle))
+        with self._lock:
+            self._validators[key] = (version, validator)
+            self.loads += 1
+        return validator
+
+    def clear(self):
+        """ Drops every cached validator """
+        with self._lock:
+            self._validators.clear()
+            self.loads = 0
+
+
+registry = SchemaRegistry()
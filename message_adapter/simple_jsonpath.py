@@ -0,0 +1,121 @@
+"""
+Native evaluator for the simple JSONPath subset used by nearly all Cumulus templates
+
+Paths made only of dotted keys, non-negative integer indices and [*] wildcards
+(e.g. $.meta.collection.name, $.payload.granules[*].files, $) are evaluated directly
+against dicts and lists, without building jsonpath_ng DatumInContext wrappers. Whenever
+the data holds a value whose jsonpath_ng behaviour is not plain dict/list navigation
+(e.g. indexing into a string, or [*] over a dict), UnsupportedValue is raised so the
+caller can defer to jsonpath_ng and get identical results.
+"""
+import re
+
+FIELD = 'field'
+INDEX = 'index'
+WILDCARD = 'wildcard'
+
+_IDENTIFIER = r'[A-Za-z_][A-Za-z0-9_\-]*'
+_FIRST_FIELD_REGEX = re.compile(_IDENTIFIER)
+_STEP_REGEX = re.compile(rf'\.(?P<field>{_IDENTIFIER})|\[(?P<index>\d+)\]|\[(?P<wildcard>\*)\]')
+# Words the jsonpath_ng lexer treats as operators rather than field names
+_RESERVED_WORDS = {'where', 'wherenot'}
+
+
+class UnsupportedValue(Exception):
+    """ The data requires jsonpath_ng semantics the native evaluator does not replicate """
+
+
+class SimplePath:
+    """ A compiled simple JSONPath: a tuple of (kind, argument) steps applied from the root """
+
+    def __init__(self, path, steps):
+        self.path = path
+        self.steps = steps
+
+    def __str__(self):
+        return self.path
+
+    def _find(self, data, steps):
+        current = [data]
+        for kind, argument in steps:
+            matches = []
+            for value in current:
+                if kind == FIELD:
+                    if not isinstance(value, dict):
+                        raise UnsupportedValue(self.path)
+                    if argument in value:
+                        matches.append(value[argument])
+                elif not isinstance(value, list):
+                    raise UnsupportedValue(self.path)
+                elif kind == INDEX:
+                    if argument < len(value):
+                        matches.append(value[argument])
+                else:
+                    matches.extend(value)
+            current = matches
+        return current
+
+    def find_values(self, data):
+        """
+        * Returns the values matched by the path, in jsonpath_ng match order
+        * @param {*} data The document to search
+        * @throws UnsupportedValue if jsonpath_ng must evaluate this document
+        * @returns {list} the matched values
+        """
+        return self._find(data, self.steps)
+
+    def update(self, data, value):
+        """
+        * Replaces every existing value matched by the path with value, as
+        * jsonpath_ng's update does. Only paths ending in a field are supported.
+        * @param {*} data The document to update in place
+        * @param {*} value The value to set
+        * @throws UnsupportedValue if jsonpath_ng must perform this update
+        * @returns {*} the updated document (value itself for the root path)
+        """
+        if not self.steps:
+            return value
+        kind, field = self.steps[-1]
+        if kind != FIELD:
+            raise UnsupportedValue(self.path)
+        parents = self._find(data, self.steps[:-1])
+        if not all(isinstance(parent, dict) for parent in parents):
+            raise UnsupportedValue(self.path)
+        for parent in parents:
+            if field in parent:
+                parent[field] = value
+        return data
+
+
+def compile_simple_path(path):
+    """
+    * Compiles path into a SimplePath if it belongs to the supported subset
+    * @param {string} path JSONPath string
+    * @returns {SimplePath|None} the compiled path, or None if jsonpath_ng must handle it
+    """
+    position = 0
+    steps = []
+    if path.startswith('$'):
+        position = 1
+    else:
+        match = _FIRST_FIELD_REGEX.match(path)
+        if not match:
+            return None
+        steps.append((FIELD, match.group()))
+        position = match.end()
+
+    while position < len(path):
+        match = _STEP_REGEX.match(path, position)
+        if not match:
+            return None
+        if match.group('field') is not None:
+            steps.append((FIELD, match.group('field')))
+        elif match.group('index') is not None:
+            steps.append((INDEX, int(match.group('index'))))
+        else:
+            steps.append((WILDCARD, None))
+        position = match.end()
+
+    if any(kind == FIELD and argument in _RESERVED_WORDS for kind, argument in steps):
+        return None
+    return SimplePath(path, tuple(steps))
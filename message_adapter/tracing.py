@@ -0,0 +1,174 @@
+"""
+Opt-in timing of the phases of each CMA command
+
+When CMA_TRACE is set, every command run by the CLI (single command or stream) emits one
+JSON record holding the command's wall and CPU time, a span for each phase it went through
+(remote load, S3 GET/PUT, config and input resolution, schema validation, output
+assignment, serialization, ...) with the bytes the phase handled, and counters such as
+remote cache hits. CMA_TRACE=stderr (or 1/true) writes each record as one line on stderr;
+any other value is the path of a file the records are appended to.
+
+Spans record wall time and the CPU time of the thread that ran them. Outside a traced
+command span() returns a shared no-op object, so instrumented code costs a context
+variable lookup when tracing is off.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+DISABLED_VALUES = ('', '0', 'false', 'off', 'none')
+STDERR_VALUES = ('1', 'true', 'stderr')
+
+_current = contextvars.ContextVar('cma_trace', default=None)
+_sink_lock = threading.Lock()
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+def sink():
+    """ Returns 'stderr', a file path, or None when tracing is off """
+    value = os.environ.get('CMA_TRACE', '')
+    if value.lower() in DISABLED_VALUES:
+        return None
+    return 'stderr' if value.lower() in STDERR_VALUES else value
+
+
+class Trace:
+    """ The spans and counters recorded for one command """
+
+    def __init__(self, name):
+        self.command = name
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        """ Appends a finished span's record """
+        self.spans.append(record)
+
+    def count(self, name, value):
+        """ Adds value to the named counter """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class Span:
+    """ Times one phase of a traced command; extra fields are set with set() """
+
+    __slots__ = ('_trace', 'name', 'fields', '_wall', '_cpu')
+
+    def __init__(self, trace, name, fields):
+        self._trace = trace
+        self.name = name
+        self.fields = fields
+        self._wall = self._cpu = None
+
+    def set(self, **fields):
+        """ Adds fields (e.g. bytes=...) to the span's record """
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        record = {
+            'name': self.name,
+            'wall_ms': _milliseconds(time.perf_counter() - self._wall),
+            'cpu_ms': _milliseconds(time.thread_time() - self._cpu)
+        }
+        if exception_type is not None:
+            record['error'] = exception_type.__name__
+        record.update(self.fields)
+        self._trace.add(record)
+        return False
+
+
+class _NoSpan:
+    """ Stands in for Span when no command is being traced """
+
+    def set(self, **fields):
+        """ Ignores fields """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name, **fields):
+    """
+    * Returns a context manager timing one phase of the current command
+    * @param {string} name The phase, e.g. 's3.get'
+    * @param {*} fields Extra values for the span's record
+    * @returns {Span|_NoSpan} the span, a no-op when no command is being traced
+    """
+    trace = _current.get()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, fields)
+
+
+def count(name, value=1):
+    """ Adds value to a counter of the current command, if it is being traced """
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def _emit(destination, record):
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with _sink_lock:
+        if destination == 'stderr':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            with open(destination, 'a', encoding='utf-8') as trace_file:
+                trace_file.write(line)
+
+
+@contextmanager
+def command(name):
+    """
+    * Traces the enclosed command and emits its record on exit, if CMA_TRACE is set
+    * @param {string} name The CMA function being run
+    """
+    destination = sink()
+    if destination is None:
+        yield None
+        return
+    trace = Trace(name)
+    token = _current.set(trace)
+    started = time.time()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    status = 'ok'
+    try:
+        yield trace
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _current.reset(token)
+        _emit(destination, {
+            'command': name,
+            'status': status,
+            'pid': os.getpid(),
+            'started': round(started, 6),
+            'wall_ms': _milliseconds(time.perf_counter() - wall),
+            'cpu_ms': _milliseconds(time.thread_time() - cpu),
+            'spans': trace.spans,
+            'counters': trace.counters
+        })
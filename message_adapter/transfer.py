@@ -0,0 +1,144 @@
+"""
+Memory-conscious transfer of message portions to and from S3
+
+Downloads are read straight from the streaming body into a single preallocated buffer that
+the codec decodes without an intermediate str, so a remote event is held as at most one raw
+copy plus the parsed object. Uploads at or above the multipart threshold are sent as a
+parallel multipart upload.
+
+Settings (bytes unless noted):
+* CMA_S3_MULTIPART_THRESHOLD: body size from which uploads are multipart (default 64 MiB)
+* CMA_S3_MULTIPART_CHUNKSIZE: multipart part size (default 16 MiB)
+* CMA_S3_MAX_CONCURRENCY: number of parts uploaded in parallel (default 4)
+
+Content-addressed keys (see content_key) let identical bodies share one object.
+"""
+import hashlib
+import io
+import os
+
+from datetime import datetime, timedelta, timezone
+
+from . import codec, compression
+
+MIB = 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 64 * MIB
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * MIB
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_DEDUP_MAX_AGE = 24 * 60 * 60
+
+
+def _setting(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _read_into_buffer(body, length):
+    """ Reads exactly length bytes from a streaming body into one bytearray """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < length:
+        count = body.readinto(view[filled:])
+        if not count:
+            raise IOError(f'Remote object ended after {filled} of {length} bytes')
+        filled += count
+    view.release()
+    return buffer
+
+
+def read_body(response, algorithm=None):
+    """
+    * Reads and decompresses the body of an S3 GetObject response
+    * @param {dict} response The GetObject response, with its unread streaming Body
+    * @param {string|None} algorithm The compression recorded in the replace pointer; if None,
+    *                                the object's ContentEncoding is used when it names one
+    * @returns {bytes|bytearray} the encoded JSON
+    """
+    if algorithm is None and response.get('ContentEncoding') in compression.ALGORITHMS:
+        algorithm = response['ContentEncoding']
+    body = response['Body']
+    length = response.get('ContentLength')
+    if length is None:
+        data = body.read()
+    else:
+        data = _read_into_buffer(body, length)
+    return compression.decompress(data, algorithm)
+
+
+def load_body(response, algorithm=None):
+    """
+    * Decodes the JSON document in an S3 GetObject response
+    * @param {dict} response The GetObject response, with its unread streaming Body
+    * @param {string|None} algorithm As for read_body
+    * @returns {*} the decoded document
+    """
+    return codec.loads(read_body(response, algorithm))
+
+
+def object_arguments(algorithm=None):
+    """
+    * Returns the PutObject arguments for a stored message portion: an expiry a week ahead,
+    * and the compression algorithm, if any, as its ContentEncoding
+    """
+    arguments = {'Expires': datetime.utcnow() + timedelta(days=7)}
+    if algorithm is not None:
+        arguments['ContentEncoding'] = algorithm
+    return arguments
+
+
+def upload_body(s3_object, body, extra_args):
+    """
+    * Uploads an encoded body to an S3 object, using a parallel multipart upload for bodies
+    * at or above CMA_S3_MULTIPART_THRESHOLD
+    * @param {*} s3_object The boto3 S3 Object resource to write
+    * @param {bytes} body The body to upload
+    * @param {dict} extra_args Additional PutObject arguments (Expires, ContentEncoding, ...)
+    * @returns {string|None} the new object's ETag, or None for multipart uploads
+    """
+    threshold = _setting('CMA_S3_MULTIPART_THRESHOLD', DEFAULT_MULTIPART_THRESHOLD)
+    if len(body) < threshold:
+        return s3_object.put(Body=body, **extra_args).get('ETag')
+
+    from boto3.s3.transfer import TransferConfig  # pylint: disable=import-outside-toplevel
+    config = TransferConfig(
+        multipart_threshold=threshold,
+        multipart_chunksize=_setting('CMA_S3_MULTIPART_CHUNKSIZE', DEFAULT_MULTIPART_CHUNKSIZE),
+        max_concurrency=_setting('CMA_S3_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)
+    )
+    # BytesIO shares the bytes object's buffer until it is written to
+    s3_object.upload_fileobj(io.BytesIO(body), ExtraArgs=extra_args, Config=config)
+    return None
+
+
+def content_key(body, algorithm=None):
+    """
+    * Returns the content-addressed key for an encoded message portion
+    * @param {bytes} body The encoded JSON, before compression
+    * @param {string|None} algorithm The compression it will be stored with
+    * @returns {string} events/sha256-<hex digest>, with the algorithm as a suffix
+    """
+    key = f'events/sha256-{hashlib.sha256(body).hexdigest()}'
+    return f'{key}.{algorithm}' if algorithm else key
+
+
+def fresh_object(s3_object, max_age):
+    """
+    * Checks, with a HEAD request, for an existing object written recently enough to reuse.
+    * Older objects are not reused so bucket lifecycle rules cannot expire them while a
+    * pointer to them is in flight; uploading again refreshes their age.
+    * @param {*} s3_object The boto3 S3 Object resource
+    * @param {int} max_age The maximum age, in seconds, of a reusable object
+    * @returns {tuple|None} (ETag, ContentLength) of a reusable object, or None
+    """
+    from botocore.exceptions import ClientError  # pylint: disable=import-outside-toplevel
+    try:
+        s3_object.load()
+    except ClientError as error:
+        # 403 is returned for missing keys when the caller may not list the bucket
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound', '403'):
+            return None
+        raise
+    age = datetime.now(timezone.utc) - s3_object.last_modified
+    if age.total_seconds() > max_age:
+        return None
+    return s3_object.e_tag, s3_object.content_length
@@ -1,8 +1,9 @@
 from copy import deepcopy
-from jsonpath_ng import parse
+from .jsonpath_cache import parse
+from .simple_jsonpath import FIELD
 
 
-def assign_json_path_value(source_message, jspath, value):
+def assign_json_path_value(source_message, jspath, value, copy=True):
     """
     * Assign (update or insert) a value to message based on jsonpath.
     * Create the keys if jspath doesn't already exist in the message. In this case, we
@@ -10,10 +11,12 @@ def assign_json_path_value(source_message, jspath, value):
     * @param {dict} source_message The message to be updated
     * @param {string} jspath JSON path string
     * @param {*} value Value to update to
+    * @param {bool} copy If False, source_message is updated in place instead of copied
     * @return {*} updated message
     """
-    message = deepcopy(source_message)
-    if not parse(jspath).find(message):
+    message = deepcopy(source_message) if copy else source_message
+    json_path = parse(jspath)
+    if not json_path.find_values(message):
         paths = jspath.lstrip('$.').split('.')
         current_item = message
         key_not_found = False
@@ -27,5 +30,63 @@ def assign_json_path_value(source_message, jspath, value):
                 current_item = new_path_dict
             else:
                 current_item = current_item[path]
-    parse(jspath).update(message, value)
+    json_path.update(message, value)
     return message
+
+
+def assign_json_path_values(source_message, assignments, copy=True):
+    """
+    * Assign (update or insert) several values to message based on jsonpaths, in order.
+    * Each assignment behaves as assign_json_path_value, but the message is copied at
+    * most once and dotted destination paths are written in a single walk that creates
+    * any missing intermediate keys on the way.
+    * @param {dict} source_message The message to be updated
+    * @param {iterable} assignments (jspath, value) pairs; later pairs overwrite earlier ones.
+    *                              The values are not modified
+    * @param {bool} copy If False, source_message is updated in place instead of copied
+    * @return {*} updated message
+    """
+    message = deepcopy(source_message) if copy else source_message
+    assignments = list(assignments)
+    paths = [jspath for jspath, _ in assignments]
+    for index, (jspath, value) in enumerate(assignments):
+        # assign_json_path_value copies the whole message before each assignment, so a later
+        # path never writes into a value as given; copy just the values that one writes into
+        if _is_written_into(jspath, paths[index + 1:]):
+            value = deepcopy(value)
+        if not _assign_field_path(message, jspath, value):
+            assign_json_path_value(message, jspath, value, copy=False)
+    return message
+
+
+def _is_written_into(jspath, later_paths):
+    """ Returns True if any of later_paths is inside the value assigned at jspath """
+    return any(path.startswith((f'{jspath}.', f'{jspath}[')) for path in later_paths)
+
+
+def _assign_field_path(message, jspath, value):
+    """
+    * Assigns value at a dotted-key path ($.a.b.c) in one walk, creating missing dicts.
+    * Returns False, without changing message, if the path is not a dotted-key path or
+    * an existing value along it is not a dict.
+    """
+    simple = parse(jspath).simple
+    if simple is None or not simple.steps or any(kind != FIELD for kind, _ in simple.steps):
+        return False
+    if not isinstance(message, dict):
+        return False
+
+    keys = [key for _, key in simple.steps]
+    current_item = message
+    for depth, key in enumerate(keys[:-1]):
+        if key not in current_item:
+            for missing_key in keys[depth:-1]:
+                new_path_dict = {}
+                current_item[missing_key] = new_path_dict
+                current_item = new_path_dict
+            break
+        current_item = current_item[key]
+        if not isinstance(current_item, dict):
+            return False
+    current_item[keys[-1]] = value
+    return True
@@ -50,7 +50,7 @@ setup(
         'Programming Language :: Python :: 3.12',
     ],
     keywords='nasa cumulus message adapter',  # Optional
-    packages=find_packages(exclude=['.circleci', 'contrib', 'docs', 'tests']),  # Required
+    packages=find_packages(exclude=['.circleci', 'benchmarks', 'contrib', 'docs', 'tests']),  # Required
     install_requires=install_requires,
     python_requires='~=3.12',
     dependency_links=dependency_links
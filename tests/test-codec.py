@@ -0,0 +1,104 @@
+"""
+Parity tests for the JSON codec backends
+"""
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+import unittest
+
+from mock import patch
+from message_adapter import codec
+
+
+class Test(unittest.TestCase):
+    """ Test class """
+
+    test_folder = os.path.join(os.getcwd(), 'examples/messages')
+    stdlib = codec.get_codec('stdlib')
+
+    documents = [
+        {'unicode': 'café ☃ \U0001f600', 'escapes': '"\\/\b\f\n\r\t\u0000'},
+        {'max': 2 ** 64 - 1, 'min': -(2 ** 63)},
+        {'floats': [0.1, -0.0, 1e-7, 1e16, 1.7976931348623157e308, 5e-324]},
+        {'surrogate': '\ud800'},
+        {1: 'int key', None: 'none key', 2.5: 'float key'},
+        {'numeric string': '12345678901234567890123'},
+        [[[[[[[[[[[]]]]]]]]]]],
+        'scalar', 3, None, True,
+    ]
+
+    def codecs(self):
+        """ returns every codec available in this environment """
+        available = [self.stdlib]
+        orjson_codec = codec.get_codec('auto')
+        if orjson_codec.name == 'orjson':
+            available.append(orjson_codec)
+        return available
+
+    def test_documents_round_trip(self):
+        """ Test every backend encodes to JSON the stdlib decodes to the same document """
+        nested = []
+        for _ in range(300):
+            nested = [nested]
+        for document in self.documents + [nested]:
+            expected = json.loads(json.dumps(document))
+            for backend in self.codecs():
+                encoded = backend.dumps(document)
+                assert isinstance(encoded, bytes)
+                assert json.loads(encoded) == expected, backend.name
+                assert backend.loads(encoded) == expected, backend.name
+                assert backend.loads(encoded.decode('utf-8')) == expected, backend.name
+
+    def test_example_messages_decode_identically(self):
+        """ Test every backend decodes the example messages like json.loads """
+        for filename in glob.glob(os.path.join(self.test_folder, '*.json')):
+            with open(filename, 'rb') as message_file:
+                data = message_file.read()
+            for backend in self.codecs():
+                assert backend.loads(data) == json.loads(data), (backend.name, filename)
+                assert backend.loads(backend.dumps(json.loads(data))) == json.loads(data)
+
+    def test_large_integers_encode_exactly(self):
+        """ Test integers outside the 64-bit range are encoded exactly by every backend """
+        for backend in self.codecs():
+            assert json.loads(backend.dumps([2 ** 70, -(2 ** 64)])) == [2 ** 70, -(2 ** 64)]
+
+    def test_non_standard_input_literals(self):
+        """ Test NaN and Infinity literals are accepted by every backend """
+        for backend in self.codecs():
+            values = backend.loads(b'[NaN, Infinity, -Infinity]')
+            assert math.isnan(values[0])
+            assert values[1:] == [math.inf, -math.inf]
+
+    def test_unencodable_values_raise_type_error(self):
+        """ Test every backend raises the stdlib's TypeError for values JSON cannot hold """
+        for backend in self.codecs():
+            with self.assertRaises(TypeError):
+                backend.dumps({'set': {1, 2}})
+            with self.assertRaises(ValueError):
+                backend.loads(b'{"truncated": ')
+
+    def test_backend_selection(self):
+        """ Test CMA_JSON_CODEC selects the backend """
+        with patch.dict(os.environ, {'CMA_JSON_CODEC': 'stdlib'}):
+            assert codec.default_codec().name == 'stdlib'
+            assert codec.dumps({'a': [1, 2]}) == b'{"a":[1,2]}'
+        with self.assertRaises(ValueError):
+            codec.get_codec('fastest')
+
+    def test_cli_output_matches_across_backends(self):
+        """ Test the CLI produces the same message whichever backend is selected """
+        with open(os.path.join(self.test_folder, 'templates.input.json'),
+                  encoding='utf-8') as message_file:
+            cli_input = json.dumps({'event': json.load(message_file)})
+        outputs = []
+        for backend in self.codecs():
+            env = dict(os.environ, CMA_JSON_CODEC=backend.name)
+            result = subprocess.run([sys.executable, os.getcwd(), 'loadNestedEvent'],
+                                    input=cli_input, env=env, check=True,
+                                    capture_output=True, text=True)
+            outputs.append(json.loads(result.stdout))
+        assert all(output == outputs[0] for output in outputs)
@@ -0,0 +1,127 @@
+"""
+Differential tests for the native simple-JSONPath evaluator against jsonpath_ng
+"""
+import json
+import os
+import unittest
+from copy import deepcopy
+
+from jsonpath_ng import parse as parse_jsonpath
+from message_adapter import jsonpath_cache, simple_jsonpath
+
+
+class Test(unittest.TestCase):
+    """ Test class """
+
+    test_folder = os.path.join(os.getcwd(), 'examples/messages')
+
+    documents = [
+        {
+            'meta': {'collection': {'name': 'MOD09GQ', 'version': '006'}, 'foo': 'bar',
+                     'empty': {}, 'none': None, 'number': 7, 'flag': False,
+                     'list': [1, 'two', {'three': 3}], 'dashed-key': 'dash'},
+            'payload': {'granules': [
+                {'granuleId': 'g1', 'files': [{'name': 'a.hdf'}, {'name': 'a.jpg'}]},
+                {'granuleId': 'g2', 'files': []},
+                {'granuleId': 'g3', 'files': {'name': 'single'}},
+                {'granuleId': 'g4'},
+                'not-a-granule',
+                None
+            ]},
+            'exception': 'None'
+        },
+        [{'a': 1}, {'a': [2, 3]}, 'string', 4, None, [5, 6]],
+        {'payload': None},
+        {'payload': 'a string'},
+        {'payload': [[0, 1], [2]]},
+        'scalar',
+        None,
+    ]
+
+    paths = [
+        '$', '$.meta', '$.meta.collection.name', 'meta.foo', '$.meta.none', '$.meta.none.x',
+        '$.meta.number', '$.meta.number.x', '$.meta.flag.x', '$.meta.missing',
+        '$.meta.missing.deeper', '$.meta.empty', '$.meta.list', '$.meta.list[0]',
+        '$.meta.list[2].three', '$.meta.list[9]', '$.meta.list[*]', '$.meta.list[*].three',
+        '$.meta.dashed-key', '$.meta.foo[0]', '$.meta.foo[*]', '$.meta.collection[*]',
+        '$.meta.collection[0]', '$.meta.number[*]', '$.meta.none[*]',
+        '$.payload', '$.payload.granules', '$.payload.granules[*]',
+        '$.payload.granules[*].granuleId', '$.payload.granules[*].files',
+        '$.payload.granules[*].files[*]', '$.payload.granules[*].files[*].name',
+        '$.payload.granules[0].files[1].name', '$.payload.granules[1].files[0]',
+        '$.payload[*]', '$.payload[0]', '$.payload[0][1]', '$.payload[*][*]',
+        '$[*]', '$[0]', '$[5][1]', '$[*].a', '$[*].a[*]', '$[1].a[0]',
+        '$.exception',
+    ]
+
+    def assert_same_find(self, path, document):
+        """ compares native and jsonpath_ng results for one path and document """
+        expected = [match.value for match in parse_jsonpath(path).find(deepcopy(document))]
+        simple = simple_jsonpath.compile_simple_path(path)
+        assert simple is not None, path
+        try:
+            actual = simple.find_values(deepcopy(document))
+        except simple_jsonpath.UnsupportedValue:
+            actual = None
+        if actual is not None:
+            self.assertEqual(expected, actual, f'{path} on {document}')
+        self.assertEqual(expected,
+                         jsonpath_cache.CompiledJsonPath(path).find_values(deepcopy(document)),
+                         f'{path} on {document}')
+
+    def assert_same_update(self, path, document):
+        """ compares native and jsonpath_ng updates for one path and document """
+        value = {'updated': True}
+        expected = deepcopy(document)
+        actual = deepcopy(document)
+        try:
+            expected_return = parse_jsonpath(path).update(expected, value)
+        except Exception as exception:  # pylint: disable=broad-except
+            with self.assertRaises(type(exception), msg=f'{path} on {document}'):
+                jsonpath_cache.CompiledJsonPath(path).update(actual, value)
+            return
+        actual_return = jsonpath_cache.CompiledJsonPath(path).update(actual, value)
+        self.assertEqual(expected, actual, f'{path} on {document}')
+        self.assertEqual(expected_return, actual_return, f'{path} on {document}')
+
+    def test_find_matches_jsonpath_ng(self):
+        """ Test the native evaluator finds the same values as jsonpath_ng """
+        for document in self.documents:
+            for path in self.paths:
+                self.assert_same_find(path, document)
+
+    def test_update_matches_jsonpath_ng(self):
+        """ Test the native evaluator updates documents as jsonpath_ng does """
+        for document in self.documents:
+            for path in self.paths:
+                self.assert_same_update(path, document)
+
+    def test_example_messages_match_jsonpath_ng(self):
+        """ Test every path over every example message """
+        for filename in sorted(os.listdir(self.test_folder)):
+            with open(os.path.join(self.test_folder, filename), encoding='utf-8') as handle:
+                document = json.load(handle)
+            for path in self.paths:
+                self.assert_same_find(path, document)
+                self.assert_same_update(path, document)
+
+    def test_unsupported_paths_use_jsonpath_ng(self):
+        """ Test paths outside the simple subset are left to jsonpath_ng """
+        document = self.documents[0]
+        for path in ["$..name", "$.meta.*", "$.meta['foo']", "$.meta.list[-1]",
+                     "$.meta.list[0:2]", "$.payload.granules[?(@.granuleId)]",
+                     "$.meta.where", "$ .meta", "$.meta.foo.`parent`"]:
+            assert simple_jsonpath.compile_simple_path(path) is None, path
+            try:
+                expected = [match.value for match in parse_jsonpath(path).find(document)]
+            except Exception:  # pylint: disable=broad-except
+                continue
+            self.assertEqual(expected, jsonpath_cache.CompiledJsonPath(path).find_values(document))
+
+    def test_unsupported_values_defer_to_jsonpath_ng(self):
+        """ Test data the native evaluator does not model raises UnsupportedValue """
+        simple = simple_jsonpath.compile_simple_path('$.meta.foo[*]')
+        with self.assertRaises(simple_jsonpath.UnsupportedValue):
+            simple.find_values({'meta': {'foo': 'bar'}})
+        self.assertEqual(['bar'], jsonpath_cache.CompiledJsonPath('$.meta.foo[*]').find_values(
+            {'meta': {'foo': 'bar'}}))
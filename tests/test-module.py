@@ -1,12 +1,22 @@
 """
 Tests for cumulus-message-adapter
 """
+import asyncio
+import importlib.util
+import io
+import logging
 import os
 import json
+import subprocess
+import sys
+import tempfile
 import unittest
+from copy import deepcopy
 from mock import patch
 from jsonschema.exceptions import ValidationError
-from message_adapter import aws, message_adapter
+from message_adapter import (aio, aws, codec, compression, config_plan, cumulus_message,
+                             error, execution_history, ingest, jsonpath_cache, log, lru,
+                             message_adapter, remote_cache, schemas, tracing, transfer, util)
 
 
 class Test(unittest.TestCase):  # pylint: disable=too-many-public-methods
@@ -89,6 +99,49 @@ class Test(unittest.TestCase):  # pylint: disable=too-many-public-methods
                     'replace': self.config_event_with_replace['cma']['event']['replace']}
         self.assertEqual(expected, result)
 
+    def test_default_adapter_does_not_modify_inputs(self):
+        """ Test the default adapter leaves the events and handler response it is given intact """
+        event = {'cma': {'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1000000},
+                         'event': {'meta': {'foo': 'bar'}, 'payload': {'a': [1]},
+                                   'cumulus_meta': {'system_bucket': self.bucket_name}}}}
+        original_event = deepcopy(event)
+        handler_response = {'b': [2]}
+        full_event = self.cumulus_message_adapter.load_and_update_remote_event(
+            event, {'functionName': 'task'})
+        original_full_event = deepcopy(full_event)
+        result = self.cumulus_message_adapter.create_next_event(
+            handler_response, full_event, None)
+        self.assertEqual(original_event, event)
+        self.assertEqual(original_full_event, full_event)
+        self.assertEqual({'b': [2]}, handler_response)
+        self.assertEqual({'b': [2]}, result['payload'])
+        assert result['payload'] is not handler_response
+        # A later output's destination inside an earlier one must not write into the response
+        handler_response = {'a': {'x': 1}, 'b': 2}
+        outputs = [{'source': '{$.a}', 'destination': '{$.payload}'},
+                   {'source': '{$.b}', 'destination': '{$.payload.y}'},
+                   {'source': '{$.a}', 'destination': '{$.meta.a}'}]
+        result = self.cumulus_message_adapter.create_next_event(
+            handler_response, full_event, {'outputs': outputs})
+        self.assertEqual({'a': {'x': 1}, 'b': 2}, handler_response)
+        self.assertEqual({'x': 1, 'y': 2}, result['payload'])
+        self.assertEqual({'x': 1}, result['meta']['a'])
+
+    def test_owns_events_updates_inputs_in_place(self):
+        """ Test an adapter that owns its events updates them instead of copying """
+        adapter = message_adapter.MessageAdapter(owns_events=True)
+        inner_event = {'meta': {'foo': 'bar'}, 'payload': {'a': [1]}}
+        event = {'cma': {'task_config': {'x': 'y'}, 'event': inner_event}}
+        full_event = adapter.load_and_update_remote_event(event, {'functionName': 'task'})
+        assert full_event is inner_event
+        self.assertEqual({'x': 'y'}, full_event['task_config'])
+        self.assertEqual({'0': {'name': 'task', 'version': None, 'arn': None}},
+                         json.loads(json.dumps(full_event['meta']['workflow_tasks'])))
+        handler_response = {'b': [2]}
+        result = adapter.create_next_event(handler_response, full_event, None)
+        assert result is full_event
+        assert result['payload'] is handler_response
+
 
     # load_nested_event task_config tests
     def test_returns_load_nested_event_local_with_task_config(self):
@@ -196,6 +249,44 @@ class Test(unittest.TestCase):  # pylint: disable=too-many-public-methods
             'key': 'value'
         }
 
+    def test_result_payload_with_multiple_config_outputs(self):
+        """
+        Test outputs are assigned in order, creating missing keys and letting later
+        outputs overwrite earlier ones
+        """
+        message_config_with_multiple_outputs = {
+            'outputs': [
+                {'source': '{$.input}', 'destination': '{$.payload.input}'},
+                {'source': '{$.input.dataLocation}', 'destination': '{$.meta.new.location}'},
+                {'source': '{$.input.dataLocation}', 'destination': '{$.payload.input}'},
+                {'source': '{$.input.dataLocation}', 'destination': '{$.meta.list[0]}'}
+            ]
+        }
+        event = {'meta': {'keep': 'me', 'list': ['old']}}
+
+        result = self.cumulus_message_adapter._MessageAdapter__assign_outputs(
+            self.nested_response, event, message_config_with_multiple_outputs)
+        assert result == {
+            'meta': {'keep': 'me', 'list': ['s3://source.jpg'],
+                     'new': {'location': 's3://source.jpg'}},
+            'payload': {'input': 's3://source.jpg'}
+        }
+        assert event == {'meta': {'keep': 'me', 'list': ['old']}}
+
+    def test_assign_json_path_values_matches_single_assignments(self):
+        """ Test batched assignment gives the same message as one assignment at a time """
+        message = {'a': {'b': 1}, 'c': 'string', 'd': [{'e': 1}, {'e': 2}]}
+        replacement = {'replaced': True}
+        assignments = [('$.a.b', 2), ('$.a.x.y', 3), ('$.new.deep.key', 4), ('$.d[*].e', 5),
+                       ('$.a', replacement), ('$.a.z', 6), ('$', 'ignored')]
+        expected = message
+        for jspath, value in assignments:
+            expected = util.assign_json_path_value(expected, jspath, value)
+        result = util.assign_json_path_values(message, assignments)
+        self.assertEqual(expected, result)
+        self.assertEqual({'a': {'b': 1}, 'c': 'string', 'd': [{'e': 1}, {'e': 2}]}, message)
+        self.assertEqual({'replaced': True}, replacement)
+
     # create_next_event tests
     def test_with_replace(self):
         """
@@ -357,6 +448,28 @@ class Test(unittest.TestCase):  # pylint: disable=too-many-public-methods
         self.assertEqual(remote_event_object, expected_remote_event_object)
         self.assertEqual(create_next_event_result, expected_create_next_event_result)
 
+    @patch('uuid.uuid4')
+    def test_stored_result_is_encoded_once(self, uuid_mock):
+        """ Test the bytes measured against MaxSize are the bytes uploaded to S3 """
+        uuid_mock.return_value = self.test_uuid
+        granules = [{'granuleId': f'g{index}', 'files': []} for index in range(100)]
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'payload': {'granules': granules},
+            'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1000}
+        }
+        with patch.object(codec, 'dumps', wraps=codec.dumps) as dumps_mock:
+            result = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+            small = cumulus_message.store_remote_response(
+                {'cumulus_meta': {}, 'payload': {'granules': granules[:2]},
+                 'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1000}}, 0, [])
+        assert dumps_mock.call_count == 2
+        assert result['payload'] == {}
+        assert small['payload'] == {'granules': granules[:2]}
+
+        remote_event = self.s3.Object(self.bucket_name, self.next_event_object_key_name).get()
+        assert remote_event['Body'].read() == codec.dumps({'granules': granules})
+
     def test_basic(self):
         """ test basic.input.json """
         inp = open(os.path.join(self.test_folder, 'basic.input.json'), encoding='utf-8')
@@ -662,3 +775,689 @@ class Test(unittest.TestCase):  # pylint: disable=too-many-public-methods
             adapter.create_next_event(handler_response, in_msg, messageConfig,)
         except ValidationError as e:
             assert e.message == "output schema: 1 is not of type u'string'"
+
+    # jsonpath cache tests
+    def test_jsonpath_cache_reuses_compiled_paths(self):
+        """ Test repeated paths are compiled once and served from the cache """
+        cache = jsonpath_cache.JsonPathCache(max_size=2)
+        first = cache.parse('$.meta.foo')
+        second = cache.parse('$.meta.foo')
+        assert first is second
+        assert cache.info() == {'hits': 1, 'misses': 1, 'size': 1, 'max_size': 2}
+
+    def test_jsonpath_cache_evicts_least_recently_used(self):
+        """ Test the cache evicts the least recently used path once full """
+        cache = jsonpath_cache.JsonPathCache(max_size=2)
+        first = cache.parse('$.a')
+        cache.parse('$.b')
+        cache.parse('$.a')
+        cache.parse('$.c')
+        assert cache.parse('$.a') is first
+        assert cache.info()['size'] == 2
+        assert cache.info()['misses'] == 3
+        cache.parse('$.b')
+        assert cache.info()['misses'] == 4
+
+    def test_jsonpath_cache_can_be_disabled(self):
+        """ Test a zero-sized cache compiles every lookup """
+        cache = jsonpath_cache.JsonPathCache(max_size=4)
+        cache.parse('$.a')
+        cache.resize(0)
+        assert cache.parse('$.a') is not cache.parse('$.a')
+        assert cache.info() == {'hits': 0, 'misses': 3, 'size': 0, 'max_size': 0}
+
+    def test_cache_size_settings_fall_back_to_the_default(self):
+        """ Test a malformed cache size setting is ignored with a warning """
+        name = 'CMA_JSONPATH_CACHE_SIZE'
+        with patch.dict(os.environ, {name: '64'}):
+            assert lru.size_from_environment(name, 1024) == 64
+        for value in ('lots', '1e3', '-1', ''):
+            with patch.dict(os.environ, {name: value}), \
+                    self.assertLogs(log.logger, 'WARNING') as logged:
+                assert lru.size_from_environment(name, 1024) == 1024
+            assert name in logged.output[0]
+        with patch.dict(os.environ):
+            os.environ.pop(name, None)
+            assert lru.size_from_environment(name, 1024) == 1024
+
+    # config plan tests
+    def test_config_plan_resolves_templates(self):
+        """ Test a compiled plan resolves every template flavor and keeps literals """
+        event = {'meta': {'foo': 'bar', 'list': [1, 2]}, 'payload': {'anykey': 'anyvalue'}}
+        config = {
+            'literal': 'no templates here',
+            'number': 5,
+            'nested': {'value': '{$.meta.foo}', 'untouched': {'a': ['b']}},
+            'items': ['{[$.meta.list]}', 'x', 'prefix{$.meta.foo}suffix'],
+            'missing': '{$.meta.nope}',
+            'cumulus_message': {'input': '{$.payload}'}
+        }
+        plan = config_plan.compile_config(config)
+        result = plan.resolve_config(event, config)
+        assert result == {
+            'literal': 'no templates here',
+            'number': 5,
+            'nested': {'value': 'bar', 'untouched': {'a': ['b']}},
+            'items': [[[1, 2]], 'x', 'prefixbarsuffix'],
+            'missing': None
+        }
+        assert plan.resolve_input(event, config) == {'anykey': 'anyvalue'}
+        assert config['items'][0] == '{[$.meta.list]}'
+
+    def test_config_plan_is_reused_for_equal_configs(self):
+        """ Test equal configs share a plan, which is applied to each event """
+        config = {'name': '{$.meta.name}', 'cumulus_message': {'input': '{$.payload.x}'}}
+        plan = config_plan.compile_config(config)
+        assert config_plan.compile_config(json.loads(json.dumps(config))) is plan
+        for name in ['first', 'second']:
+            event = {'meta': {'name': name}, 'payload': {'x': name}}
+            assert plan.resolve_config(event, config) == {'name': name}
+            assert plan.resolve_input(event, config) == name
+
+    def test_config_plan_defaults_input_to_payload(self):
+        """ Test a plan without cumulus_message.input resolves input to the payload """
+        plan = config_plan.compile_config({'literal': 'value'})
+        assert plan.resolve_input({'payload': [1]}, {'literal': 'value'}) == [1]
+
+    def test_templates_follow_the_jsonpath_cache(self):
+        """ Test templates take their paths from the JSONPath cache, and none when it is off """
+        assert (config_plan.compile_template('{$.a}').path is
+                config_plan.compile_template('{$.a}').path)
+        max_size = jsonpath_cache.cache_info()['max_size']
+        try:
+            jsonpath_cache.configure_cache(0)
+            assert (config_plan.compile_template('{$.a}').path is not
+                    config_plan.compile_template('{$.a}').path)
+        finally:
+            jsonpath_cache.configure_cache(max_size)
+
+    # schema registry tests
+    def test_schema_registry_reuses_validators(self):
+        """ Test a schema file is loaded once and reloaded only when it changes """
+        registry = schemas.SchemaRegistry()
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'input.json')
+            with open(filepath, 'w', encoding='utf-8') as schema_file:
+                json.dump({'type': 'object'}, schema_file)
+            validator = registry.get(filepath)
+            assert registry.get(filepath) is validator
+            assert registry.loads == 1
+
+            with open(filepath, 'w', encoding='utf-8') as schema_file:
+                json.dump({'type': 'string'}, schema_file)
+            stat = os.stat(filepath)
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+            registry.get(filepath).validate('a string')
+            assert registry.loads == 2
+            assert registry.get(os.path.join(directory, 'missing.json')) is None
+
+    def test_fast_schema_validation_raises_jsonschema_errors(self):
+        """ Test code-generated validation reports the same errors as jsonschema """
+        schema_file = os.path.join(self.schemas_folder, 'input.json')
+        with open(schema_file, encoding='utf-8') as handle:
+            schema = json.load(handle)
+        with patch.dict(os.environ, {'CMA_FAST_SCHEMA_VALIDATION': 'true'}):
+            validator = schemas.SchemaValidator(schema)
+        if importlib.util.find_spec('fastjsonschema') is None:
+            self.skipTest('fastjsonschema is not installed')
+        assert validator.fast_validator is not None
+        validator.validate({'hello': 'world'})
+        with self.assertRaises(ValidationError) as context:
+            validator.validate({'hello': 1})
+        self.assertEqual("1 is not of type 'string'", context.exception.message)
+
+    # aws tests
+    def test_s3_resource_is_reused(self):
+        """ Test the S3 resource is created once and rebuilt only when its settings change """
+        assert aws.s3() is aws.s3()
+        client = aws.s3().meta.client
+        assert client.meta.config.max_pool_connections == aws.DEFAULT_MAX_POOL_CONNECTIONS
+        assert client.meta.endpoint_url == aws.localhost_s3_url()
+
+        settings = {'LOCALSTACK_HOST': 'example', 'CMA_S3_MAX_POOL_CONNECTIONS': '32'}
+        with patch.dict(os.environ, settings):
+            client = aws.s3().meta.client
+            assert client.meta.endpoint_url == 'http://example:4566'
+            assert client.meta.config.max_pool_connections == 32
+        assert aws.s3().meta.client.meta.endpoint_url == aws.localhost_s3_url()
+
+        resource = aws.s3()
+        aws.reset_s3()
+        assert aws.s3() is not resource
+
+    def test_import_defers_heavy_dependencies(self):
+        """ Test importing the adapter does not load boto3, jsonschema or jsonpath_ng """
+        script = ('import sys, message_adapter.message_adapter; '
+                  'print(sorted(m for m in ("boto3", "jsonschema", "jsonpath_ng") '
+                  'if m in sys.modules))')
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+                                capture_output=True, text=True).stdout
+        assert output.strip() == '[]'
+
+    # compression tests
+    @patch('uuid.uuid4')
+    def test_compressed_result_round_trips(self, uuid_mock):
+        """ Test a compressed remote payload is recorded in the pointer and loaded back """
+        uuid_mock.return_value = self.test_uuid
+        payload = {'granules': [{'granuleId': f'g{index}'} for index in range(100)]}
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'payload': deepcopy(payload),
+            'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1, 'Compression': 'gzip'}
+        }
+        result = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+        assert result['replace']['Compression'] == 'gzip'
+        stored = self.s3.Object(self.bucket_name, self.next_event_object_key_name).get()
+        assert stored['ContentEncoding'] == 'gzip'
+        assert len(stored['Body'].read()) < len(codec.dumps(payload))
+
+        loaded = cumulus_message.load_remote_event(result)
+        assert loaded['payload'] == payload
+        assert 'replace' not in loaded
+
+    @patch('uuid.uuid4')
+    def test_compression_process_default(self, uuid_mock):
+        """ Test CMA_REMOTE_COMPRESSION applies unless ReplaceConfig overrides it """
+        uuid_mock.return_value = self.test_uuid
+        for configured, expected in [({}, 'gzip'), ({'Compression': 'none'}, None)]:
+            event = {
+                'cumulus_meta': {'system_bucket': self.bucket_name},
+                'payload': {'granules': ['g1']},
+                'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1, **configured}
+            }
+            with patch.dict(os.environ, {'CMA_REMOTE_COMPRESSION': 'gzip'}):
+                result = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+            assert result['replace'].get('Compression') == expected
+            assert cumulus_message.load_remote_event(result)['payload'] == {'granules': ['g1']}
+
+    def test_content_encoding_is_decompressed(self):
+        """ Test a pointer without Compression still loads a gzip encoded object """
+        payload = {'granules': ['g1']}
+        self.s3.Object(self.bucket_name, self.next_event_object_key_name).put(
+            Body=compression.compress(codec.dumps(payload), 'gzip'), ContentEncoding='gzip')
+        event = {'payload': {}, 'replace': {'Bucket': self.bucket_name,
+                                            'Key': self.next_event_object_key_name,
+                                            'TargetPath': '$.payload'}}
+        assert cumulus_message.load_remote_event(event)['payload'] == payload
+
+    def test_zstd_round_trip(self):
+        """ Test zstd compression round trips when zstandard is installed """
+        if importlib.util.find_spec('zstandard') is None:
+            self.skipTest('zstandard is not installed')
+        body = codec.dumps({'granules': ['g1'] * 100})
+        compressed = compression.compress(body, 'zstd')
+        assert len(compressed) < len(body)
+        assert compression.decompress(compressed, 'zstd') == body
+
+    def test_unsupported_compression_raises(self):
+        """ Test an unknown Compression value is rejected """
+        event = {'cumulus_meta': {}, 'payload': {},
+                 'ReplaceConfig': {'Path': '$.payload', 'Compression': 'lzma'}}
+        with self.assertRaises(ValueError):
+            cumulus_message.store_remote_response(event, 0, [])
+
+    # transfer tests
+    @patch('uuid.uuid4')
+    def test_multipart_upload_round_trips(self, uuid_mock):
+        """ Test a body at the multipart threshold is uploaded in parts and loads back """
+        uuid_mock.return_value = self.test_uuid
+        payload = {'granules': [f'g{index}' for index in range(1000)]}
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'payload': deepcopy(payload),
+            'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1}
+        }
+        with patch.dict(os.environ, {'CMA_S3_MULTIPART_THRESHOLD': '1'}):
+            result = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+        stored = self.s3.Object(self.bucket_name, self.next_event_object_key_name)
+        assert '-' in stored.e_tag  # multipart ETags carry a part count
+        assert cumulus_message.load_remote_event(result)['payload'] == payload
+
+    def test_load_body_reads_streaming_bodies(self):
+        """ Test bodies are decoded with and without a known length or compression """
+        body = codec.dumps({'a': [1, 2.5, 'three']})
+        gzipped = compression.compress(body, 'gzip')
+        assert transfer.load_body({'Body': io.BytesIO(body), 'ContentLength': len(body)}) == \
+            {'a': [1, 2.5, 'three']}
+        assert transfer.load_body({'Body': io.BytesIO(body)}) == {'a': [1, 2.5, 'three']}
+        assert transfer.load_body({'Body': io.BytesIO(gzipped), 'ContentLength': len(gzipped)},
+                                  'gzip') == {'a': [1, 2.5, 'three']}
+        with self.assertRaises(IOError):
+            transfer.load_body({'Body': io.BytesIO(body[:-1]), 'ContentLength': len(body)})
+
+    # remote cache tests
+    @patch('uuid.uuid4')
+    def test_remote_cache_round_trips(self, uuid_mock):
+        """ Test stored portions are written through, revalidated and refreshed when stale """
+        uuid_mock.return_value = self.test_uuid
+        payload = {'granules': [f'g{index}' for index in range(100)]}
+        remote_cache.configure(max_bytes=1024 * 1024)
+        try:
+            event = {
+                'cumulus_meta': {'system_bucket': self.bucket_name},
+                'payload': deepcopy(payload),
+                'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1, 'Compression': 'gzip'}
+            }
+            stored = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+            assert cumulus_message.load_remote_event(deepcopy(stored))['payload'] == payload
+            info = remote_cache.cache_info()
+            assert (info['hits'], info['misses'], info['entries']) == (1, 0, 1)
+            assert 0 < info['bytes_saved'] < len(codec.dumps(payload))
+
+            self.s3.Object(self.bucket_name, self.next_event_object_key_name).put(
+                Body=compression.compress(codec.dumps({'granules': []}), 'gzip'))
+            assert cumulus_message.load_remote_event(stored)['payload'] == {'granules': []}
+            info = remote_cache.cache_info()
+            assert (info['hits'], info['stale'], info['hit_ratio']) == (1, 1, 0.5)
+        finally:
+            remote_cache.configure()
+
+    def test_remote_cache_disk_tier_outlives_the_process_cache(self):
+        """ Test entries on disk are used by a new cache instance """
+        self.s3.Object(self.bucket_name, self.next_event_object_key_name).put(
+            Body=codec.dumps({'granules': ['g1']}))
+        event = {'payload': {}, 'replace': {'Bucket': self.bucket_name,
+                                            'Key': self.next_event_object_key_name,
+                                            'TargetPath': '$.payload'}}
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                remote_cache.configure(directory=directory)
+                cumulus_message.load_remote_event(deepcopy(event))
+                assert remote_cache.cache_info()['misses'] == 1
+                remote_cache.configure(directory=directory)
+                loaded = cumulus_message.load_remote_event(deepcopy(event))
+                assert loaded['payload'] == {'granules': ['g1']}
+                assert remote_cache.cache_info()['hits'] == 1
+            finally:
+                remote_cache.configure()
+
+    def test_remote_cache_directory_that_cannot_be_created_is_ignored(self):
+        """ Test an unusable CMA_REMOTE_CACHE_DIR disables the disk tier with a warning """
+        with tempfile.NamedTemporaryFile() as not_a_directory:
+            script = ('from message_adapter import remote_cache; '
+                      'print(remote_cache.cache_info()["directory"])')
+            completed = subprocess.run(
+                [sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                env={**os.environ, 'CMA_REMOTE_CACHE_DIR': f'{not_a_directory.name}/cache'})
+        assert completed.stdout.strip() == 'None'
+        assert 'Ignoring CMA_REMOTE_CACHE_DIR' in completed.stderr
+
+    def test_weighed_lru_cache_bounds_total_weight(self):
+        """ Test a weighed cache evicts by total weight and skips oversized values """
+        cache = lru.LRUCache(10, weigh=len)
+        cache.put('a', 'xxxx')
+        cache.put('b', 'xxxx')
+        cache.put('c', 'xxxx')
+        assert cache.get('a') is None
+        assert cache.info()['weight'] == 8
+        cache.put('big', 'x' * 11)
+        assert cache.get('big') is None
+        assert cache.get('c') == 'xxxx'
+
+    # content-addressed storage tests
+    def test_content_addressed_storage_skips_duplicate_uploads(self):
+        """ Test identical portions share one digest-named object, uploaded once """
+        payload = {'granules': [f'g{index}' for index in range(100)]}
+        key = transfer.content_key(codec.dumps(payload), 'gzip')
+
+        def store(max_age='86400'):
+            event = {
+                'cumulus_meta': {'system_bucket': self.bucket_name},
+                'payload': deepcopy(payload),
+                'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1, 'Compression': 'gzip',
+                                  'ContentAddressed': True}
+            }
+            with patch.dict(os.environ, {'CMA_REMOTE_DEDUP_MAX_AGE': max_age}):
+                return cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+
+        try:
+            with patch.object(transfer, 'upload_body', wraps=transfer.upload_body) as upload:
+                first = store()
+                second = store()
+                assert upload.call_count == 1
+                store(max_age='-1')
+                assert upload.call_count == 2
+            assert first['replace'] == second['replace'] == {
+                'Bucket': self.bucket_name, 'Key': key, 'TargetPath': '$.payload',
+                'Compression': 'gzip'}
+            assert cumulus_message.load_remote_event(second)['payload'] == payload
+        finally:
+            self.s3.Object(self.bucket_name, key).delete()
+
+    # message size budget tests
+    def test_budget_offloads_largest_subtrees(self):
+        """ Test MaxMessageSize offloads the fewest, largest subtrees to fit the budget """
+        meta = {
+            'workflow_tasks': {f'task{index}': {'arn': 'x' * 50} for index in range(40)},
+            'collection': {'name': 'MOD09GQ', 'files': ['f' * 80] * 20},
+            'provider': {'id': 'small'}
+        }
+        payload = {'granules': [{'granuleId': f'g{index}'} for index in range(200)]}
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'meta': deepcopy(meta),
+            'payload': deepcopy(payload),
+            'ReplaceConfig': {'MaxMessageSize': 2500}
+        }
+        stored = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+        pointers = stored['replace']
+        try:
+            assert [pointer['TargetPath'] for pointer in pointers] == [
+                '$.payload', '$.meta.workflow_tasks']
+            assert stored['payload'] == {} and stored['meta']['workflow_tasks'] == {}
+            assert stored['meta']['collection'] == meta['collection']
+            assert len(json.dumps(stored)) <= 2500
+
+            loaded = cumulus_message.load_remote_event(deepcopy(stored))
+            assert loaded['payload'] == payload
+            assert loaded['meta'] == meta
+            assert 'replace' not in loaded
+        finally:
+            for pointer in pointers:
+                self.s3.Object(self.bucket_name, pointer['Key']).delete()
+
+    def test_budget_boundaries_match_the_emitted_size(self):
+        """ Test MaxMessageSize is met exactly at its boundary, with one or several pointers """
+        def offload(meta, budget):
+            event = {'cumulus_meta': {'system_bucket': self.bucket_name}, 'meta': deepcopy(meta),
+                     'payload': {'data': 'x' * 500}, 'ReplaceConfig': {'MaxMessageSize': budget}}
+            stream = io.StringIO()
+            try:
+                log.configure(stream=stream)
+                stored = cumulus_message.store_remote_response(
+                    event, 0, ['ReplaceConfig'], store_body=lambda *_: 'events/fixed-key')
+                log.flush()
+            finally:
+                log.configure()
+            return stored, len(codec.dumps(stored)), stream.getvalue()
+
+        for meta, pointer_count in (({}, 1), ({'big': 'y' * 400}, 2)):
+            _, emitted, _ = offload(meta, 1)
+            for budget in (emitted - 1, emitted, emitted + 1):
+                stored, size, warning = offload(meta, budget)
+                pointers = stored['replace'] if pointer_count > 1 else [stored['replace']]
+                assert len(pointers) == pointer_count
+                assert size == emitted
+                if budget < emitted:
+                    assert f'at {emitted} bytes, over its MaxMessageSize of {budget}' in warning
+                else:
+                    assert warning == ''
+
+    def test_budget_offloading_never_grows_the_message(self):
+        """ Test subtrees smaller than their pointer are not offloaded """
+        stored_bodies = []
+
+        def store_body(bucket, body, replace_config_values):
+            stored_bodies.append(body)
+            return cumulus_message.object_key(body, replace_config_values)
+
+        for meta in ({'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'big': 'y' * 400, 'c': [3]}):
+            for budget in (1, 150, 300):
+                stored_bodies.clear()
+                def event(max_message_size):
+                    return {'cumulus_meta': {'system_bucket': self.bucket_name},
+                            'meta': deepcopy(meta), 'payload': {},
+                            'ReplaceConfig': {'MaxMessageSize': max_message_size}}
+
+                original_size = len(codec.dumps(cumulus_message.store_remote_response(
+                    event(10 ** 6), 0, ['ReplaceConfig'], store_body=store_body)))
+                stored = cumulus_message.store_remote_response(
+                    event(budget), 0, ['ReplaceConfig'], store_body=store_body)
+                assert len(codec.dumps(stored)) <= original_size
+                assert all(len(body) > 100 for body in stored_bodies)
+                self.assertEqual(meta['a'], stored['meta']['a'])
+
+    def test_budget_within_limit_is_not_offloaded(self):
+        """ Test a message under its MaxMessageSize is returned without a pointer """
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'meta': {'workflow_tasks': {}},
+            'payload': {'granules': []},
+            'ReplaceConfig': {'MaxMessageSize': 10000, 'Paths': ['$.payload']}
+        }
+        stored = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+        assert 'replace' not in stored
+        assert stored['payload'] == {'granules': []}
+
+    # tracing tests
+    @patch('uuid.uuid4')
+    def test_trace_spans_remote_phases(self, uuid_mock):
+        """ Test a traced command records its S3 and serialization phases with their bytes """
+        uuid_mock.return_value = self.test_uuid
+        event = {
+            'cumulus_meta': {'system_bucket': self.bucket_name},
+            'payload': {'granules': [f'g{index}' for index in range(100)]},
+            'ReplaceConfig': {'Path': '$.payload', 'MaxSize': 1, 'Compression': 'gzip'}
+        }
+        with tempfile.TemporaryDirectory() as trace_dir:
+            trace_path = os.path.join(trace_dir, 'trace.jsonl')
+            with patch.dict(os.environ, {'CMA_TRACE': trace_path}):
+                with tracing.command('createNextEvent'):
+                    stored = cumulus_message.store_remote_response(event, 0, ['ReplaceConfig'])
+                with tracing.command('loadAndUpdateRemoteEvent'):
+                    cumulus_message.load_remote_event(stored)
+            with patch.dict(os.environ, {'CMA_TRACE': ''}):
+                with tracing.command('untraced'):
+                    assert tracing.span('serialize') is tracing.NO_SPAN
+            with open(trace_path, encoding='utf-8') as trace_file:
+                store_record, load_record = [json.loads(line) for line in trace_file]
+
+        spans = {span['name']: span for span in store_record['spans']}
+        assert list(spans) == ['serialize', 'compress', 's3.put']
+        assert spans['serialize']['bytes'] == spans['compress']['bytes']
+        assert 0 < spans['s3.put']['bytes'] < spans['serialize']['bytes']
+        spans = {span['name']: span for span in load_record['spans']}
+        assert list(spans) == ['s3.get', 'deserialize', 'remote.load']
+        assert spans['s3.get']['bytes'] == store_record['spans'][2]['bytes']
+        assert spans['deserialize']['bytes'] == store_record['spans'][0]['bytes']
+
+    # log tests
+    def test_log_is_leveled_and_buffered(self):
+        """ Test debug chatter is dropped by default and other records are written in batches """
+        stream = io.StringIO()
+        try:
+            log.configure(stream=stream)
+            cumulus_message.load_config({'task_config': {}})
+            log.logger.warning('first')
+            assert stream.getvalue() == ''
+            log.flush()
+            assert stream.getvalue() == 'first\n'
+
+            log.configure(level='debug', buffer=3, stream=stream)
+            cumulus_message.load_config({'task_config': {}})
+            log.logger.error('failed')
+            assert stream.getvalue() == 'first\nStarting load_config\nfailed\n'
+
+            with self.assertWarns(DeprecationWarning):
+                error.write_error('legacy')
+            assert stream.getvalue().endswith('failed\nlegacy\n')
+
+            stream = io.StringIO()
+            with patch.dict(os.environ, {'CMA_LOG_LEVEL': 'loud', 'CMA_LOG_BUFFER': 'many'}):
+                log.configure(stream=stream)
+            assert log.logger.level == logging.WARNING
+            log.flush()
+            self.assertEqual("Ignoring CMA_LOG_LEVEL='loud', which is not a logging level; "
+                             "using WARNING\nIgnoring CMA_LOG_BUFFER='many', which is not an "
+                             "integer; using 100\n", stream.getvalue())
+        finally:
+            log.configure()
+
+    # batch tests
+    def test_batches_report_per_item_results_and_errors(self):
+        """ Test batch methods match the single-event methods and isolate failing items """
+        missing = {'replace': {'Bucket': self.bucket_name, 'Key': 'missing.json',
+                               'TargetPath': '$'}}
+        events = [self.event_with_replace, self.event_without_replace, missing]
+        records = self.cumulus_message_adapter.load_and_update_remote_events(events)
+        assert records[0] == {'result': self.s3_object}
+        assert records[1] == {'result': self.event_without_replace}
+        assert records[2]['error'] == 'NoSuchKey'
+
+        events = [{'task_config': {'n': '{$.meta.n}', 'cumulus_message': {'input': '{$.meta}'}},
+                   'meta': {'n': index}, 'payload': {}} for index in range(20)]
+        events.append({'task_config': {'n': '{$.meta.[}'}})
+        records = self.cumulus_message_adapter.load_nested_events(events)
+        for event, record in zip(events[:-1], records):
+            assert record == {'result': self.cumulus_message_adapter.load_nested_event(event)}
+        assert records[-1]['error'] == 'JsonPathParserError'
+
+        records = self.cumulus_message_adapter.create_next_events(
+            [{'a': index} for index in range(20)], events[:-1])
+        assert [record['result']['payload'] for record in records] == [
+            {'a': index} for index in range(20)]
+        with self.assertRaises(ValueError):
+            self.cumulus_message_adapter.create_next_events([{}], events)
+
+    # async adapter tests
+    def test_async_adapter_offloads_and_hydrates_concurrently(self):
+        """ Test AsyncMessageAdapter round-trips every pointer through its store at once """
+        class CountingStore(aio.MemoryObjectStore):
+            """ Records the most gets in flight at one time """
+            active = peak = 0
+
+            async def get(self, bucket, key):
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+                await asyncio.sleep(0.01)
+                self.active -= 1
+                return await super().get(bucket, key)
+
+        meta = {
+            'workflow_tasks': {f'task{index}': {'arn': 'x' * 50} for index in range(40)},
+            'collection': {'name': 'MOD09GQ', 'files': ['f' * 80] * 20}
+        }
+        payload = {'granules': [{'granuleId': f'g{index}'} for index in range(200)]}
+        event = {'cumulus_meta': {'system_bucket': 'async-bucket'}, 'meta': meta,
+                 'ReplaceConfig': {'MaxMessageSize': 2500, 'Compression': 'gzip'}}
+
+        async def round_trip(adapter, count):
+            stored = await asyncio.gather(*(adapter.create_next_event(payload, event, None)
+                                            for _ in range(count)))
+            return stored, await asyncio.gather(*(adapter.load_and_update_remote_event(
+                message, None) for message in stored))
+
+        counting = CountingStore()
+        with tempfile.TemporaryDirectory() as root:
+            for store in (counting, aio.FileSystemObjectStore(root)):
+                adapter = aio.AsyncMessageAdapter(store=store)
+                stored, loaded = asyncio.run(round_trip(adapter, 5))
+                for message, hydrated in zip(stored, loaded):
+                    assert [pointer['TargetPath'] for pointer in message['replace']] == [
+                        '$.payload', '$.meta.workflow_tasks']
+                    assert hydrated['payload'] == payload and hydrated['meta'] == meta
+                    assert 'replace' not in hydrated
+        # Both pointers of all five messages were fetched at once
+        assert counting.peak == 10
+        assert all(encoding == 'gzip' for _, encoding in counting.objects.values())
+
+        class ReadOnlyStore(aio.ObjectStore):  # pylint: disable=abstract-method
+            """ Lacks put """
+
+            async def get(self, bucket, key):
+                return b'{}', None
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStore()
+
+    # execution history tests
+    def test_task_name_lookup_reads_history_lazily(self):
+        """ Test the task name lookup stops at the first answering page and caches by ARN """
+        lambda_arn = 'arn:aws:lambda:us-east-1:123:function:sync'
+
+        def step(event_id, event_type, **fields):
+            return {'id': event_id, 'type': event_type, 'previousEventId': event_id - 1,
+                    **fields}
+
+        def entered(event_id, name):
+            return step(event_id, 'TaskStateEntered', stateEnteredEventDetails={'name': name})
+
+        def scheduled(event_id, resource):
+            return step(event_id, 'LambdaFunctionScheduled',
+                        lambdaFunctionScheduledEventDetails={'resource': resource})
+
+        # Newest first: SyncGranule's Lambda was scheduled last, and the TaskStateEntered
+        # event it refers to is on the next page
+        history = [[scheduled(1001, lambda_arn)], [entered(1000, 'SyncGranule')]] + [
+            [entered(event_id, 'Earlier'), scheduled(event_id - 1, 'other')]
+            for event_id in range(998, 0, -2)]
+        read = []
+
+        def pager():
+            for page in history:
+                read.append(page)
+                yield page
+
+        execution_history.clear_cache()
+        arn = execution_history.execution_arn('arn:aws:states:us-east-1:123:stateMachine:wf',
+                                              'run-1')
+        assert arn == 'arn:aws:states:us-east-1:123:execution:wf:run-1'
+        assert execution_history.lookup_task_name(arn, lambda_arn, pager()) == 'SyncGranule'
+        assert len(read) == 2
+        assert execution_history.lookup_task_name(arn, lambda_arn, pager()) == 'SyncGranule'
+        assert len(read) == 2
+        assert execution_history.lookup_task_name(arn, None, pager()) == 'SyncGranule'
+        # A task entered by another branch of a parallel execution is not the ARN's task
+        parallel = [entered(12, 'OtherBranch'), scheduled(11, lambda_arn),
+                    entered(10, 'Mine')]
+        assert execution_history.task_name_from_events(parallel, lambda_arn) == 'Mine'
+        assert execution_history.task_name_from_events(parallel, None) == 'OtherBranch'
+        execution_history.clear_cache()
+        assert execution_history.lookup_task_name(arn, lambda_arn, [parallel]) == 'Mine'
+        assert execution_history.lookup_task_name(arn, lambda_arn, []) == 'Mine'
+        with self.assertRaises(LookupError):
+            execution_history.task_name_from_events(
+                [scheduled(5, lambda_arn), step(4, 'Pass'), entered(3, 'Previous')],
+                lambda_arn)
+        with self.assertRaises(LookupError):
+            execution_history.task_name_from_events(iter(history[0]), 'missing')
+
+        class FakeClient:  # pylint: disable=too-few-public-methods
+            """ Serves history pages as the Step Functions API does """
+            calls = []
+
+            def get_execution_history(self, **arguments):
+                """ Returns the page for the request's nextToken """
+                self.calls.append(arguments)
+                index = int(arguments.get('nextToken', 0))
+                response = {'events': history[index]}
+                if index + 1 < len(history):
+                    response['nextToken'] = str(index + 1)
+                return response
+
+        pages = execution_history.history_pages(FakeClient(), arn, page_size=2)
+        assert next(pages) == history[0] and next(pages) == history[1]
+        assert FakeClient.calls[1] == {'executionArn': arn, 'reverseOrder': True,
+                                       'maxResults': 2, 'nextToken': '1'}
+
+    # ingest tests
+    def test_ingest_reads_lines_in_bounded_chunks(self):
+        """ Test input lines are read in chunks into one buffer that decoding releases """
+        document = {'payload': ['x' * 10] * 10}
+        line = json.dumps(document).encode('utf-8') + b'\n'
+        with patch.object(ingest, 'CHUNK_SIZE', 16):
+            body = ingest.read_line(io.BytesIO(line + b'next\n'), len(line) - 1)
+            assert body == line
+            assert ingest.load(body) == document
+            assert body == bytearray()
+            with self.assertRaises(ingest.InputTooLarge):
+                ingest.read_line(io.BytesIO(line), len(line) - 2)
+
+    def test_incremental_parser_matches_json(self):
+        """ Test the incremental parser decodes documents split across chunks like json """
+        document = {'payload': {'granules': [{'id': 'ü€😀"\\', 'size': 12345678901234567890,
+                                              'ratio': -2.5e-10, 'ok': True, 'prev': None}] * 3,
+                                'empty': [{}, [], '']},
+                    'meta': {'nested': [[[[1.5]]]], 'flags': [False, 0, -1]}}
+        for text in (json.dumps(document), json.dumps(document, indent=2, ensure_ascii=False)):
+            data = text.encode('utf-8')
+            with patch.object(ingest, 'CHUNK_SIZE', 3):
+                assert ingest.IncrementalParser(io.BytesIO(data + b'\nnext')).parse() == document
+                parser = ingest.IncrementalParser(io.BytesIO(data + b'  tail'), length=len(data))
+                assert ingest.load(parser) == document
+                assert len(parser) == parser.size == len(data)
+                with self.assertRaises(ingest.InputTooLarge):
+                    ingest.IncrementalParser(io.BytesIO(data), len(data) - 1).parse()
+        for invalid in (b'{"a" 1}', b'[1, 2', b'[1]x', b'{"a": tru}', b'"open', b''):
+            with self.assertRaises(ValueError):
+                ingest.IncrementalParser(io.BytesIO(invalid)).parse()
@@ -1,17 +1,24 @@
 """
 Tests for cumulus-message-adapter command-line interface
 """
+import io
 import json
 import os
+import signal
+import socket
 import subprocess
+import tempfile
+import time
 import unittest
 
 from message_adapter import aws
+from message_adapter.message_adapter import MessageAdapter
 
 
 class Test(unittest.TestCase):
     # pylint: disable=attribute-defined-outside-init
     # pylint: disable=too-many-locals
+    # pylint: disable=too-many-public-methods
 
     """ Test class """
     test_folder = os.path.join(os.getcwd(), 'examples/messages')
@@ -84,6 +91,27 @@ class Test(unittest.TestCase):
         p_stdin.write('<EOC>\n'.encode('utf-8'))
         p_stdin.flush()
 
+    @staticmethod
+    def read_framed_output(stream_process):
+        """
+        Given a subprocess using the framed protocol, read one length-prefixed response
+        """
+        header = stream_process.stdout.readline()
+        if not header:
+            err_string = ''.join([x.decode('utf-8') for x in stream_process.stderr.readlines()])
+            raise RuntimeError(err_string)
+        return json.loads(stream_process.stdout.read(int(header)))
+
+    @staticmethod
+    def write_framed_input(command, proc_input, p_stdin):
+        """
+        Given a stdin pipe for a subprocess, write a length-prefixed command to CMA subprocess
+        """
+        body = json.dumps(proc_input, indent=2).encode('utf-8')
+        p_stdin.write(f'{command} {len(body)}\n'.encode('utf-8'))
+        p_stdin.write(body)
+        p_stdin.flush()
+
     def transform_messages_streaming(self, params):
         """
         Given a testcase, run 'streaming' interface against input and check if outputs are correct
@@ -110,12 +138,21 @@ class Test(unittest.TestCase):
         stream_process = subprocess.Popen(['python', current_directory, 'stream'],
                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                                           stderr=subprocess.PIPE)
-        self.write_streaming_input('loadAndUpdateRemoteEvent', cma_input, stream_process.stdin)
-        load_and_update_remote_event_response = self.read_streaming_output(stream_process)
+        write_input = self.write_streaming_input
+        read_output = self.read_streaming_output
+        if params.get('framed'):
+            stream_process.stdin.write('<FRAMED>\n'.encode('utf-8'))
+            stream_process.stdin.flush()
+            assert stream_process.stdout.readline() == '<FRAMED>\n'.encode('utf-8')
+            write_input = self.write_framed_input
+            read_output = self.read_framed_output
+
+        write_input('loadAndUpdateRemoteEvent', cma_input, stream_process.stdin)
+        load_and_update_remote_event_response = read_output(stream_process)
         cma_input = {'event': load_and_update_remote_event_response, 'context': context,
                      'schemas': schemas}
-        self.write_streaming_input('loadNestedEvent', cma_input, stream_process.stdin)
-        load_nested_event_response = self.read_streaming_output(stream_process)
+        write_input('loadNestedEvent', cma_input, stream_process.stdin)
+        load_nested_event_response = read_output(stream_process)
 
         message_config = load_nested_event_response.get('messageConfig')
         if 'messageConfig' in load_nested_event_response:
@@ -123,8 +160,8 @@ class Test(unittest.TestCase):
         cma_input = {'handler_response': load_nested_event_response,
                      'event': load_and_update_remote_event_response,
                      'message_config': message_config, 'schemas': schemas}
-        self.write_streaming_input('createNextEvent', cma_input, stream_process.stdin)
-        create_next_event_response = self.read_streaming_output(stream_process)
+        write_input('createNextEvent', cma_input, stream_process.stdin)
+        create_next_event_response = read_output(stream_process)
 
         stream_process.stdin.write('<EXIT>\n'.encode('utf-8'))
         stream_process.stdin.flush()
@@ -203,6 +240,230 @@ class Test(unittest.TestCase):
         self.transform_messages({'testcase': 'basic'})
         self.transform_messages_streaming({'testcase': 'basic'})
 
+    def test_framed_streaming(self):
+        """ test the length-prefixed stream protocol """
+        for testcase in ['basic', 'remote', 'templates', 'exception']:
+            self.transform_messages_streaming({'testcase': testcase, 'framed': True})
+        context = {
+            'functionName': 'first_function',
+            'invokedFunctionArn': 'fakearn',
+            'functionVersion': '1',
+        }
+        self.transform_messages_streaming({
+            'testcase': 'workflow_tasks',
+            'context': context,
+            'framed': True
+        })
+
+    def test_pipelined_streaming(self):
+        """ test the pipelined stream protocol answers every tagged request """
+        schemas = {
+            'input': 'schemas/examples-messages.input.json',
+            'output': 'schemas/examples-messages.output.json',
+            'config': 'schemas/examples-messages.config.json'
+        }
+        testcases = ['basic', 'jsonpath', 'meta', 'templates']
+        stream_process = subprocess.Popen(['python', os.getcwd(), 'stream'],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE)
+        stream_process.stdin.write(b'<PIPELINED>\n')
+        stream_process.stdin.flush()
+        assert stream_process.stdout.readline() == b'<PIPELINED>\n'
+
+        for request_id, testcase in enumerate(testcases):
+            with open(os.path.join(self.test_folder, f'{testcase}.input.json'),
+                      encoding='utf-8') as inp:
+                body = json.dumps({'event': json.load(inp), 'context': {},
+                                   'schemas': schemas}).encode('utf-8')
+            stream_process.stdin.write(
+                f'{request_id} loadAndUpdateRemoteEvent {len(body)}\n'.encode('utf-8'))
+            stream_process.stdin.write(body)
+        stream_process.stdin.write(b'bad unknownCommand 13\n{"event": {}}<EXIT>\n')
+        stream_process.stdin.flush()
+
+        responses = {}
+        for _ in range(len(testcases) + 1):
+            request_id, status, length = stream_process.stdout.readline().split()
+            responses[request_id.decode('utf-8')] = (
+                status, json.loads(stream_process.stdout.read(int(length))))
+        assert stream_process.wait(20) == 0
+
+        for request_id, testcase in enumerate(testcases):
+            with open(os.path.join(self.test_folder, f'{testcase}.input.json'),
+                      encoding='utf-8') as inp:
+                assert responses[str(request_id)] == (b'OK', json.load(inp))
+        status, error = responses['bad']
+        assert status == b'ERROR'
+        assert error['error'] == 'ValueError'
+
+    def test_daemon(self):
+        """ test the daemon serves stream sessions from several clients on a Unix socket """
+        testcases = ['basic', 'jsonpath', 'meta', 'templates']
+        with tempfile.TemporaryDirectory() as socket_dir:
+            socket_path = os.path.join(socket_dir, 'cma.sock')
+            daemon_process = subprocess.Popen(  # pylint: disable=consider-using-with
+                ['python', os.getcwd(), 'daemon', socket_path],
+                env=dict(os.environ, CMA_DAEMON_WORKERS='2'), stderr=subprocess.PIPE)
+            try:
+                for _ in range(100):
+                    if os.path.exists(socket_path):
+                        break
+                    time.sleep(0.1)
+                connections = []
+                for handshake in (b'<FRAMED>', b'<PIPELINED>', b'<FRAMED>'):
+                    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    connection.connect(socket_path)
+                    reader, writer = connection.makefile('rb'), connection.makefile('wb')
+                    writer.write(handshake + b'\n')
+                    writer.flush()
+                    assert reader.readline() == handshake + b'\n'
+                    connections.append((connection, reader, writer))
+
+                for testcase in testcases:
+                    with open(os.path.join(self.test_folder, f'{testcase}.input.json'),
+                              encoding='utf-8') as inp:
+                        in_msg = json.load(inp)
+                    body = json.dumps({'event': in_msg}).encode('utf-8')
+                    for index, (_, reader, writer) in enumerate(connections):
+                        tag = b'1 ' if index == 1 else b''
+                        writer.write(tag + f'loadNestedEvent {len(body)}\n'.encode('utf-8'))
+                        writer.write(body)
+                        writer.flush()
+                    responses = []
+                    for index, (_, reader, _) in enumerate(connections):
+                        header = reader.readline().split()
+                        assert index != 1 or header[:2] == [b'1', b'OK']
+                        responses.append(json.loads(reader.read(int(header[-1]))))
+                    expected = json.loads(json.dumps(MessageAdapter().load_nested_event(in_msg)))
+                    assert responses == [expected] * len(connections)
+
+                for connection, reader, writer in connections:
+                    writer.write(b'<EXIT>\n')
+                    writer.flush()
+                    assert reader.read() == b''
+                    connection.close()
+            finally:
+                daemon_process.send_signal(signal.SIGTERM)
+                _, errorstr = daemon_process.communicate(timeout=20)
+            assert daemon_process.returncode == 0, errorstr
+            assert not os.path.exists(socket_path)
+
+    def test_trace_records(self):
+        """ test CMA_TRACE writes one record per command with a span for each phase """
+        schemas = {
+            'input': 'schemas/examples-messages.input.json',
+            'config': 'schemas/examples-messages.config.json'
+        }
+        with open(os.path.join(self.test_folder, 'templates.input.json'),
+                  encoding='utf-8') as inp:
+            cma_input = json.dumps({'event': json.load(inp), 'schemas': schemas})
+        with tempfile.TemporaryDirectory() as trace_dir:
+            trace_path = os.path.join(trace_dir, 'trace.jsonl')
+            env = dict(os.environ, CMA_TRACE=trace_path)
+            for _ in range(2):
+                subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=cma_input,
+                               env=env, check=True, capture_output=True, text=True)
+            with open(trace_path, encoding='utf-8') as trace_file:
+                records = [json.loads(line) for line in trace_file]
+
+        assert len(records) == 2
+        record = records[0]
+        assert record['command'] == 'loadNestedEvent'
+        assert record['status'] == 'ok'
+        assert record['wall_ms'] >= sum(span['wall_ms'] for span in record['spans'])
+        assert [span['name'] for span in record['spans']] == [
+            'deserialize', 'config.resolve', 'input.resolve', 'schema.validate',
+            'schema.validate', 'serialize']
+        assert [span.get('schema') for span in record['spans'][3:5]] == ['input', 'config']
+        assert record['spans'][0]['bytes'] == len(cma_input.encode('utf-8'))
+
+    def test_batch_command(self):
+        """ test batch commands return a result or error record per event """
+        testcases = ['basic', 'jsonpath', 'meta', 'templates']
+        events = []
+        for testcase in testcases:
+            with open(os.path.join(self.test_folder, f'{testcase}.input.json'),
+                      encoding='utf-8') as inp:
+                events.append(json.load(inp))
+        cma_input = json.dumps({'events': events + [None]})
+        _, outstr, _ = self.execute_command(['python', os.getcwd(), 'loadNestedEventBatch'],
+                                            cma_input)
+        records = json.loads(outstr)
+        assert records[:-1] == [
+            {'result': json.loads(json.dumps(MessageAdapter().load_nested_event(event)))}
+            for event in events]
+        assert records[-1]['error'] == 'TypeError'
+
+        empty = subprocess.run(['python', os.getcwd(), 'loadNestedEventBatch'],
+                               input='{"events": []}', check=True, capture_output=True, text=True)
+        assert json.loads(empty.stdout) == []
+
+    def test_log_level(self):
+        """ test CMA_LOG_LEVEL controls the diagnostic lines written to stderr """
+        with open(os.path.join(self.test_folder, 'basic.input.json'), encoding='utf-8') as inp:
+            cma_input = json.dumps({'event': json.load(inp)})
+        quiet = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=cma_input,
+                               check=True, capture_output=True, text=True)
+        assert quiet.stderr == ''
+        verbose = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=cma_input,
+                                 env=dict(os.environ, CMA_LOG_LEVEL='DEBUG'),
+                                 check=True, capture_output=True, text=True)
+        assert verbose.stderr.splitlines()[0] == 'Starting load_config'
+        failed = subprocess.run(['python', os.getcwd(), 'unknownCommand'], input=cma_input,
+                                check=False, capture_output=True, text=True)
+        assert failed.returncode == 1
+        assert failed.stderr.startswith('Unexpected Error')
+
+    def test_max_input_bytes(self):
+        """ test CMA_MAX_INPUT_BYTES rejects oversized input without ending a pipelined session """
+        with open(os.path.join(self.test_folder, 'basic.input.json'), encoding='utf-8') as inp:
+            body = json.dumps({'event': json.load(inp)}).encode('utf-8')
+        env = dict(os.environ, CMA_MAX_INPUT_BYTES=str(len(body)))
+        result = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=body + b'\n',
+                                env=env, check=True, capture_output=True)
+        assert 'input' in json.loads(result.stdout)
+        env['CMA_MAX_INPUT_BYTES'] = str(len(body) - 1)
+        failed = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=body,
+                                env=env, check=False, capture_output=True)
+        assert failed.returncode == 1
+        assert b'exceeds the CMA_MAX_INPUT_BYTES limit' in failed.stderr
+
+        env['CMA_MAX_INPUT_BYTES'] = '20'
+        requests = (b'<PIPELINED>\nbig loadNestedEvent %d\n%ssmall loadNestedEvent 13\n'
+                    b'{"event": {}}<EXIT>\n' % (len(body), body))
+        session = subprocess.run(['python', os.getcwd(), 'stream'], input=requests, env=env,
+                                 check=True, capture_output=True)
+        output = io.BytesIO(session.stdout)
+        assert output.readline() == b'<PIPELINED>\n'
+        responses = {}
+        for _ in range(2):
+            request_id, status, length = output.readline().split()
+            responses[request_id] = (status, json.loads(output.read(int(length))))
+        assert responses[b'big'] == (b'ERROR', {
+            'error': 'InputTooLarge',
+            'message': f'Input of at least {len(body)} bytes exceeds the CMA_MAX_INPUT_BYTES '
+                       'limit of 20 bytes'})
+        assert responses[b'small'][0] == b'OK'
+
+    def test_incremental_input_parser(self):
+        """ test CMA_INPUT_PARSER=incremental gives the same results for single and framed input """
+        with open(os.path.join(self.test_folder, 'basic.input.json'), encoding='utf-8') as inp:
+            body = json.dumps({'event': json.load(inp)}).encode('utf-8')
+        env = dict(os.environ, CMA_INPUT_PARSER='incremental')
+        expected = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=body,
+                                  check=True, capture_output=True).stdout
+        result = subprocess.run(['python', os.getcwd(), 'loadNestedEvent'], input=body,
+                                env=env, check=True, capture_output=True)
+        assert result.stdout == expected
+
+        requests = b'<FRAMED>\n' + b'loadNestedEvent %d\n%s' % (len(body), body) * 2 + b'<EXIT>\n'
+        session = subprocess.run(['python', os.getcwd(), 'stream'], input=requests, env=env,
+                                 check=True, capture_output=True)
+        output = io.BytesIO(session.stdout)
+        assert output.readline() == b'<FRAMED>\n'
+        for _ in range(2):
+            assert output.read(int(output.readline())) == expected
+
     def test_basic_no_config(self):
         """ test basic no config message """
         schemas = {